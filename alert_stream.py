@@ -0,0 +1,184 @@
+import operator
+import threading
+import time
+from collections import OrderedDict, deque
+
+from rule_engine import DEFAULT_VITALS
+
+_OPERATORS = {'>': operator.gt, '<': operator.lt, '>=': operator.ge, '<=': operator.le}
+
+# Windowed rules applied on top of the per-reading threshold checks.
+# "sustained" rules fire after `count` consecutive readings past `limit` and
+# stay active until the value crosses back past `clear` (hysteresis).
+# "rate" rules fire when a vital moves more than `max_change` over the last
+# `span` readings and re-arm once the change drops below `clear`.
+DEFAULT_STREAM_RULES = [
+    {'name': 'sustained_tachycardia', 'kind': 'sustained', 'vital': 'heart_rate', 'op': '>',
+     'limit': 100, 'count': 5, 'clear': 95, 'severity': 'high',
+     'message': "Sustained high heart rate: {value} bpm for {count} readings"},
+    {'name': 'sustained_bradycardia', 'kind': 'sustained', 'vital': 'heart_rate', 'op': '<',
+     'limit': 60, 'count': 5, 'clear': 63, 'severity': 'low',
+     'message': "Sustained low heart rate: {value} bpm for {count} readings"},
+    {'name': 'sustained_hypoxemia', 'kind': 'sustained', 'vital': 'spo2', 'op': '<',
+     'limit': 94, 'count': 3, 'clear': 95, 'severity': 'low',
+     'message': "Sustained low oxygen saturation: {value}% for {count} readings"},
+    {'name': 'sustained_fever', 'kind': 'sustained', 'vital': 'body_temp', 'op': '>',
+     'limit': 38.0, 'count': 3, 'clear': 37.7, 'severity': 'high',
+     'message': "Sustained high body temperature: {value} °C for {count} readings"},
+    {'name': 'heart_rate_swing', 'kind': 'rate', 'vital': 'heart_rate', 'max_change': 30,
+     'span': 3, 'clear': 20, 'severity': 'high',
+     'message': "Rapid heart rate change: {change:+} bpm over {span} readings"},
+    {'name': 'systolic_swing', 'kind': 'rate', 'vital': 'blood_pressure', 'max_change': 40,
+     'span': 3, 'clear': 25, 'severity': 'high',
+     'message': "Rapid systolic BP change: {change:+} mmHg over {span} readings"}
+]
+
+# After the operator has been told about a (type, severity) once, repeats
+# are held back for this long
+DEFAULT_DEDUP_SECONDS = 300
+
+
+class _PatientState:
+    __slots__ = ('values', 'counts', 'active', 'last_sent')
+
+    def __init__(self, spans, rule_count):
+        # One ring buffer per vital, sized to the longest span that reads it
+        self.values = {vital: deque(maxlen=span) for vital, span in spans.items()}
+        self.counts = [0] * rule_count
+        self.active = [False] * rule_count
+        self.last_sent = {}  # alert key -> time it was last passed through
+
+
+class StreamingAlertEngine:
+    """
+    Per-patient streaming alert stage.
+
+    Each patient has bounded state: a fixed-size ring buffer per vital used
+    by rate rules, a consecutive-breach counter and an active flag per rule,
+    and the last time each kind of alert was let through. A reading updates
+    that state in O(1) per rule, so nothing is rescanned. Only the
+    `max_patients` most recently seen patients are kept.
+    """
+
+    def __init__(self, rules=None, vitals=None, dedup_seconds=DEFAULT_DEDUP_SECONDS,
+                 max_patients=100000):
+        self.rules = list(rules if rules is not None else DEFAULT_STREAM_RULES)
+        self.vitals = vitals or DEFAULT_VITALS
+        self.dedup_seconds = dedup_seconds
+        self.max_patients = max_patients
+        self.lock = threading.Lock()
+        self._patients = OrderedDict()  # patient_id -> _PatientState, least recent first
+
+        self._spans = {}
+        self._compiled = []
+        for position, rule in enumerate(self.rules):
+            vital = self.vitals[rule['vital']]
+            span = rule.get('span', 0) + 1
+            self._spans[rule['vital']] = max(self._spans.get(rule['vital'], 1), span)
+            self._compiled.append((position, rule, vital['field'], vital.get('item'),
+                                   _OPERATORS.get(rule.get('op'))))
+
+    def _state(self, patient_id):
+        state = self._patients.get(patient_id)
+        if state is None:
+            state = self._patients[patient_id] = _PatientState(self._spans, len(self.rules))
+            if len(self._patients) > self.max_patients:
+                self._patients.popitem(last=False)
+        else:
+            self._patients.move_to_end(patient_id)
+        return state
+
+    def _read(self, data, field, item):
+        value = data.get(field)
+        if value is not None and item is not None:
+            value = value[item]
+        return value
+
+    def process(self, data, alerts=()):
+        """
+        Feed one reading through the windowed rules. `alerts` are the reading's
+        threshold alerts; the result is those alerts minus recent duplicates,
+        followed by any windowed alerts that fired.
+        """
+        now = data.get('timestamp') or time.time()
+        with self.lock:
+            state = self._state(data['patient_id'])
+            for vital, buffer in state.values.items():
+                field = self.vitals[vital]
+                value = self._read(data, field['field'], field.get('item'))
+                if value is not None:
+                    buffer.append(value)
+
+            fired = []
+            for position, rule, field, item, compare in self._compiled:
+                value = self._read(data, field, item)
+                if value is None:
+                    continue
+                if rule['kind'] == 'sustained':
+                    alert = self._sustained(state, position, rule, compare, value)
+                else:
+                    alert = self._rate(state, position, rule, value)
+                if alert is not None:
+                    fired.append(alert)
+
+            return self._deduplicate(state, list(alerts) + fired, now)
+
+    def _sustained(self, state, position, rule, compare, value):
+        if state.active[position]:
+            # Hysteresis: stay active until the value is back past the clear level
+            if compare(value, rule['clear']):
+                return None
+            state.active[position] = False
+            state.counts[position] = 0
+            return None
+
+        state.counts[position] = state.counts[position] + 1 if compare(value, rule['limit']) else 0
+        if state.counts[position] < rule['count']:
+            return None
+        state.active[position] = True
+        return {
+            'type': rule['vital'],
+            'severity': rule['severity'],
+            'rule': rule['name'],
+            'message': rule['message'].format(value=value, count=state.counts[position])
+        }
+
+    def _rate(self, state, position, rule, value):
+        buffer = state.values[rule['vital']]
+        span = rule['span']
+        if len(buffer) <= span:
+            return None
+        change = value - buffer[-1 - span]
+        if state.active[position]:
+            if abs(change) < rule['clear']:
+                state.active[position] = False
+            return None
+        if abs(change) <= rule['max_change']:
+            return None
+        state.active[position] = True
+        return {
+            'type': rule['vital'],
+            'severity': rule['severity'],
+            'rule': rule['name'],
+            'message': rule['message'].format(value=value, change=change, span=span)
+        }
+
+    def _deduplicate(self, state, alerts, now):
+        kept = []
+        for alert in alerts:
+            # Windowed alerts are tracked per rule, threshold alerts per severity
+            key = (alert['type'], alert['severity'], alert.get('rule'))
+            last = state.last_sent.get(key)
+            if last is not None and now - last < self.dedup_seconds:
+                continue
+            state.last_sent[key] = now
+            kept.append(alert)
+        return kept
+
+    def reset(self, patient_id=None):
+        """Forget the stream state of one patient, or of everyone"""
+        with self.lock:
+            if patient_id is None:
+                self._patients.clear()
+            else:
+                self._patients.pop(patient_id, None)
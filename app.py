@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, Response
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_pymongo import PyMongo
 from bson.objectid import ObjectId
@@ -9,11 +9,13 @@ import datetime
 import time
 import json
 import os
+import itertools
 import secrets
 import atexit
 
 # Import system components
 from system import HealthMonitoringSystem
+from chain_verifier import ChainVerifier
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
@@ -60,6 +62,13 @@ try:
     
     # Keep sparse index for eth_address
     patients_collection.create_index("eth_address", sparse=True)
+
+    # Used by the block -> health record join and by block lookups
+    health_records_collection.create_index("block_hash")
+    blockchain_collection.create_index("index")
+    # Keyset pagination of a patient's blocks and history
+    blockchain_collection.create_index([("patient_id", 1), ("index", 1)])
+    health_records_collection.create_index([("patient_id", 1), ("timestamp", -1), ("_id", -1)])
     
     print("MongoDB indexes created successfully")
 except Exception as e:
@@ -85,7 +94,25 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # Initialize the health monitoring system
-system = HealthMonitoringSystem(mongo)
+# IOMT_DATASTORE_DIR moves the chain files elsewhere (e.g. a scratch directory for load tests)
+app.config["DATASTORE_DIR"] = os.environ.get(
+    'IOMT_DATASTORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datastore'))
+# Blocks are kept in an append-only on-disk log so restarts don't rebuild the chain
+app.config["BLOCK_LOG_DIR"] = os.path.join(app.config["DATASTORE_DIR"], 'blocklog')
+# Periodic snapshots of the chain indexes so startup only replays recent blocks
+app.config["SNAPSHOT_PATH"] = os.path.join(app.config["DATASTORE_DIR"], 'chain.snapshot')
+system = HealthMonitoringSystem(mongo, block_log_dir=app.config["BLOCK_LOG_DIR"],
+                                snapshot_path=app.config["SNAPSHOT_PATH"])
+# With IOMT_BUCKETED_RECORDS=1 health records are stored as per-patient hourly buckets
+if os.environ.get('IOMT_BUCKETED_RECORDS') == '1':
+    system.enable_bucketed_records()
+# Restore the chain indexes from the snapshot (replaying only later blocks) and the patient list
+system.load_state()
+# With IOMT_WRITE_BEHIND=1 MongoDB writes are queued and made by a background writer
+if os.environ.get('IOMT_WRITE_BEHIND') == '1':
+    system.enable_write_behind(os.path.join(app.config["DATASTORE_DIR"], 'write_behind.spill'))
+# Finish re-wrapping payloads if the app stopped during a key rotation
+system.resume_key_rotation()
 
 # Admin users (stored in memory for simplicity)
 admin_users = {
@@ -344,7 +371,14 @@ def blockchain_view():
     # Get blockchain data
     blockchain_data = system.get_blockchain_data()
     patients = system.get_all_patients()
-    is_valid = system.blockchain.is_chain_valid()
+    # Only newly appended blocks are verified unless a full audit is requested
+    if request.args.get('audit') == '1':
+        report = ChainVerifier().verify(system.blockchain)
+        is_valid = report['valid']
+        flash(f"Audit checked {report['blocks_checked']} blocks in {report['seconds']:.2f}s "
+              f"({report['blocks_per_second']:.0f} blocks/s on {report['workers']} workers)", 'info')
+    else:
+        is_valid = system.blockchain.is_chain_valid()
     
     return render_template(
         'blockchain_view.html', 
@@ -443,7 +477,7 @@ def register_patient():
             health_record['block_hash'] = new_block.hash
             health_record['created_at'] = datetime.datetime.now()
             
-            record_result = health_records_collection.insert_one(health_record)
+            record_result = system.record_store.insert_one(health_record)
             print(f"Health record inserted with ID: {record_result.inserted_id}")
             
             # Update patient record with reference to health record
@@ -666,13 +700,69 @@ def verify_signature():
 
 
 
+def ndjson_response(items, limit=None, lines_per_chunk=200, group_key=None):
+    """
+    Stream items as newline-delimited JSON. The body is generated lazily and
+    sent with chunked transfer encoding, a few hundred lines per chunk.
+    With group_key, limit counts runs of consecutive items sharing that key
+    (e.g. the readings of one block) rather than lines, so a page never ends
+    inside a run. An error while streaming ends the body with an
+    {"error": ...} line instead of a silently short response.
+    """
+    if limit is not None:
+        if group_key is None:
+            items = itertools.islice(items, limit)
+        else:
+            groups = itertools.islice(itertools.groupby(items, key=group_key), limit)
+            items = (item for _, group in groups for item in group)
+
+    def generate():
+        lines = []
+        try:
+            for item in items:
+                lines.append(json.dumps(item, default=str))
+                if len(lines) >= lines_per_chunk:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+            lines.append(json.dumps({'error': str(e)}))
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
 @app.route('/api/health_data', methods=['GET'])
 @login_required
 @role_required('admin')
 def api_health_data():
-    # API endpoint to get health data
-    blockchain_data = system.get_blockchain_data()
-    return jsonify(blockchain_data)
+    # Streams every block after ?after=<block index> as NDJSON, one line per
+    # reading; ?limit counts whole blocks, so a client resumes from the index
+    # of the last line it received
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    start_time = request.args.get('start_time', None, type=float)
+    end_time = request.args.get('end_time', None, type=float)
+    return ndjson_response(system.iter_blockchain_data(start_time, end_time, after_index=after), limit,
+                           group_key=lambda entry: entry['index'])
+
+@app.route('/api/patient/<patient_id>/history', methods=['GET'])
+@login_required
+def api_patient_history(patient_id):
+    # Streams the patient's records newest first as NDJSON; a client resumes
+    # with ?before=<timestamp>&before_id=<_id> of the last line it received
+    if current_user.role == 'patient' and getattr(current_user, 'patient_id', None) != patient_id:
+        return jsonify({'success': False, 'error': 'You can only view your own medical history.'}), 403
+
+    before = None
+    before_timestamp = request.args.get('before', None, type=float)
+    before_id = request.args.get('before_id')
+    if before_timestamp is not None:
+        if before_id is not None and not ObjectId.is_valid(before_id):
+            return jsonify({'success': False, 'error': 'Invalid before_id'}), 400
+        before = (before_timestamp, before_id)
+    limit = request.args.get('limit', None, type=int)
+    return ndjson_response(system.iter_medical_history(patient_id, before=before), limit)
 
 @app.route('/api/generate_data', methods=['POST'])
 @login_required
@@ -687,11 +777,55 @@ def api_generate_data():
         'alerts': alerts
     })
 
+@app.route('/api/upload_data', methods=['POST'])
+@login_required
+@role_required('admin')
+def api_upload_data():
+    # Gateway upload: a JSON list of readings, ingested with bulk MongoDB writes
+    readings = request.get_json(silent=True)
+    if not isinstance(readings, list) or not all(
+            isinstance(reading, dict) and 'patient_id' in reading for reading in readings):
+        return jsonify({'success': False, 'error': 'Expected a JSON list of readings'}), 400
+
+    results = system.process_health_data_batch(readings)
+    return jsonify({
+        'success': True,
+        'results': [{'block_index': new_block.index, 'alerts': alerts}
+                    for new_block, alerts, _ in results]
+    })
+
+@app.route('/api/rotate_key', methods=['POST'])
+@login_required
+@role_required('admin')
+def api_rotate_key():
+    # New readings use the new key at once; older ones are re-wrapped in the background
+    options = request.get_json(silent=True) or {}
+    job = system.rotate_encryption_key(blocks_per_second=options.get('blocks_per_second'))
+    return jsonify({'success': True, 'progress': job.progress()})
+
+@app.route('/api/key_rotation')
+@login_required
+@role_required('admin')
+def api_key_rotation():
+    job = system.key_rotation
+    return jsonify({'running': job is not None and not job.finished and job.error is None,
+                    'progress': job.progress() if job else None})
+
 # Register function to save data when application shuts down
 @atexit.register
 def save_data_on_shutdown():
     print("Saving all data before shutdown...")
-    system.save_state()
+    system.stop_key_rotation()
+    # A block whose put() hit QueueFull is on the chain but was never queued, so
+    # once the queue is drained save_state writes whatever the watermark says is missing
+    if system.write_behind is None or system.write_behind.close():
+        system.save_state()
+    else:
+        # Unwritten entries stay spilled and are replayed on the next start
+        system.save_watermark()
+        system.save_snapshot()
+        system.save_baselines()
+    system.blockchain.flush()
     print("Data saved successfully")
 
 if __name__ == '__main__':
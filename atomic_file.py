@@ -0,0 +1,16 @@
+import os
+
+
+def write_atomic(path, data):
+    """
+    Replace the file at `path` with `data` (bytes or str). The data is
+    written to a temporary file and fsynced before it is renamed over
+    `path`, so a crash leaves either the old file or the new one.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data.encode() if isinstance(data, str) else data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,287 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from atomic_file import write_atomic
+from rule_engine import DEFAULT_VITALS
+
+_MAGIC = b'IOMTBASE'
+_FORMAT_VERSION = 1
+# format version, EWMA alpha, number of tracked quantiles
+_HEADER = struct.Struct('>Bdb')
+_COUNT = struct.Struct('>I')
+# readings seen, Welford mean, Welford M2, EWMA, EWM variance
+_STATS = struct.Struct('>Qdddd')
+# five P² marker heights followed by their five positions
+_MARKERS = struct.Struct('>5d5Q')
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class P2Quantile:
+    """
+    Streaming estimate of one quantile with the P² algorithm (Jain &
+    Chlamtac): five markers are adjusted per observation, so memory and
+    update cost are constant no matter how many values have been seen.
+    """
+    __slots__ = ('p', 'heights', 'positions', 'count')
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.count = 0
+
+    def _desired(self, marker):
+        # Desired marker positions follow directly from the number of observations
+        p = self.p
+        increments = (0.0, p / 2, p, (1 + p) / 2, 1.0)
+        starts = (1.0, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5.0)
+        return starts[marker] + (self.count - 5) * increments[marker]
+
+    def add(self, x):
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(x)
+            heights.sort()
+            return
+
+        positions = self.positions
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            positions[i] += 1
+
+        for i in (1, 2, 3):
+            d = self._desired(i) - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (d <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if d > 0 else -1
+                height = self._parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * (heights[i + step] - heights[i]) / \
+                        (positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def _parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if not self.heights:
+            return None
+        if self.count <= 5:
+            # Too few values for the markers; use the exact sample quantile
+            return self.heights[min(len(self.heights) - 1, int(self.p * len(self.heights)))]
+        return self.heights[2]
+
+
+class VitalBaseline:
+    """Running statistics of one vital of one patient"""
+    __slots__ = ('count', 'mean', 'm2', 'ewma', 'ewm_var', 'quantiles')
+
+    def __init__(self, quantiles=DEFAULT_QUANTILES):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ewma = 0.0
+        self.ewm_var = 0.0
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x, alpha):
+        # Welford's update keeps mean and variance numerically stable
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+        if self.count == 1:
+            self.ewma = float(x)
+        else:
+            diff = x - self.ewma
+            self.ewma += alpha * diff
+            self.ewm_var = (1 - alpha) * (self.ewm_var + alpha * diff * diff)
+
+        for quantile in self.quantiles:
+            quantile.add(x)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def z_score(self, x):
+        std = self.std
+        return (x - self.mean) / std if std > 0 else 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'std': self.std,
+            'ewma': self.ewma,
+            'ewm_std': math.sqrt(self.ewm_var),
+            'quantiles': {q.p: q.value() for q in self.quantiles}
+        }
+
+
+class BaselineTracker:
+    """
+    Per-patient, per-vital baselines used to score readings against the
+    patient's own history.
+
+    Every reading is first scored against the baseline so far and then added
+    to it, in O(1) per vital. Once a vital has `min_samples` readings, alerts
+    for it carry a z-score, and readings more than `z_threshold` standard
+    deviations from the patient's mean raise an anomaly alert even when they
+    are inside the population thresholds. Baselines are persisted as a
+    compact checksummed binary file.
+    """
+
+    def __init__(self, vitals=None, path=None, alpha=0.1, quantiles=DEFAULT_QUANTILES,
+                 z_threshold=3.0, min_samples=20):
+        self.vitals = vitals or DEFAULT_VITALS
+        self.path = path
+        self.alpha = alpha
+        self.quantiles = tuple(quantiles)
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.patients = {}  # patient_id -> {vital: VitalBaseline}
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def baseline(self, patient_id, vital):
+        baseline = self.patients.get(patient_id, {}).get(vital)
+        return baseline.summary() if baseline is not None else None
+
+    def score(self, data, alerts=()):
+        """
+        Update the patient's baselines with a reading. Returns the alerts with
+        z-scores added (as copies) followed by any baseline anomaly alerts.
+        """
+        with self.lock:
+            baselines = self.patients.setdefault(data['patient_id'], {})
+            z_scores = {}
+            anomalies = []
+            for vital, spec in self.vitals.items():
+                value = data.get(spec['field'])
+                if value is None:
+                    continue
+                if spec.get('item') is not None:
+                    value = value[spec['item']]
+
+                baseline = baselines.get(vital)
+                if baseline is None:
+                    baseline = baselines[vital] = VitalBaseline(self.quantiles)
+                if baseline.count >= self.min_samples:
+                    z = round(baseline.z_score(value), 2)
+                    z_scores[vital] = z
+                    if abs(z) > self.z_threshold:
+                        anomalies.append({
+                            'type': vital,
+                            'severity': 'high' if z > 0 else 'low',
+                            'rule': 'baseline',
+                            'z_score': z,
+                            'message': f"Unusual {vital.replace('_', ' ')} for this patient: "
+                                       f"{value} (z={z:+.1f}, baseline {baseline.mean:.1f} "
+                                       f"± {baseline.std:.1f})"
+                        })
+                baseline.add(value, self.alpha)
+
+        scored = []
+        for alert in alerts:
+            if alert['type'] in z_scores:
+                alert = dict(alert, z_score=z_scores[alert['type']])
+            scored.append(alert)
+        return scored + anomalies
+
+    def save(self, path=None):
+        """Atomically write every baseline to `path`"""
+        path = path or self.path
+        with self.lock:
+            parts = [_MAGIC, _HEADER.pack(_FORMAT_VERSION, self.alpha, len(self.quantiles))]
+            parts.extend(struct.pack('>d', p) for p in self.quantiles)
+            parts.append(_COUNT.pack(len(self.patients)))
+            for patient_id, baselines in self.patients.items():
+                parts.append(_pack_name(patient_id))
+                parts.append(_COUNT.pack(len(baselines)))
+                for vital, baseline in baselines.items():
+                    parts.append(_pack_name(vital))
+                    parts.append(_STATS.pack(baseline.count, baseline.mean, baseline.m2,
+                                             baseline.ewma, baseline.ewm_var))
+                    for quantile in baseline.quantiles:
+                        heights = quantile.heights + [0.0] * (5 - len(quantile.heights))
+                        parts.append(_MARKERS.pack(*heights, *quantile.positions))
+
+        body = b''.join(parts)
+        write_atomic(path, body + hashlib.sha256(body).digest())
+
+    def load(self, path):
+        """Load baselines written by save; a corrupted file is ignored"""
+        with open(path, 'rb') as f:
+            raw = f.read()
+        body, checksum = raw[:-32], raw[-32:]
+        if not body.startswith(_MAGIC) or hashlib.sha256(body).digest() != checksum:
+            print(f"Ignoring corrupted baselines file: {path}")
+            return
+
+        offset = len(_MAGIC)
+        version, alpha, quantile_count = _HEADER.unpack_from(body, offset)
+        if version != _FORMAT_VERSION:
+            print(f"Ignoring baselines file with unknown format version {version}: {path}")
+            return
+        offset += _HEADER.size
+        quantiles = struct.unpack_from(f'>{quantile_count}d', body, offset)
+        offset += 8 * quantile_count
+
+        patients = {}
+        (patient_count,) = _COUNT.unpack_from(body, offset)
+        offset += _COUNT.size
+        for _ in range(patient_count):
+            patient_id, offset = _unpack_name(body, offset)
+            baselines = patients[patient_id] = {}
+            (vital_count,) = _COUNT.unpack_from(body, offset)
+            offset += _COUNT.size
+            for _ in range(vital_count):
+                vital, offset = _unpack_name(body, offset)
+                baseline = baselines[vital] = VitalBaseline(quantiles)
+                (baseline.count, baseline.mean, baseline.m2, baseline.ewma,
+                 baseline.ewm_var) = _STATS.unpack_from(body, offset)
+                offset += _STATS.size
+                for quantile in baseline.quantiles:
+                    markers = _MARKERS.unpack_from(body, offset)
+                    offset += _MARKERS.size
+                    quantile.count = baseline.count
+                    quantile.heights = list(markers[:min(5, baseline.count)])
+                    quantile.positions = list(markers[5:])
+
+        with self.lock:
+            self.alpha = alpha
+            self.quantiles = quantiles
+            self.patients = patients
+
+
+def _pack_name(name):
+    encoded = name.encode()
+    return _COUNT.pack(len(encoded)) + encoded
+
+
+def _unpack_name(buffer, offset):
+    (length,) = _COUNT.unpack_from(buffer, offset)
+    offset += _COUNT.size
+    return buffer[offset:offset + length].decode(), offset + length
@@ -0,0 +1,282 @@
+import os
+import mmap
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from blockchain import Block, RECORD_HEADER_SIZE
+
+
+class _LogView:
+    """Lazy slice of a BlockLog; blocks are decoded only while iterating"""
+
+    def __init__(self, log, indices):
+        self.log = log
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.log[i]
+
+
+class BlockLog:
+    """
+    Append-only log of serialized blocks, split into fixed-size segments.
+
+    Each segment is a pair of files: `segment-<first index>.log` holding the
+    block records back to back, and `.idx` holding the byte offset of every
+    record as unsigned 64-bit integers. Appends are buffered and made durable
+    in groups by commit() (data fsync, then index fsync), at the latest
+    commit_interval seconds after the oldest one. Reads go through a
+    small cache of memory-mapped segments, so only the segments being paged
+    through are resident. A read-only log (e.g. opened by a verification
+    worker) never touches the files it reads.
+    """
+
+    def __init__(self, directory, segment_blocks=100000, group_size=64,
+                 commit_interval=1.0, max_open_segments=4, read_only=False):
+        self.directory = directory
+        self.read_only = read_only
+        self.segment_blocks = segment_blocks
+        self.group_size = group_size
+        self.commit_interval = commit_interval
+        self.max_open_segments = max_open_segments
+        self.lock = threading.RLock()
+
+        self._maps = OrderedDict()  # segment start -> (file, mmap)
+        self._offsets = {}  # segment start -> array('Q'), kept while mapped
+        self._pending = []  # serialized records not yet committed
+        self._pending_since = None
+        self._last_block = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[len('segment-'):-len('.log')])
+            for name in os.listdir(directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+        if not self.segments:
+            self.segments = [0]
+            open(self._path(0, '.log'), 'ab').close()
+            open(self._path(0, '.idx'), 'ab').close()
+
+        # Only the tail segment is opened at startup
+        self._tail_offsets = self._load_offsets(self.segments[-1])
+        if read_only:
+            return
+        self._recover_tail()
+        self._tail_file = open(self._path(self.segments[-1], '.log'), 'ab')
+        self._tail_index = open(self._path(self.segments[-1], '.idx'), 'ab')
+
+        # Commits a partial group once it is commit_interval old, even if no append follows
+        self._closed = threading.Event()
+        if commit_interval:
+            self._flusher = threading.Thread(target=self._flush_loop, name='block-log-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.commit_interval / 2):
+            with self.lock:
+                if self._closed.is_set() or self._pending_since is None or \
+                        time.time() - self._pending_since < self.commit_interval:
+                    continue
+                try:
+                    self.commit()
+                except OSError as e:
+                    print(f"Error committing block log: {e}")
+
+    def _path(self, start, suffix):
+        return os.path.join(self.directory, f"segment-{start:012d}{suffix}")
+
+    def _load_offsets(self, start):
+        offsets = self._offsets.get(start)
+        if offsets is None:
+            offsets = array('Q')
+            with open(self._path(start, '.idx'), 'rb') as f:
+                raw = f.read()
+            # Ignore a torn trailing entry from an interrupted index write
+            offsets.frombytes(raw[:len(raw) - len(raw) % offsets.itemsize])
+            self._offsets[start] = offsets
+        return offsets
+
+    def _recover_tail(self):
+        """Drop bytes written after the last indexed record (crash mid-commit)"""
+        start = self.segments[-1]
+        log_path = self._path(start, '.log')
+        end = 0
+        if self._tail_offsets:
+            with open(log_path, 'rb') as f:
+                f.seek(self._tail_offsets[-1])
+                header = f.read(RECORD_HEADER_SIZE)
+            end = self._tail_offsets[-1] + Block.record_size(header)
+        if os.path.getsize(log_path) > end:
+            with open(log_path, 'r+b') as f:
+                f.truncate(end)
+        index_path = self._path(start, '.idx')
+        if os.path.getsize(index_path) != len(self._tail_offsets) * self._tail_offsets.itemsize:
+            with open(index_path, 'wb') as f:
+                self._tail_offsets.tofile(f)
+
+    def __len__(self):
+        # A commit moves records from _pending to the tail in steps, so count under the lock
+        with self.lock:
+            return self.segments[-1] + len(self._tail_offsets) + len(self._pending)
+
+    def _mapping(self, start):
+        entry = self._maps.get(start)
+        if entry is not None:
+            self._maps.move_to_end(start)
+            return entry[1]
+
+        f = open(self._path(start, '.log'), 'rb')
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[start] = (f, mapped)
+        while len(self._maps) > self.max_open_segments:
+            _, (old_file, old_map) = self._maps.popitem(last=False)
+            old_map.close()
+            old_file.close()
+        return mapped
+
+    def _unmap(self, start):
+        self._offsets.pop(start, None)
+        entry = self._maps.pop(start, None)
+        if entry is not None:
+            entry[1].close()
+            entry[0].close()
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return _LogView(self, range(*item.indices(len(self))))
+
+        with self.lock:
+            length = len(self)
+            if item < 0:
+                item += length
+            if not 0 <= item < length:
+                raise IndexError("block index out of range")
+            if item == length - 1 and self._last_block is not None:
+                return self._last_block
+
+            committed = self.segments[-1] + len(self._tail_offsets)
+            if item >= committed:
+                return Block.from_buffer(self._pending[item - committed])[0]
+
+            start, offset = self._locate(item)
+            return Block.from_buffer(self._mapping(start), offset)[0]
+
+    def _locate(self, item):
+        """(segment start, byte offset) of a committed block"""
+        # Segments are named after their first block index
+        position = len(self.segments) - 1
+        while self.segments[position] > item:
+            position -= 1
+        start = self.segments[position]
+        offsets = self._tail_offsets if position == len(self.segments) - 1 \
+            else self._load_offsets(start)
+        return start, offsets[item - start]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, block):
+        if self.read_only:
+            raise ValueError("Cannot append to a read-only block log")
+        with self.lock:
+            if block.index != len(self):
+                raise ValueError(f"Expected block {len(self)}, got {block.index}")
+            self._pending.append(block.to_bytes())
+            self._last_block = block
+            if self._pending_since is None:
+                self._pending_since = time.time()
+
+            if len(self._pending) >= self.group_size or \
+                    time.time() - self._pending_since >= self.commit_interval:
+                self.commit()
+
+    def rewrite(self, blocks):
+        """
+        Overwrite blocks in place with new versions of the same serialized
+        length (e.g. payloads whose data keys were re-wrapped). Each touched
+        segment is fsynced once. Mapped readers see the new bytes directly.
+        """
+        if self.read_only:
+            raise ValueError("Cannot rewrite a read-only block log")
+        with self.lock:
+            committed = self.segments[-1] + len(self._tail_offsets)
+            writes = {}  # segment start -> [(offset, record)]
+            for block in blocks:
+                record = block.to_bytes()
+                if block.index >= committed:
+                    position = block.index - committed
+                    if len(self._pending[position]) != len(record):
+                        raise ValueError(f"Rewrite of block {block.index} changes its length")
+                    self._pending[position] = record
+                else:
+                    start, offset = self._locate(block.index)
+                    if Block.record_size(self._mapping(start), offset) != len(record):
+                        raise ValueError(f"Rewrite of block {block.index} changes its length")
+                    writes.setdefault(start, []).append((offset, record))
+                if block.index == len(self) - 1 and self._last_block is not None:
+                    self._last_block = block
+
+            for start, records in writes.items():
+                with open(self._path(start, '.log'), 'r+b') as f:
+                    for offset, record in records:
+                        f.seek(offset)
+                        f.write(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def commit(self):
+        """Write and fsync all pending records (group commit)"""
+        with self.lock:
+            while self._pending:
+                room = self.segment_blocks - len(self._tail_offsets)
+                if room <= 0:
+                    self._roll_segment()
+                    continue
+
+                group, self._pending = self._pending[:room], self._pending[room:]
+                offset = self._tail_file.tell()
+                new_offsets = array('Q')
+                for record in group:
+                    new_offsets.append(offset)
+                    offset += len(record)
+
+                self._tail_file.write(b''.join(group))
+                self._tail_file.flush()
+                os.fsync(self._tail_file.fileno())
+                # The index is only written once the data it points to is durable
+                new_offsets.tofile(self._tail_index)
+                self._tail_index.flush()
+                os.fsync(self._tail_index.fileno())
+
+                self._tail_offsets.extend(new_offsets)
+                # The tail grew, so any existing mapping of it is stale
+                self._unmap(self.segments[-1])
+            self._pending_since = None
+
+    def _roll_segment(self):
+        self._tail_file.close()
+        self._tail_index.close()
+        start = self.segments[-1] + len(self._tail_offsets)
+        self.segments.append(start)
+        self._tail_offsets = array('Q')
+        self._tail_file = open(self._path(start, '.log'), 'ab')
+        self._tail_index = open(self._path(start, '.idx'), 'ab')
+
+    def close(self):
+        with self.lock:
+            for start in list(self._maps):
+                self._unmap(start)
+            if self.read_only:
+                return
+            self._closed.set()
+            self.commit()
+            self._tail_file.close()
+            self._tail_index.close()
@@ -1,47 +1,425 @@
+import base64
 import hashlib
 import time
 import json
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+from merkle import merkle_levels, merkle_root, merkle_path, root_from_path
+from envelope import hashed_body, is_envelope
+
+# Hash format versions. Version 1 blocks were hashed over a sorted JSON dump of
+# their fields; version 2 hashes a fixed binary encoding of the same fields.
+# Version 3 blocks carry a batch of payloads and hash their Merkle root instead.
+HASH_VERSION_JSON = 1
+HASH_VERSION_BINARY = 2
+HASH_VERSION_MERKLE = 3
+CURRENT_HASH_VERSION = HASH_VERSION_BINARY
+
+ZERO_DIGEST = bytes(32)
+
+# version, index, timestamp, previous digest, payload length (leaf count for batches)
+_HEADER = struct.Struct('>BQd32sI')
+_NONCE = struct.Struct('>Q')
+_LENGTH = struct.Struct('>I')
+_DIFFICULTY = struct.Struct('>B')
+# Serialized form: version, index, timestamp, nonce, previous digest, digest, payload length
+_RECORD = struct.Struct('>BQdQ32s32sI')
+RECORD_HEADER_SIZE = _RECORD.size
+# Set on a record's version byte when a difficulty byte follows the record header
+_RECORD_MINED = 0x80
+
+
+def to_digest(value):
+    """Convert a hex hash string (or raw digest) to a raw 32-byte digest"""
+    if isinstance(value, bytes):
+        return value
+    if not value or value == "0":
+        return ZERO_DIGEST
+    return bytes.fromhex(value)
+
+
+def hash_prefix(version, index, timestamp, previous_digest, length, body, difficulty=0):
+    """
+    Bytes hashed ahead of the nonce: fixed header, then the payload (or Merkle
+    root). A mined block also commits to its difficulty, after the fixed header;
+    unmined blocks hash exactly as before.
+    """
+    header = _HEADER.pack(version, index, timestamp, previous_digest, length)
+    if difficulty:
+        header += _DIFFICULTY.pack(difficulty)
+    return header + body
+
+
+def header_digest(version, index, timestamp, previous_digest, length, body, nonce, difficulty=0):
+    """Binary block hash: the hash prefix followed by the nonce"""
+    prefix = hash_prefix(version, index, timestamp, previous_digest, length, body, difficulty)
+    return hashlib.sha256(prefix + _NONCE.pack(nonce)).digest()
+
+
+def _json_payload(data):
+    """
+    Text a version 1 (JSON) block hashes its payload as. Legacy payloads are
+    Fernet tokens and hash as-is; binary envelope payloads (e.g. legacy
+    readings re-encrypted on reload) hash the base64 of their body, so the
+    key-wrap header stays outside the hash as in later versions.
+    """
+    if is_envelope(data):
+        return base64.urlsafe_b64encode(hashed_body(data)).decode()
+    return data.decode()
+
+
+def meets_difficulty(digest, difficulty):
+    """Proof-of-work check: the hash starts with `difficulty` zero hex digits"""
+    return int.from_bytes(digest, 'big') >> (256 - 4 * difficulty) == 0 if difficulty else True
+
+
+def encode_batch(payloads):
+    """Pack several payloads into one block body as length-prefixed records"""
+    parts = [_LENGTH.pack(len(payloads))]
+    for payload in payloads:
+        parts.append(_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def decode_batch(data):
+    (count,) = _LENGTH.unpack_from(data, 0)
+    offset = _LENGTH.size
+    payloads = []
+    for _ in range(count):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        payloads.append(data[offset:offset + length])
+        offset += length
+    return payloads
+
+
+def batch_levels(payloads):
+    """Merkle tree levels over the hashed bodies of a batch's payloads"""
+    return merkle_levels([hashed_body(payload) for payload in payloads])
+
+
+def verify_inclusion(payload, proof):
+    """
+    Check that `payload` is part of the block described by `proof` (as returned
+    by Block.inclusion_proof) without needing the rest of the block.
+    """
+    root = root_from_path(hashed_body(payload), proof['path'])
+    if root.hex() != proof['merkle_root']:
+        return False
+    digest = header_digest(HASH_VERSION_MERKLE, proof['block_index'], proof['timestamp'],
+                           to_digest(proof['previous_hash']), proof['leaf_count'],
+                           root, proof['nonce'], proof.get('difficulty', 0))
+    return digest.hex() == proof['block_hash']
+
 
 class Block:
-    def __init__(self, index, timestamp, data, previous_hash):
+    __slots__ = ('index', 'timestamp', 'data', 'nonce', 'difficulty', 'version', 'previous_digest', 'digest')
+
+    def __init__(self, index, timestamp, data, previous_hash, nonce=0, version=CURRENT_HASH_VERSION,
+                 difficulty=0):
         self.index = index
         self.timestamp = timestamp
-        self.data = data  # Encrypted health data
-        self.previous_hash = previous_hash
-        self.hash = self.calculate_hash()
+        self.data = data if isinstance(data, bytes) else data.encode()  # Encrypted health data
+        self.nonce = nonce
+        # Proof-of-work difficulty the hash must meet (0 for unmined blocks)
+        self.difficulty = difficulty
+        self.version = version
+        self.previous_digest = to_digest(previous_hash)
+        self.digest = self.calculate_digest()
 
-    def calculate_hash(self):
-        block_string = json.dumps({
-            'index': self.index,
+    # Hex views of the raw digests, as stored in MongoDB and shown in templates
+    @property
+    def hash(self):
+        return self.digest.hex()
+
+    @hash.setter
+    def hash(self, value):
+        self.digest = to_digest(value)
+
+    @property
+    def previous_hash(self):
+        return self.previous_digest.hex()
+
+    @previous_hash.setter
+    def previous_hash(self, value):
+        self.previous_digest = to_digest(value)
+
+    @classmethod
+    def from_batch(cls, index, timestamp, payloads, previous_hash, nonce=0, difficulty=0):
+        """Create a block committing to many payloads under one Merkle root"""
+        return cls(index, timestamp, encode_batch(payloads), previous_hash,
+                   nonce=nonce, version=HASH_VERSION_MERKLE, difficulty=difficulty)
+
+    def payloads(self):
+        """Encrypted payloads held by the block (one unless it is a batch)"""
+        if self.version == HASH_VERSION_MERKLE:
+            return decode_batch(self.data)
+        return [self.data]
+
+    def with_payloads(self, payloads):
+        """Copy of the block holding `payloads` in place of its own, keeping the stored hash"""
+        block = Block.__new__(Block)
+        block.index = self.index
+        block.timestamp = self.timestamp
+        block.data = encode_batch(payloads) if self.version == HASH_VERSION_MERKLE else payloads[0]
+        block.nonce = self.nonce
+        block.difficulty = self.difficulty
+        block.version = self.version
+        block.previous_digest = self.previous_digest
+        block.digest = self.digest
+        return block
+
+    def inclusion_proof(self, position, levels=None):
+        """Proof that payload `position` of a batch block is committed by this block's hash"""
+        if levels is None:
+            levels = batch_levels(self.payloads())
+        return {
+            'block_index': self.index,
+            'block_hash': self.hash,
+            'previous_hash': self.previous_hash,
             'timestamp': self.timestamp,
-            'data': self.data,
-            'previous_hash': self.previous_hash
-        }, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+            'nonce': self.nonce,
+            'difficulty': self.difficulty,
+            'leaf_count': len(levels[0]),
+            'merkle_root': levels[-1][0].hex(),
+            'position': position,
+            'path': merkle_path(levels, position)
+        }
+
+    def hash_prefix(self):
+        """Everything a binary block hash covers except the nonce (used for mining)"""
+        if self.version == HASH_VERSION_MERKLE:
+            payloads = decode_batch(self.data)
+            return hash_prefix(self.version, self.index, self.timestamp, self.previous_digest,
+                               len(payloads), merkle_root([hashed_body(p) for p in payloads]),
+                               self.difficulty)
+        # Key-wrap headers of envelope payloads are not hashed, so keys can be rotated
+        body = hashed_body(self.data)
+        return hash_prefix(self.version, self.index, self.timestamp, self.previous_digest,
+                           len(body), body, self.difficulty)
+
+    def calculate_digest(self):
+        if self.version == HASH_VERSION_JSON:
+            block_string = json.dumps({
+                'index': self.index,
+                'timestamp': self.timestamp,
+                'data': _json_payload(self.data),
+                'previous_hash': self.previous_hash
+            }, sort_keys=True).encode()
+            return hashlib.sha256(block_string).digest()
+
+        return hashlib.sha256(self.hash_prefix() + _NONCE.pack(self.nonce)).digest()
+
+    def calculate_hash(self):
+        return self.calculate_digest().hex()
+
+    def is_valid(self):
+        """The stored hash matches the block's contents and meets its difficulty"""
+        return self.digest == self.calculate_digest() and meets_difficulty(self.digest, self.difficulty)
+
+    def to_bytes(self):
+        """Serialize the block (header followed by payload) for on-disk storage"""
+        if not self.difficulty:
+            return _RECORD.pack(self.version, self.index, self.timestamp, self.nonce,
+                                self.previous_digest, self.digest, len(self.data)) + self.data
+        # Mined blocks flag the version byte and store their difficulty after the header
+        return _RECORD.pack(self.version | _RECORD_MINED, self.index, self.timestamp, self.nonce,
+                            self.previous_digest, self.digest, len(self.data)) + \
+            _DIFFICULTY.pack(self.difficulty) + self.data
+
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        """Deserialize a block written by to_bytes; returns (block, end offset)"""
+        version, index, timestamp, nonce, previous_digest, digest, length = \
+            _RECORD.unpack_from(buffer, offset)
+        start = offset + _RECORD.size
+        difficulty = 0
+        if version & _RECORD_MINED:
+            version &= ~_RECORD_MINED
+            (difficulty,) = _DIFFICULTY.unpack_from(buffer, start)
+            start += _DIFFICULTY.size
+        block = cls.__new__(cls)
+        block.index = index
+        block.timestamp = timestamp
+        block.data = bytes(buffer[start:start + length])
+        block.nonce = nonce
+        block.difficulty = difficulty
+        block.version = version
+        block.previous_digest = previous_digest
+        block.digest = digest  # Stored hash, re-checked by is_chain_valid
+        return block, start + length
+
+    @staticmethod
+    def record_size(buffer, offset=0):
+        """Length of the serialized block starting at offset (only its header is read)"""
+        version, *_, length = _RECORD.unpack_from(buffer, offset)
+        if version & _RECORD_MINED:
+            length += _DIFFICULTY.size
+        return _RECORD.size + length
 
 class Blockchain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]
+    def __init__(self, log=None):
+        # The chain is either an in-memory list or an on-disk BlockLog, which
+        # supports the same len/index/slice/append operations.
+        self.log = log
+        if log is not None:
+            self.chain = log
+            if len(log) == 0:
+                log.append(self.create_genesis_block())
+                log.commit()
+        else:
+            self.chain = [self.create_genesis_block()]
         self.difficulty = 2  # Proof-of-Work difficulty
+        # Checkpoint of the last block already verified by is_chain_valid
+        self.verified_index = 0
+        self.verified_digest = self.chain[0].digest
+        self.clear_indexes()
 
     def create_genesis_block(self):
         return Block(0, time.time(), "GENESIS", "0")
 
-    def add_block(self, new_block):
-        new_block.previous_hash = self.get_latest_block().hash
-        new_block.hash = new_block.calculate_hash()
+    def add_block(self, new_block, patient_ids=()):
+        new_block.previous_digest = self.get_latest_block().digest
+        new_block.digest = new_block.calculate_digest()
         self.chain.append(new_block)
+        self.index_block(new_block.index, new_block.timestamp, patient_ids)
+
+    def clear_indexes(self):
+        # Block payloads are encrypted, so callers pass the patient ids they hold
+        self.patient_index = {}  # patient_id -> array of block indices
+        self.timestamp_keys = array('d')  # sorted block timestamps
+        self.timestamp_blocks = array('Q')  # block index for each entry in timestamp_keys
+
+    def index_block(self, block_index, timestamp, patient_ids=()):
+        """Add a block to the patient and timestamp indexes"""
+        for patient_id in set(patient_ids):
+            self.patient_index.setdefault(patient_id, array('Q')).append(block_index)
+
+        # Blocks almost always arrive in time order, making this an append
+        position = bisect_right(self.timestamp_keys, timestamp)
+        self.timestamp_keys.insert(position, timestamp)
+        self.timestamp_blocks.insert(position, block_index)
+
+    def blocks_for_patient(self, patient_id, after_index=-1):
+        """Lazily yield a patient's blocks with an index above after_index, in chain order"""
+        indices = self.patient_index.get(patient_id, ())
+        # Indices are appended in chain order, so the array is sorted
+        for position in range(bisect_right(indices, after_index), len(indices)):
+            yield self.chain[indices[position]]
+
+    def blocks_in_range(self, start_time=None, end_time=None, after_index=-1):
+        """
+        Lazily yield blocks whose timestamp lies in [start_time, end_time], in
+        time order, skipping blocks at or below after_index
+        """
+        low = 0 if start_time is None else bisect_left(self.timestamp_keys, start_time)
+        high = len(self.timestamp_keys) if end_time is None else bisect_right(self.timestamp_keys, end_time)
+        for position in range(low, high):
+            block_index = self.timestamp_blocks[position]
+            if block_index > after_index:
+                yield self.chain[block_index]
 
     def get_latest_block(self):
         return self.chain[-1]
 
-    def is_chain_valid(self):
-        for i in range(1, len(self.chain)):
+    def flush(self):
+        """Make every appended block durable when the chain is backed by a log"""
+        if self.log is not None:
+            self.log.commit()
+
+    def reset_checkpoint(self):
+        """Forget the verified tip so the next check re-verifies the whole chain"""
+        self.verified_index = 0
+        self.verified_digest = self.chain[0].digest
+
+    def _checkpoint_intact(self):
+        # The chain may have been replaced or truncated since the last check
+        if self.verified_index >= len(self.chain):
+            return False
+        return self.chain[self.verified_index].digest == self.verified_digest
+
+    def is_chain_valid(self, full=False):
+        """
+        Validate the chain.
+        By default only the blocks appended since the last successful check are
+        verified; pass full=True to re-verify every block (e.g. for audits).
+        """
+        if full or not self._checkpoint_intact():
+            self.reset_checkpoint()
+
+        # Stored blocks of a lazily hydrated chain (see LazyChain) are checked on their
+        # header links only; their payloads are re-encrypted when materialized
+        header_count = getattr(self.chain, 'header_count', 0)
+        if self.verified_index < header_count:
+            if self.chain.first_broken_link(self.verified_index + 1) is not None:
+                return False
+            self.verified_index = header_count
+            self.verified_digest = self.chain.digest(header_count)
+
+        previous = self.chain[self.verified_index]
+        for i in range(self.verified_index + 1, len(self.chain)):
             current = self.chain[i]
-            previous = self.chain[i-1]
-            
-            if current.hash != current.calculate_hash():
+
+            if not current.is_valid():
                 return False
-            if current.previous_hash != previous.hash:
+            if current.previous_digest != previous.digest:
                 return False
+
+            # Advance the checkpoint as blocks are verified
+            self.verified_index = i
+            self.verified_digest = current.digest
+            previous = current
         return True
+
+    def rewrite_blocks(self, blocks):
+        """
+        Replace stored blocks with copies whose payloads changed only outside
+        the hashed bytes (see Block.with_payloads). A copy that changes the
+        stored hash or the hashed bytes is rejected before anything is written.
+        The copy is compared with the block it replaces rather than with its
+        stored hash: blocks rebuilt from MongoDB hold re-encrypted payloads
+        under their original hash, so their contents never matched it.
+        """
+        blocks = list(blocks)
+        for block in blocks:
+            current = self.chain[block.index]
+            if block.digest != current.digest or block.hash_prefix() != current.hash_prefix():
+                raise ValueError(f"Rewrite of block {block.index} would change its hash")
+        if self.log is not None:
+            self.log.rewrite(blocks)
+        else:
+            for block in blocks:
+                self.chain[block.index] = block
+
+    def migrate(self, version=CURRENT_HASH_VERSION):
+        """
+        Re-hash every block older than `version` with the newer format.
+        Re-hashing changes each block's hash and therefore every later link, so
+        the whole chain after the first migrated block is relinked. Returns a
+        mapping of old hex hash -> new hex hash for updating external copies.
+        """
+        if self.log is not None:
+            raise ValueError("Only in-memory chains can be migrated; log-backed blocks are never legacy")
+        if not isinstance(self.chain, list):
+            raise ValueError("Only fully loaded chains can be migrated")
+
+        renamed = {}
+        for i in range(1, len(self.chain)):
+            block = self.chain[i]
+            previous = self.chain[i-1]
+            if block.version >= version and block.previous_digest == previous.digest:
+                continue
+
+            old_hash = block.hash
+            block.version = max(block.version, version)
+            block.previous_digest = previous.digest
+            # A re-hashed block no longer carries its proof of work
+            block.difficulty = 0
+            block.digest = block.calculate_digest()
+            renamed[old_hash] = block.hash
+
+        self.reset_checkpoint()
+        return renamed
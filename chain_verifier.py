@@ -0,0 +1,141 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from blockchain import Block
+from block_log import BlockLog
+from lazy_chain import LazyChain
+
+
+def _check_blocks(blocks, expected):
+    """
+    Recompute hashes and check links inside one range of `expected` blocks.
+    Returns (first broken index or None, first block's previous digest, last digest).
+    """
+    first_previous = None
+    previous = None
+    count = 0
+    for block in blocks:
+        count += 1
+        if previous is None:
+            first_previous = block.previous_digest
+        elif block.previous_digest != previous.digest:
+            return block.index, first_previous, None
+        if not block.is_valid():
+            return block.index, first_previous, None
+        previous = block
+    # A short range would otherwise report a tip that was never checked
+    if count != expected:
+        raise ValueError(f"Expected {expected} blocks in range, read {count}")
+    return None, first_previous, previous.digest
+
+
+def _verify_records(records):
+    return _check_blocks((Block.from_buffer(record)[0] for record in records), len(records))
+
+
+def _verify_log_range(directory, start, stop):
+    # Opened per range so the tail offsets are never stale; opening reads only the tail index
+    log = BlockLog(directory, read_only=True)
+    try:
+        if len(log) < stop:
+            raise ValueError(f"Block log has {len(log)} blocks, range ends at {stop}")
+        return _check_blocks(log[start:stop], stop - start)
+    finally:
+        log.close()
+
+
+class ChainVerifier:
+    """
+    Full-chain audit that recomputes block hashes in a process pool.
+
+    The chain is split into ranges that workers verify independently; the
+    previous-hash links between ranges are stitched together afterwards. Log
+    backed chains are read by the workers straight from the segment files, so
+    only range bounds are sent between processes. Stored blocks of a lazily
+    hydrated chain are checked on their header links only (see LazyChain).
+    """
+
+    def __init__(self, workers=None, chunk_size=50000):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def _task(self, blockchain, start, stop):
+        if blockchain.log is not None:
+            return _verify_log_range, (blockchain.log.directory, start, stop)
+        return _verify_records, ([block.to_bytes() for block in blockchain.chain[start:stop]],)
+
+    def verify(self, blockchain):
+        """
+        Verify every block after genesis. Returns a report with the first broken
+        block index (None when the chain is valid) and throughput figures. A
+        valid result also moves the chain's verified checkpoint to the tip.
+        """
+        started = time.perf_counter()
+        # Workers read the log from disk, so every appended block must be there
+        blockchain.flush()
+        length = len(blockchain.chain)
+        previous_digest = blockchain.chain[0].digest
+        first_invalid = None
+        first = 1
+        if isinstance(blockchain.chain, LazyChain):
+            first_invalid = blockchain.chain.first_broken_link()
+            first = blockchain.chain.header_count + 1
+            previous_digest = blockchain.chain.digest(first - 1)
+
+        starts = range(first, length, self.chunk_size) if first_invalid is None else range(0)
+        workers = max(min(self.workers, len(starts)), 1)
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        # Only a few ranges are in flight at once, bounding memory for in-memory chains
+        in_flight = deque()
+        pending = iter(starts)
+
+        try:
+            while True:
+                while executor is not None and len(in_flight) < workers * 2:
+                    start = next(pending, None)
+                    if start is None:
+                        break
+                    function, args = self._task(blockchain, start, min(start + self.chunk_size, length))
+                    in_flight.append((start, executor.submit(function, *args)))
+
+                if executor is None:
+                    start = next(pending, None)
+                    if start is None:
+                        break
+                    function, args = self._task(blockchain, start, min(start + self.chunk_size, length))
+                    result = function(*args)
+                elif in_flight:
+                    start, future = in_flight.popleft()
+                    result = future.result()
+                else:
+                    break
+
+                # Ranges are consumed in chain order, so the first break found is the earliest
+                broken, first_previous, last_digest = result
+                if first_previous != previous_digest:
+                    first_invalid = start
+                    break
+                if broken is not None:
+                    first_invalid = broken
+                    break
+                previous_digest = last_digest
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        seconds = time.perf_counter() - started
+        checked = (first_invalid if first_invalid is not None else length) - 1
+        if first_invalid is None and length > 1:
+            blockchain.verified_index = length - 1
+            blockchain.verified_digest = previous_digest
+
+        return {
+            'valid': first_invalid is None,
+            'first_invalid_index': first_invalid,
+            'blocks_checked': checked,
+            'workers': workers,
+            'seconds': seconds,
+            'blocks_per_second': checked / seconds if seconds > 0 else 0.0
+        }
@@ -1,17 +1,69 @@
-from cryptography.fernet import Fernet
-import json
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+import base64
+import itertools
 import os
+import threading
+
+from envelope import pack_envelope, unpack_envelope, ENVELOPE_GCM_MAGIC
+from vitals_codec import encode_payload, decode_payload
+
+# A data key encrypts at most this many payloads (keeping random 96-bit GCM
+# nonces far from colliding); a new one is also drawn when the primary key changes
+_DATA_KEY_USES = 2 ** 20
+_NONCE_SIZE = 12
+
+
+def _raw(token):
+    return base64.urlsafe_b64decode(token)
+
+
+def _token(raw):
+    return base64.urlsafe_b64encode(raw)
+
+
+def _wrapping_key(master_key):
+    """AES key-wrap key derived from a Fernet master key"""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b'iomt data key wrap').derive(_raw(master_key))
+
 
 class DataEncryptor:
-    def __init__(self):
+    def __init__(self, workers=None, cache_size=10000, data_key_cache_size=1024):
         self.key_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datastore', 'encryption_key.key')
+        # Keys added by rotate_key live here as key-<id>.key; the original key file is id 0
+        self.key_dir = os.path.join(os.path.dirname(self.key_file), 'keys')
         self.key = self._load_or_generate_key()
-        self.cipher_suite = Fernet(self.key)
+        self._keys_lock = threading.Lock()
+        self._load_keyring()
+
+        # Data key new payloads are encrypted with: (master key id, wrapped key, AESGCM)
+        self._data_key = None
+        self._data_key_uses = 0
+        self._data_key_lock = threading.Lock()
+        # Unwrapped data keys by (master key id, wrapped key), least recently used first
+        self.data_key_cache_size = data_key_cache_size
+        self._data_keys = OrderedDict()
+
+        # Thread pool for the batch APIs; the cryptography backend releases the GIL
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 2)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        # Bounded LRU of decrypted payloads keyed by block hash
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
     def _load_or_generate_key(self):
         # Ensure directory exists
         os.makedirs(os.path.dirname(self.key_file), exist_ok=True)
-        
+
         # Load existing key or generate new one
         if os.path.exists(self.key_file):
             with open(self.key_file, 'rb') as key_file:
@@ -22,13 +74,191 @@ class DataEncryptor:
                 key_file.write(key)
             return key
 
+    def _load_keyring(self):
+        master_keys = {0: self.key}
+        if os.path.isdir(self.key_dir):
+            for name in os.listdir(self.key_dir):
+                if name.startswith('key-') and name.endswith('.key'):
+                    with open(os.path.join(self.key_dir, name), 'rb') as key_file:
+                        master_keys[int(name[len('key-'):-len('.key')])] = key_file.read()
+        self._set_keys(master_keys)
+
+    def _set_keys(self, master_keys):
+        self._master_keys = master_keys
+        self.keys = {key_id: Fernet(key) for key_id, key in master_keys.items()}
+        self._wrapping_keys = {key_id: _wrapping_key(key) for key_id, key in master_keys.items()}
+        keys = self.keys
+        # Set last, so encrypting threads never see a primary id without its keys
+        self.primary_key_id = max(keys)
+        self.cipher_suite = keys[self.primary_key_id]
+        # Read as one tuple so a concurrent rotation never pairs an id with the wrong key
+        self._primary = (self.primary_key_id, self.cipher_suite)
+        # Payloads written before envelope encryption carry no key id, so try every key, newest first
+        self._legacy_suite = MultiFernet([keys[key_id] for key_id in sorted(keys, reverse=True)])
+
+    def rotate_key(self):
+        """Add a new master key and make it the one new payloads are wrapped with"""
+        with self._keys_lock:
+            key_id = self.primary_key_id + 1
+            os.makedirs(self.key_dir, exist_ok=True)
+            path = os.path.join(self.key_dir, f"key-{key_id}.key")
+            key = Fernet.generate_key()
+            with open(path + '.tmp', 'wb') as key_file:
+                key_file.write(key)
+                key_file.flush()
+                os.fsync(key_file.fileno())
+            os.replace(path + '.tmp', path)
+            self._set_keys({**self._master_keys, key_id: key})
+            return key_id
+
+    def _current_data_key(self):
+        """(master key id, wrapped data key, AESGCM) for the next payload"""
+        with self._data_key_lock:
+            key_id = self.primary_key_id
+            if self._data_key is None or self._data_key[0] != key_id or \
+                    self._data_key_uses >= _DATA_KEY_USES:
+                data_key = AESGCM.generate_key(bit_length=256)
+                wrapped_key = aes_key_wrap(self._wrapping_keys[key_id], data_key)
+                self._data_key = (key_id, wrapped_key, AESGCM(data_key))
+                self._data_key_uses = 0
+            self._data_key_uses += 1
+            return self._data_key
+
+    def _unwrapped_data_key(self, key_id, wrapped_key):
+        """AESGCM for a wrapped data key, unwrapped once and then cached"""
+        cache_key = (key_id, wrapped_key)
+        with self._cache_lock:
+            cipher = self._data_keys.get(cache_key)
+            if cipher is not None:
+                self._data_keys.move_to_end(cache_key)
+                return cipher
+        cipher = AESGCM(aes_key_unwrap(self._wrapping_keys[key_id], wrapped_key))
+        with self._cache_lock:
+            self._data_keys[cache_key] = cipher
+            if len(self._data_keys) > self.data_key_cache_size:
+                self._data_keys.popitem(last=False)
+        return cipher
+
     def encrypt_data(self, data):
-        """Encrypt data using Fernet symmetric encryption"""
-        json_data = json.dumps(data).encode()
-        encrypted = self.cipher_suite.encrypt(json_data)
-        return encrypted
-
-    def decrypt_data(self, encrypted_data):
-        """Decrypt data using Fernet symmetric encryption"""
-        decrypted = self.cipher_suite.decrypt(encrypted_data)
-        return json.loads(decrypted.decode())
+        """
+        Encrypt data using envelope encryption: the reading is encrypted with
+        AES-GCM under a data key shared by many payloads, and the data key is
+        AES key-wrapped with (a key derived from) the primary master key.
+        """
+        # Vitals readings use the compact binary schema, anything else JSON
+        key_id, wrapped_key, cipher = self._current_data_key()
+        nonce = os.urandom(_NONCE_SIZE)
+        body = nonce + cipher.encrypt(nonce, encode_payload(data), None)
+        return pack_envelope(key_id, wrapped_key, body, ENVELOPE_GCM_MAGIC)
+
+    def _open(self, encrypted_data):
+        envelope = unpack_envelope(encrypted_data)
+        if envelope is None:
+            return self._legacy_suite.decrypt(encrypted_data)
+        key_id, wrapped_key, body = envelope
+        if encrypted_data.startswith(ENVELOPE_GCM_MAGIC):
+            cipher = self._unwrapped_data_key(key_id, wrapped_key)
+            return cipher.decrypt(body[:_NONCE_SIZE], body[_NONCE_SIZE:], None)
+        # Envelopes written with a Fernet data key per payload
+        data_key = self.keys[key_id].decrypt(_token(wrapped_key))
+        return Fernet(base64.urlsafe_b64encode(data_key)).decrypt(_token(body))
+
+    def rewrap(self, encrypted_data):
+        """
+        Re-wrap the data key of a payload with the primary master key. The body
+        is left untouched and the result has the same length. Returns None if
+        the payload is already on the primary key or isn't envelope-encrypted.
+        """
+        envelope = unpack_envelope(encrypted_data)
+        if envelope is None:
+            return None
+        key_id, wrapped_key, body = envelope
+        primary_id, primary = self._primary
+        if key_id == primary_id:
+            return None
+        if encrypted_data.startswith(ENVELOPE_GCM_MAGIC):
+            data_key = aes_key_unwrap(self._wrapping_keys[key_id], wrapped_key)
+            return pack_envelope(primary_id, aes_key_wrap(self._wrapping_keys[primary_id], data_key),
+                                 body, ENVELOPE_GCM_MAGIC)
+        data_key = self.keys[key_id].decrypt(_token(wrapped_key))
+        return pack_envelope(primary_id, _raw(primary.encrypt(data_key)), body)
+
+    def decrypt_data(self, encrypted_data, cache_key=None):
+        """
+        Decrypt data using Fernet symmetric encryption.
+        With a cache_key (e.g. the block hash) the result is memoized.
+        """
+        if cache_key is not None:
+            with self._cache_lock:
+                cached = self._cache.get(cache_key)
+                if cached is not None:
+                    self._cache.move_to_end(cache_key)
+                    return dict(cached)
+
+        data = decode_payload(self._open(encrypted_data))
+
+        if cache_key is not None:
+            with self._cache_lock:
+                self._cache[cache_key] = data
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return dict(data)
+        return data
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _map(self, function, items, chunk_size=64):
+        """
+        Apply function to every item on the pool, yielding (item, result or
+        exception) in input order. Work is submitted in chunks, and only a
+        bounded window of chunks runs ahead of the consumer so results stream.
+        """
+        def run(chunk):
+            results = []
+            for item in chunk:
+                try:
+                    results.append((item, function(item)))
+                except Exception as e:
+                    results.append((item, e))
+            return results
+
+        pool = self._executor()
+        window = deque()
+        iterator = iter(items)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if chunk:
+                window.append(pool.submit(run, chunk))
+            if window and (not chunk or len(window) >= self.workers * 2):
+                yield from window.popleft().result()
+            elif not chunk:
+                return
+
+    def encrypt_many(self, items):
+        """Encrypt an iterable of payloads in parallel, yielding tokens in order"""
+        for _, result in self._map(self.encrypt_data, items):
+            if isinstance(result, Exception):
+                raise result
+            yield result
+
+    def decrypt_many(self, encrypted_items, cache_keys=None, ignore_errors=False):
+        """
+        Decrypt an iterable of tokens in parallel, yielding payloads in order.
+        cache_keys optionally gives a memoization key per token. With
+        ignore_errors, tokens that fail to decrypt yield None instead of raising.
+        """
+        if cache_keys is None:
+            pairs = ((item, None) for item in encrypted_items)
+        else:
+            pairs = zip(encrypted_items, cache_keys)
+
+        for _, result in self._map(lambda pair: self.decrypt_data(*pair), pairs):
+            if isinstance(result, Exception):
+                if not ignore_errors:
+                    raise result
+                result = None
+            yield result
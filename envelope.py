@@ -0,0 +1,40 @@
+import struct
+
+# Envelope-encrypted payloads: the reading is encrypted under a data key,
+# and that data key is wrapped by a key-id-tagged master key. Only the body is
+# covered by block hashes, so rotating the master key rewraps the data key
+# without touching the hashed bytes.
+# ENVELOPE_MAGIC envelopes hold a Fernet-wrapped data key and a Fernet body.
+# ENVELOPE_GCM_MAGIC envelopes hold an AES key-wrapped data key and an AES-GCM
+# body (nonce, then ciphertext and tag); their data key is shared by many payloads.
+ENVELOPE_MAGIC = b'\x00KW'
+ENVELOPE_GCM_MAGIC = b'\x00KG'
+_MAGICS = (ENVELOPE_MAGIC, ENVELOPE_GCM_MAGIC)
+
+# magic, master key id, wrapped data key length; wrapped key and body follow
+_HEADER = struct.Struct('>3sIH')
+
+
+def pack_envelope(key_id, wrapped_key, body, magic=ENVELOPE_MAGIC):
+    return _HEADER.pack(magic, key_id, len(wrapped_key)) + wrapped_key + body
+
+
+def is_envelope(payload):
+    return payload[:len(ENVELOPE_MAGIC)] in _MAGICS
+
+
+def unpack_envelope(payload):
+    """Returns (key id, wrapped data key, body), or None for a non-envelope payload"""
+    if not is_envelope(payload):
+        return None
+    _, key_id, wrapped_length = _HEADER.unpack_from(payload, 0)
+    start = _HEADER.size
+    return key_id, payload[start:start + wrapped_length], payload[start + wrapped_length:]
+
+
+def hashed_body(payload):
+    """The part of a payload covered by block hashes (the whole payload if not an envelope)"""
+    if not is_envelope(payload):
+        return payload
+    _, _, wrapped_length = _HEADER.unpack_from(payload, 0)
+    return payload[_HEADER.size + wrapped_length:]
@@ -1,7 +1,10 @@
 import random
+import threading
 import time
 import datetime
 
+import numpy as np
+
 class IoMTDeviceSimulator:
     @staticmethod
     def generate_health_data():
@@ -16,3 +19,132 @@ class IoMTDeviceSimulator:
             'timestamp': time.time(),
             'readable_time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
+
+
+class DeviceFleet:
+    """
+    Vectorized simulator of `devices` persistent IoMT devices, one per patient.
+
+    Each device has its own resting values and a mean-reverting (AR(1)) drift
+    around them, plus per-sample measurement noise and occasional episodes
+    (e.g. a fever or tachycardia) that last for a number of readings. Every
+    call advances all devices together using NumPy, so readings form coherent
+    per-patient time series. The same seed gives the same readings.
+    """
+
+    # vital -> (population mean, spread of resting values, drift std, noise std)
+    VITALS = {
+        'heart_rate': (75.0, 8.0, 2.0, 2.0),
+        'systolic': (120.0, 10.0, 2.0, 3.0),
+        'diastolic': (78.0, 6.0, 1.5, 2.0),
+        'body_temp': (36.8, 0.2, 0.05, 0.05),
+        'spo2': (97.0, 1.0, 0.3, 0.6),
+        'glucose': (100.0, 12.0, 3.0, 4.0)
+    }
+    # vital -> shift applied while a device is in an episode
+    EPISODE_SHIFT = {'heart_rate': 30.0, 'systolic': 25.0, 'diastolic': 10.0,
+                     'body_temp': 1.6, 'spo2': -6.0, 'glucose': 60.0}
+    LIMITS = {'heart_rate': (30, 220), 'systolic': (60, 250), 'diastolic': (30, 150),
+              'body_temp': (34.0, 42.0), 'spo2': (70, 100), 'glucose': (40, 500)}
+
+    def __init__(self, devices=1000, seed=None, interval=1.0, start_time=None,
+                 drift=0.95, episode_rate=0.001, episode_length=30):
+        self.devices = devices
+        self.interval = interval
+        self.drift = drift
+        self.episode_rate = episode_rate
+        self.episode_length = episode_length
+        self.rng = np.random.default_rng(seed)
+        self.patient_ids = [f"PAT{1000 + i}" for i in range(devices)]
+
+        self.resting = {vital: self.rng.normal(mean, spread, devices)
+                        for vital, (mean, spread, _, _) in self.VITALS.items()}
+        self.deviation = {vital: np.zeros(devices) for vital in self.VITALS}
+        self.episode_left = np.zeros(devices, dtype=np.int64)
+
+        # Devices report at the same rate but not in lockstep
+        self.clock = time.time() if start_time is None else start_time
+        self.phase = self.rng.uniform(0, interval, devices)
+        self._readable = {}
+        self._stream = None
+        self._stream_lock = threading.Lock()
+
+    def _tick(self):
+        """Advance every device by one reading; returns the columns for this tick"""
+        started = self.rng.random(self.devices) < self.episode_rate
+        self.episode_left[started & (self.episode_left == 0)] = self.episode_length
+        in_episode = self.episode_left > 0
+        self.episode_left[in_episode] -= 1
+
+        columns = {}
+        for vital, (_, _, drift_std, noise_std) in self.VITALS.items():
+            deviation = self.deviation[vital]
+            deviation *= self.drift
+            deviation += self.rng.normal(0, drift_std, self.devices)
+            values = self.resting[vital] + deviation + self.rng.normal(0, noise_std, self.devices)
+            values += in_episode * self.EPISODE_SHIFT[vital]
+            low, high = self.LIMITS[vital]
+            if vital == 'body_temp':
+                columns[vital] = np.clip(np.round(values * 10) / 10, low, high)
+            else:
+                columns[vital] = np.clip(np.rint(values), low, high).astype(np.int64)
+        columns['timestamp'] = self.clock + self.phase
+        self.clock += self.interval
+        return columns
+
+    def generate_batch(self, ticks=1):
+        """
+        Columnar readings for `ticks` readings of every device, tick-major.
+        Returns a dict of NumPy arrays: device (index into patient_ids),
+        heart_rate, systolic, diastolic, body_temp, spo2, glucose, timestamp.
+        """
+        parts = [self._tick() for _ in range(ticks)]
+        batch = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        batch['device'] = np.tile(np.arange(self.devices), ticks)
+        return batch
+
+    def _readable_time(self, timestamp):
+        second = int(timestamp)
+        readable = self._readable.get(second)
+        if readable is None:
+            if len(self._readable) > 4096:
+                self._readable.clear()
+            readable = self._readable[second] = \
+                datetime.datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        return readable
+
+    def to_readings(self, batch):
+        """Turn a generate_batch result into reading dicts like generate_health_data's"""
+        columns = [batch[name].tolist() for name in
+                   ('device', 'heart_rate', 'systolic', 'diastolic', 'body_temp', 'spo2',
+                    'glucose', 'timestamp')]
+        patient_ids = self.patient_ids
+        return [{
+            'patient_id': patient_ids[device],
+            'heart_rate': heart_rate,
+            'blood_pressure': (systolic, diastolic),
+            'body_temp': body_temp,
+            'spo2': spo2,
+            'glucose': glucose,
+            'timestamp': timestamp,
+            'readable_time': self._readable_time(timestamp)
+        } for device, heart_rate, systolic, diastolic, body_temp, spo2, glucose, timestamp
+            in zip(*columns)]
+
+    def stream(self, readings=None, ticks_per_batch=None):
+        """Yield reading dicts indefinitely (or `readings` of them), generated in batches"""
+        ticks_per_batch = ticks_per_batch or max(1, 10000 // self.devices)
+        produced = 0
+        while readings is None or produced < readings:
+            for reading in self.to_readings(self.generate_batch(ticks_per_batch)):
+                if readings is not None and produced >= readings:
+                    return
+                produced += 1
+                yield reading
+
+    def generate_health_data(self):
+        """Next reading of the fleet; lets a DeviceFleet stand in for IoMTDeviceSimulator"""
+        with self._stream_lock:
+            if self._stream is None:
+                self._stream = self.stream()
+            return next(self._stream)
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+
+from atomic_file import write_atomic
+from envelope import unpack_envelope
+
+
+def read_checkpoint(path):
+    """The {key_id, next_index, finished} progress of a re-wrap job, or None"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class KeyRotationJob:
+    """
+    Background re-wrap of every payload on the chain with the primary key.
+
+    Blocks are streamed in chunks of `chunk_size`: each chunk is read, its
+    envelope payloads re-wrapped outside any lock, and written back with
+    Blockchain.rewrite_blocks. Only data keys are re-wrapped, so block hashes
+    (and the chain links) are unchanged and readers keep working throughout.
+    Progress is checkpointed to `checkpoint_path` after every chunk, so a
+    restarted job resumes where it stopped. Payloads written before envelope
+    encryption can't be re-wrapped without changing their block's hash; they
+    are counted as skipped and stay readable through the old keys.
+    """
+
+    def __init__(self, blockchain, encryptor, checkpoint_path, chunk_size=500,
+                 blocks_per_second=None, lock=None):
+        self.blockchain = blockchain
+        self.encryptor = encryptor
+        self.checkpoint_path = checkpoint_path
+        self.chunk_size = chunk_size
+        self.blocks_per_second = blocks_per_second
+        # Held only while a chunk is written back, never while reading or re-wrapping
+        self.lock = lock or threading.Lock()
+
+        self.key_id = encryptor.primary_key_id
+        self.next_index = 0
+        self.blocks_scanned = 0
+        self.payloads_rewrapped = 0
+        self.payloads_skipped = 0
+        self.finished = False
+        self.error = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        checkpoint = read_checkpoint(checkpoint_path)
+        if checkpoint is not None and checkpoint['key_id'] == self.key_id:
+            self.next_index = checkpoint['next_index']
+
+    def _write_checkpoint(self):
+        write_atomic(self.checkpoint_path, json.dumps({
+            'key_id': self.key_id, 'next_index': self.next_index, 'finished': self.finished}))
+
+    def _rewrap_block(self, block):
+        """
+        Returns (copy of the block with re-wrapped payloads or None if nothing
+        changed, payloads re-wrapped, payloads skipped)
+        """
+        payloads = []
+        rewrapped_count = skipped = 0
+        for payload in block.payloads():
+            rewrapped = self.encryptor.rewrap(payload)
+            if rewrapped is None:
+                if unpack_envelope(payload) is None:
+                    skipped += 1
+                payloads.append(payload)
+            else:
+                rewrapped_count += 1
+                payloads.append(rewrapped)
+        new_block = block.with_payloads(payloads) if rewrapped_count else None
+        return new_block, rewrapped_count, skipped
+
+    def run_chunk(self):
+        """Re-wrap the next chunk; returns False once the whole chain is done"""
+        # The genesis block holds no payload
+        start = max(self.next_index, 1)
+        end = min(start + self.chunk_size, len(self.blockchain.chain))
+        if start >= end:
+            self.finished = True
+            self._write_checkpoint()
+            return False
+
+        rewritten = []
+        rewrapped = skipped = 0
+        for block in self.blockchain.chain[start:end]:
+            new_block, block_rewrapped, block_skipped = self._rewrap_block(block)
+            rewrapped += block_rewrapped
+            skipped += block_skipped
+            if new_block is not None:
+                rewritten.append(new_block)
+        if rewritten:
+            with self.lock:
+                self.blockchain.rewrite_blocks(rewritten)
+
+        # Counted only once the chunk is written back
+        self.payloads_rewrapped += rewrapped
+        self.payloads_skipped += skipped
+        self.blocks_scanned += end - start
+        self.next_index = end
+        self._write_checkpoint()
+        return True
+
+    def run(self):
+        """Re-wrap the chain up to its current tip, pacing to blocks_per_second"""
+        try:
+            while not self._stop.is_set():
+                started = time.perf_counter()
+                if not self.run_chunk():
+                    break
+                if self.blocks_per_second:
+                    pause = self.chunk_size / self.blocks_per_second - (time.perf_counter() - started)
+                    if pause > 0:
+                        self._stop.wait(pause)
+        except Exception as e:
+            self.error = e
+            print(f"Key rotation stopped at block {self.next_index}: {e}")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='key-rotation', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop after the current chunk; the checkpoint lets a new job resume"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def progress(self):
+        return {
+            'key_id': self.key_id,
+            'next_index': self.next_index,
+            'chain_length': len(self.blockchain.chain),
+            'blocks_scanned': self.blocks_scanned,
+            'payloads_rewrapped': self.payloads_rewrapped,
+            'payloads_skipped': self.payloads_skipped,
+            'finished': self.finished,
+            'error': str(self.error) if self.error else None
+        }
@@ -0,0 +1,181 @@
+import threading
+from array import array
+from collections import OrderedDict
+
+from blockchain import Block, HASH_VERSION_JSON, to_digest
+
+
+class _ChainView:
+    """Lazy slice of a LazyChain; blocks are materialized only while iterating"""
+
+    def __init__(self, chain, positions):
+        self.chain = chain
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.chain[position]
+
+
+class LazyChain:
+    """
+    Chain hydrated from block headers only.
+
+    Startup keeps just the header of every stored block (index, timestamp,
+    version, hash and previous hash) in compact arrays. A block's payload is
+    materialized the first time it is read, by `loader(headers)`. The loader
+    gets a list of header dicts and returns one Block per header, or None
+    when the payload can't be rebuilt. Reads fetch the next `prefetch`
+    blocks with the requested one, so a sequential pass makes one loader
+    call per page. Materialized blocks are kept in an LRU cache of
+    `cache_size` blocks. Blocks appended after hydration stay in memory, as
+    in an ordinary chain.
+
+    Materialized payloads are re-encrypted, so a stored block's contents no
+    longer hash to its stored hash. Stored blocks are validated on their
+    header links only (first_broken_link); blocks appended after hydration
+    are validated in full.
+
+    Supports the same len/index/slice/append operations as a list.
+    """
+
+    def __init__(self, genesis, loader, cache_size=10000, prefetch=256):
+        self.loader = loader
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.lock = threading.Lock()
+        self._genesis = genesis
+        self._indices = array('Q')
+        self._timestamps = array('d')
+        self._versions = array('B')
+        self._digests = bytearray()  # 32 bytes per header
+        self._previous_digests = bytearray()
+        self._cache = OrderedDict()  # position -> Block, least recently used first
+        self._appended = []
+
+        self.hits = 0
+        self.misses = 0
+
+    def add_header(self, block_data):
+        """Add a stored block by its MongoDB document (only header fields are kept)"""
+        if self._appended:
+            raise ValueError("Headers can only be added before blocks are appended")
+        self._indices.append(block_data['index'])
+        self._timestamps.append(block_data['timestamp'])
+        self._versions.append(block_data.get('hash_version', HASH_VERSION_JSON))
+        self._digests += to_digest(block_data['hash'])
+        self._previous_digests += to_digest(block_data['previous_hash'])
+
+    @property
+    def header_count(self):
+        return len(self._indices)
+
+    def header(self, position):
+        """MongoDB-style header document of the stored block at `position`"""
+        i = position - 1
+        return {
+            'index': self._indices[i],
+            'timestamp': self._timestamps[i],
+            'hash': self._digests[32 * i:32 * i + 32].hex(),
+            'previous_hash': self._previous_digests[32 * i:32 * i + 32].hex(),
+            'hash_version': self._versions[i]
+        }
+
+    def digest(self, position):
+        """Stored hash of the block at `position`, without materializing it"""
+        if position == 0:
+            return self._genesis.digest
+        if position > len(self._indices):
+            return self[position].digest
+        i = position - 1
+        return bytes(self._digests[32 * i:32 * i + 32])
+
+    def first_broken_link(self, start=1):
+        """
+        First stored position from `start` whose header doesn't link to the
+        header before it (by previous hash and index), or None. Reads headers only.
+        The genesis block is not stored in MongoDB but created afresh at startup,
+        so the first stored block's link to it can't be checked.
+        """
+        for position in range(max(start, 1), len(self._indices) + 1):
+            i = position - 1
+            if self._indices[i] != position:
+                return position
+            if position > 1 and self._previous_digests[32 * i:32 * i + 32] != self.digest(position - 1):
+                return position
+        return None
+
+    def _stub(self, header):
+        # Header-only block for a payload that can't be rebuilt; validation flags it
+        block = Block.__new__(Block)
+        block.index = header['index']
+        block.timestamp = header['timestamp']
+        block.data = b''
+        block.nonce = 0
+        block.difficulty = 0
+        block.version = header['hash_version']
+        block.previous_hash = header['previous_hash']
+        block.hash = header['hash']
+        return block
+
+    def __len__(self):
+        return 1 + len(self._indices) + len(self._appended)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return _ChainView(self, range(*item.indices(len(self))))
+
+        length = len(self)
+        if item < 0:
+            item += length
+        if not 0 <= item < length:
+            raise IndexError("block index out of range")
+        if item == 0:
+            return self._genesis
+        if item > len(self._indices):
+            return self._appended[item - len(self._indices) - 1]
+
+        with self.lock:
+            block = self._cache.get(item)
+            if block is not None:
+                self._cache.move_to_end(item)
+                self.hits += 1
+                return block
+            self.misses += 1
+            end = min(item + self.prefetch, len(self._indices) + 1)
+            positions = [position for position in range(item, end) if position not in self._cache]
+
+        headers = [self.header(position) for position in positions]
+        blocks = self.loader(headers)
+        with self.lock:
+            for position, header, block in zip(positions, headers, blocks):
+                self._cache[position] = block if block is not None else self._stub(header)
+            result = self._cache[item]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def __setitem__(self, item, block):
+        # Used by Blockchain.rewrite_blocks; a rewritten stored block lives in the cache
+        if item > len(self._indices):
+            self._appended[item - len(self._indices) - 1] = block
+            return
+        with self.lock:
+            self._cache[item] = block
+            self._cache.move_to_end(item)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, block):
+        self._appended.append(block)
+
+    def cache_info(self):
+        return {'cached': len(self._cache), 'cache_size': self.cache_size,
+                'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,225 @@
+"""
+Load-testing harness for the ingestion path.
+
+Replays simulated (DeviceFleet) or recorded (NDJSON, one reading per line)
+traffic at a given rate and concurrency against either
+HealthMonitoringSystem.process_health_data directly or the Flask app through
+its test client, with mongomock standing in for MongoDB. Reports throughput
+and p50/p95/p99 latency per ingestion stage (alert check, encrypt, hash,
+Mongo writes) and end to end. Passing several concurrency levels shows where
+throughput stops scaling:
+
+    python load_test.py --readings 20000 --concurrency 1,2,4,8
+    python load_test.py --mode flask --rate 500 --replay readings.ndjson
+"""
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+import mongomock
+import numpy as np
+
+from iomt_simulator import DeviceFleet
+
+STAGES = ('alert_check', 'encrypt', 'hash', 'mongo_write', 'total')
+
+
+class LatencyRecorder:
+    """Collects per-stage durations; used as HealthMonitoringSystem.stage_timer"""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def __call__(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        results = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+            results[stage] = {'count': len(samples), 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+        return results
+
+
+class ReadingSource:
+    """
+    Thread-safe iterator over readings. It also stands in for system.device,
+    handing a route the reading its calling thread just took.
+    """
+
+    def __init__(self, readings):
+        self._readings = iter(readings)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def next(self):
+        with self._lock:
+            reading = next(self._readings, None)
+        self._local.reading = reading
+        return reading
+
+    def generate_health_data(self):
+        return self._local.reading
+
+
+def recorded_readings(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def direct_target(datastore_dir, block_log):
+    """Call process_health_data on a fresh system backed by mongomock"""
+    from system import HealthMonitoringSystem
+
+    client = mongomock.MongoClient()
+    system = HealthMonitoringSystem(
+        SimpleNamespace(db=client.iomt_blockchain_db),
+        block_log_dir=os.path.join(datastore_dir, 'blocklog') if block_log else None
+    )
+    return system, lambda reading: system.process_health_data(custom_data=reading)
+
+
+def flask_target(datastore_dir):
+    """POST /api/generate_data through the test client, one logged-in client per thread"""
+    os.environ['IOMT_DATASTORE_DIR'] = datastore_dir
+    with mongomock.patch(servers=(('localhost', 27017),)), \
+            mock.patch('flask_pymongo.MongoClient', mongomock.MongoClient):
+        import app as web
+    # The harness owns the system; don't run the app's shutdown save on exit
+    atexit.unregister(web.save_data_on_shutdown)
+
+    clients = threading.local()
+
+    def call(_reading):
+        # The route reads the reading back through system.device
+        client = getattr(clients, 'client', None)
+        if client is None:
+            client = clients.client = web.app.test_client()
+            client.post('/login/admin', data={'username': 'admin', 'password': 'admin123'})
+        response = client.post('/api/generate_data')
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/generate_data returned {response.status_code}")
+
+    return web.system, call
+
+
+def run(system, call, source, readings, rate, concurrency):
+    """Drive `readings` calls from `concurrency` threads, paced to `rate` per second"""
+    recorder = LatencyRecorder()
+    system.stage_timer = recorder
+    system.device = source
+
+    lock = threading.Lock()
+    issued = [0]
+    errors = [0]
+    started = time.perf_counter()
+
+    def worker():
+        while True:
+            with lock:
+                i = issued[0]
+                if i >= readings:
+                    return
+                issued[0] += 1
+            reading = source.next()
+            if reading is None:
+                return
+            if rate:
+                # Open-loop pacing: reading i is due at started + i / rate
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            call_started = time.perf_counter()
+            try:
+                call(reading)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            recorder('total', time.perf_counter() - call_started)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    # The ingestion path logs every write; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    system.stage_timer = None
+
+    completed = len(recorder.samples['total'])
+    return {
+        'concurrency': concurrency,
+        'readings': completed,
+        'errors': errors[0],
+        'seconds': elapsed,
+        'throughput': completed / elapsed if elapsed else 0.0,
+        'stages': recorder.summary()
+    }
+
+
+def print_report(result):
+    print(f"\nconcurrency {result['concurrency']}: {result['readings']} readings in "
+          f"{result['seconds']:.2f}s = {result['throughput']:.0f} readings/s"
+          f" ({result['errors']} errors)")
+    print(f"  {'stage':<12} {'count':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage in STAGES:
+        stats = result['stages'].get(stage)
+        if stats:
+            print(f"  {stage:<12} {stats['count']:>8} {stats['p50_ms']:>9.3f} "
+                  f"{stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('direct', 'flask'), default='direct')
+    parser.add_argument('--readings', type=int, default=5000, help="readings per concurrency level")
+    parser.add_argument('--rate', type=float, default=0, help="target readings/s (0 = as fast as possible)")
+    parser.add_argument('--concurrency', default='1', help="comma-separated thread counts, e.g. 1,2,4,8")
+    parser.add_argument('--devices', type=int, default=1000, help="simulated devices")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--replay', help="NDJSON file of recorded readings to replay instead of simulating")
+    parser.add_argument('--block-log', action='store_true', help="keep the chain in an on-disk block log")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    datastore_dir = tempfile.mkdtemp(prefix='iomt-load-')
+    if args.mode == 'flask':
+        system, call = flask_target(datastore_dir)
+
+    results = []
+    for concurrency in levels:
+        if args.mode == 'direct':
+            system, call = direct_target(os.path.join(datastore_dir, f"c{concurrency}"),
+                                         args.block_log)
+        if args.replay:
+            traffic = recorded_readings(args.replay)
+        else:
+            traffic = DeviceFleet(args.devices, seed=args.seed).stream(args.readings)
+        result = run(system, call, ReadingSource(traffic), args.readings, args.rate, concurrency)
+        results.append(result)
+        if not args.json:
+            print_report(result)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return results
+
+
+if __name__ == '__main__':
+    main()
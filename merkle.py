@@ -0,0 +1,52 @@
+import hashlib
+
+# Domain separation between leaves and interior nodes, so a leaf can never be
+# passed off as a node (second-preimage attack on the tree).
+_LEAF_PREFIX = b'\x00'
+_NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(payload):
+    return hashlib.sha256(_LEAF_PREFIX + payload).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(_NODE_PREFIX + left + right).digest()
+
+
+def merkle_levels(leaves):
+    """Build every level of the tree, from the leaf hashes up to the root"""
+    level = [leaf_hash(payload) for payload in leaves]
+    levels = [level]
+    while len(level) > 1:
+        # An odd node is promoted to the next level unchanged
+        level = [node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+def merkle_root(leaves):
+    if not leaves:
+        return bytes(32)
+    return merkle_levels(leaves)[-1][0]
+
+
+def merkle_path(levels, position):
+    """Sibling hashes from leaf `position` up to the root as [side, hex] pairs"""
+    path = []
+    for level in levels[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append(['L' if sibling < position else 'R', level[sibling].hex()])
+        position //= 2
+    return path
+
+
+def root_from_path(payload, path):
+    """Fold a leaf payload with its path back up to the root it commits to"""
+    digest = leaf_hash(payload)
+    for side, sibling in path:
+        sibling = bytes.fromhex(sibling)
+        digest = node_hash(sibling, digest) if side == 'L' else node_hash(digest, sibling)
+    return digest
@@ -0,0 +1,165 @@
+import hashlib
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from blockchain import Block, meets_difficulty
+
+_NONCE = struct.Struct('>Q')
+_MAX_NONCE = 2 ** 64
+_CANCEL_CHECK = 4096  # nonces tried between checks of the cancel flag
+
+# Set in each worker process by _init_worker
+_cancel = None
+
+
+def _init_worker(cancel):
+    global _cancel
+    _cancel = cancel
+
+
+def _search(prefix, difficulty, start, step, cancel=None):
+    """
+    Try nonces start, start + step, ... until one meets the difficulty or the
+    search is cancelled. Returns (nonce or None, nonces tried).
+    """
+    cancel = cancel or _cancel
+    base = hashlib.sha256(prefix)
+    nonce = start
+    tried = 0
+    while nonce < _MAX_NONCE:
+        for _ in range(min(_CANCEL_CHECK, (_MAX_NONCE - 1 - nonce) // step + 1)):
+            candidate = base.copy()
+            candidate.update(_NONCE.pack(nonce))
+            tried += 1
+            if meets_difficulty(candidate.digest(), difficulty):
+                return nonce, tried
+            nonce += step
+        if cancel.is_set():
+            break
+    return None, tried
+
+
+class Miner:
+    """
+    Proof-of-work miner that searches nonces on a pool of worker processes.
+
+    Each worker scans an interleaved slice of the nonce space; the first to
+    find a valid nonce cancels the others. After every block the difficulty
+    is nudged towards `target_interval` seconds per block.
+    """
+
+    def __init__(self, workers=None, difficulty=2, target_interval=10.0,
+                 min_difficulty=1, max_difficulty=16):
+        self.workers = workers or os.cpu_count() or 1
+        self.difficulty = difficulty
+        self.target_interval = target_interval
+        self.min_difficulty = min_difficulty
+        self.max_difficulty = max_difficulty
+
+        # Metrics
+        self.blocks_mined = 0
+        self.total_nonces = 0
+        self.total_seconds = 0.0
+        self.last_hash_rate = 0.0
+
+        self._cancel = multiprocessing.Event()
+        self._pool = None
+        if self.workers > 1:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self._cancel,))
+
+    def search(self, prefix, difficulty, timeout=None):
+        """Find a nonce for the hash prefix; returns (nonce or None on timeout, nonces tried)"""
+        self._cancel.clear()
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._cancel.set)
+            timer.start()
+
+        try:
+            if self._pool is None:
+                return _search(prefix, difficulty, 0, 1, self._cancel)
+
+            futures = [self._pool.submit(_search, prefix, difficulty, i, self.workers)
+                       for i in range(self.workers)]
+            wait(futures, return_when=FIRST_COMPLETED)
+            # Stop the other workers as soon as one of them finishes
+            self._cancel.set()
+            wait(futures)
+
+            nonces = [f.result()[0] for f in futures if f.result()[0] is not None]
+            tried = sum(f.result()[1] for f in futures)
+            return (min(nonces) if nonces else None), tried
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def mine(self, block):
+        """
+        Find a nonce for `block` at the current difficulty and store both in the
+        block. Returns None, leaving the block unmined, if the search is cancelled.
+        """
+        started = time.perf_counter()
+        # The difficulty is part of the hashed header, so it is set before searching
+        block.difficulty = self.difficulty
+        nonce, tried = self.search(block.hash_prefix(), self.difficulty)
+        elapsed = time.perf_counter() - started
+
+        if nonce is None:
+            block.difficulty = 0
+            block.digest = block.calculate_digest()
+            return None
+        block.nonce = nonce
+        block.digest = block.calculate_digest()
+
+        self.blocks_mined += 1
+        self.total_nonces += tried
+        self.total_seconds += elapsed
+        self.last_hash_rate = tried / elapsed if elapsed > 0 else 0.0
+        self.adjust_difficulty(elapsed)
+        return block
+
+    def adjust_difficulty(self, elapsed):
+        # One hex digit is a 16x change in work, so only move on a clear miss
+        if elapsed < self.target_interval / 4 and self.difficulty < self.max_difficulty:
+            self.difficulty += 1
+        elif elapsed > self.target_interval * 4 and self.difficulty > self.min_difficulty:
+            self.difficulty -= 1
+
+    def metrics(self):
+        return {
+            'workers': self.workers,
+            'difficulty': self.difficulty,
+            'blocks_mined': self.blocks_mined,
+            'last_hash_rate': self.last_hash_rate,
+            'average_hash_rate': self.total_nonces / self.total_seconds if self.total_seconds else 0.0
+        }
+
+    def close(self):
+        if self._pool is not None:
+            self._cancel.set()
+            self._pool.shutdown()
+
+
+def benchmark(worker_counts=None, seconds=3.0):
+    """Measure nonces/sec for each worker count on an unsolvable difficulty"""
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count() or 1})
+    prefix = Block(1, time.time(), b"benchmark", "0").hash_prefix()
+    results = {}
+    for workers in worker_counts:
+        miner = Miner(workers=workers)
+        try:
+            _, tried = miner.search(prefix, 64, timeout=seconds)
+        finally:
+            miner.close()
+        results[workers] = tried / seconds
+    return results
+
+
+if __name__ == '__main__':
+    for workers, rate in benchmark().items():
+        print(f"{workers:>3} workers: {rate:,.0f} nonces/sec")
@@ -0,0 +1,191 @@
+import datetime
+import threading
+
+import numpy as np
+
+from smart_contract import alerts_to_mask, mask_to_alerts
+
+# Numeric fields kept per reading, one ring-buffer row each
+_COLUMNS = ('timestamp', 'heart_rate', 'systolic', 'diastolic', 'body_temp', 'spo2', 'glucose')
+# Columns reported as ints when they hold whole numbers, as the devices send them
+_INT_COLUMNS = frozenset(('heart_rate', 'systolic', 'diastolic', 'spo2', 'glucose'))
+_INITIAL_CAPACITY = 16
+
+
+class PatientWindow:
+    """
+    Recent readings of one patient in columnar ring buffers: a float64 row
+    per numeric field and a uint16 alert bitmask per reading. Alerts that
+    can't be rebuilt from a bitmask (custom profiles, z-scores) are kept
+    as-is, keyed by buffer position.
+    """
+    __slots__ = ('values', 'alert_masks', 'other_alerts', 'start', 'size')
+
+    def __init__(self, capacity=_INITIAL_CAPACITY):
+        self.values = np.full((len(_COLUMNS), capacity), np.nan)
+        self.alert_masks = np.zeros(capacity, dtype=np.uint16)
+        self.other_alerts = {}  # buffer position -> alerts
+        self.start = 0
+        self.size = 0
+
+    @property
+    def capacity(self):
+        return self.values.shape[1]
+
+    def positions(self):
+        """Buffer positions of the readings, oldest first"""
+        return (self.start + np.arange(self.size)) % self.capacity
+
+    def _grow(self, capacity):
+        positions = self.positions()
+        values = np.full((len(_COLUMNS), capacity), np.nan)
+        values[:, :self.size] = self.values[:, positions]
+        alert_masks = np.zeros(capacity, dtype=np.uint16)
+        alert_masks[:self.size] = self.alert_masks[positions]
+        moved = {old: new for new, old in enumerate(positions.tolist())}
+        self.other_alerts = {moved[position]: alerts for position, alerts in self.other_alerts.items()}
+        self.values, self.alert_masks, self.start = values, alert_masks, 0
+
+    def _evict_oldest(self):
+        self.other_alerts.pop(self.start, None)
+        self.start = (self.start + 1) % self.capacity
+        self.size -= 1
+
+    def append(self, row, mask, alerts, max_readings, max_age):
+        if self.size == self.capacity:
+            if self.capacity < max_readings:
+                self._grow(min(max_readings, self.capacity * 2))
+            else:
+                self._evict_oldest()
+        position = (self.start + self.size) % self.capacity
+        self.values[:, position] = row
+        self.alert_masks[position] = mask
+        if alerts is None:
+            self.other_alerts.pop(position, None)
+        else:
+            self.other_alerts[position] = alerts
+        self.size += 1
+
+        if max_age is not None and not np.isnan(row[0]):
+            # Time window: drop readings older than max_age before the newest one
+            cutoff = row[0] - max_age
+            while self.size > 1 and self.values[0, self.start] < cutoff:
+                self._evict_oldest()
+
+    def reading(self, patient_id, position):
+        values = {}
+        for name, value in zip(_COLUMNS, self.values[:, position].tolist()):
+            if value != value:  # NaN: the reading didn't have this field
+                continue
+            values[name] = int(value) if name in _INT_COLUMNS and value.is_integer() else value
+
+        reading = {'patient_id': patient_id}
+        for name in ('heart_rate', 'body_temp', 'spo2', 'glucose', 'timestamp'):
+            if name in values:
+                reading[name] = values[name]
+        if 'systolic' in values:
+            reading['blood_pressure'] = (values['systolic'], values.get('diastolic'))
+        if 'timestamp' in reading:
+            reading['readable_time'] = datetime.datetime.fromtimestamp(
+                int(reading['timestamp'])).strftime("%Y-%m-%d %H:%M:%S")
+
+        alerts = self.other_alerts.get(position)
+        if alerts is None:
+            alerts = mask_to_alerts(int(self.alert_masks[position]), reading)
+        reading['alerts'] = alerts
+        return reading
+
+
+class PatientStore:
+    """
+    Per-patient window of recent readings, bounded by count and optionally
+    by age.
+
+    Each patient holds at most `max_readings` readings, and with `max_age`
+    (seconds) only those within max_age of the patient's newest reading.
+    Buffers grow on demand up to max_readings, so memory is bounded by the
+    number of patients times the window. Older readings are served from
+    storage by `loader(patient_id, before)`, e.g.
+    HealthMonitoringSystem.iter_medical_history.
+
+    It behaves like the dict of reading lists it replaces: `in`, iteration
+    over patient ids, `store[patient_id]` (the window, oldest first) and
+    `del store[patient_id]`.
+    """
+
+    def __init__(self, max_readings=1000, max_age=None, loader=None):
+        if max_readings < 1:
+            raise ValueError("max_readings must be at least 1")
+        self.max_readings = max_readings
+        self.max_age = max_age
+        self.loader = loader
+        self.lock = threading.Lock()
+        self._windows = {}  # patient_id -> PatientWindow
+
+    def __contains__(self, patient_id):
+        return patient_id in self._windows
+
+    def __iter__(self):
+        return iter(list(self._windows))
+
+    def __len__(self):
+        return len(self._windows)
+
+    def keys(self):
+        return list(self._windows)
+
+    def __getitem__(self, patient_id):
+        with self.lock:
+            window = self._windows[patient_id]
+            return [window.reading(patient_id, position) for position in window.positions().tolist()]
+
+    def __delitem__(self, patient_id):
+        with self.lock:
+            del self._windows[patient_id]
+
+    def add_patient(self, patient_id):
+        """Track a patient that has no readings yet"""
+        with self.lock:
+            if patient_id not in self._windows:
+                self._windows[patient_id] = PatientWindow(min(_INITIAL_CAPACITY, self.max_readings))
+
+    def append(self, reading):
+        patient_id = reading['patient_id']
+        blood_pressure = reading.get('blood_pressure') or (None, None)
+        row = [reading.get('timestamp'), reading.get('heart_rate'), blood_pressure[0],
+               blood_pressure[1], reading.get('body_temp'), reading.get('spo2'), reading.get('glucose')]
+        row = [np.nan if value is None else value for value in row]
+
+        alerts = reading.get('alerts') or []
+        try:
+            mask = alerts_to_mask(alerts, reading)
+        except (KeyError, IndexError, TypeError):
+            mask = None
+
+        with self.lock:
+            window = self._windows.get(patient_id)
+            if window is None:
+                window = self._windows[patient_id] = PatientWindow(
+                    min(_INITIAL_CAPACITY, self.max_readings))
+            window.append(row, mask or 0, list(alerts) if mask is None else None,
+                          self.max_readings, self.max_age)
+
+    def recent(self, patient_id, limit=None):
+        """The patient's windowed readings, newest first"""
+        if patient_id not in self._windows:
+            return []
+        readings = self[patient_id]
+        readings.reverse()
+        return readings[:limit] if limit is not None else readings
+
+    def history(self, patient_id):
+        """
+        Lazily yield all of a patient's readings, newest first: the window
+        from memory, then older readings from storage
+        """
+        recent = self.recent(patient_id)
+        yield from recent
+        if self.loader is None:
+            return
+        before = (recent[-1]['timestamp'], None) if recent else None
+        yield from self.loader(patient_id, before=before)
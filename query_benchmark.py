@@ -0,0 +1,88 @@
+"""
+Regression check for the number of MongoDB queries made by the read paths.
+
+Builds chains of increasing length on mongomock, counts the queries each of
+get_blockchain_data and get_patient_blockchain_data makes, and fails if the
+count grows with the chain (an N+1 pattern):
+
+    python query_benchmark.py --lengths 10,100,1000
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import mongomock
+
+from iomt_simulator import DeviceFleet
+from system import HealthMonitoringSystem
+
+_QUERY_METHODS = {'find', 'find_one', 'aggregate', 'count_documents', 'distinct'}
+
+
+class CountingCollection:
+    """Proxy for a collection that counts the queries issued through it"""
+
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in _QUERY_METHODS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._counter[0] += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def measure(length, devices=20):
+    """Query counts and timings of the read paths for a chain of `length` readings"""
+    db = mongomock.MongoClient().iomt_blockchain_db
+    system = HealthMonitoringSystem(SimpleNamespace(db=db))
+    fleet = DeviceFleet(devices, seed=1)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        system.process_health_data_batch(fleet.stream(length))
+
+    counter = [0]
+    for name in ('patients_collection', 'health_records_collection', 'blockchain_collection'):
+        setattr(system, name, CountingCollection(getattr(system, name), counter))
+
+    results = {}
+    for label, read in (('get_blockchain_data', system.get_blockchain_data),
+                        ('get_patient_blockchain_data',
+                         lambda: system.get_patient_blockchain_data(fleet.patient_ids[0]))):
+        counter[0] = 0
+        started = time.perf_counter()
+        rows = read()
+        results[label] = {'queries': counter[0], 'rows': len(rows),
+                          'seconds': time.perf_counter() - started}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that read paths make a constant number of queries")
+    parser.add_argument('--lengths', default='10,100,1000', help="comma-separated chain lengths")
+    args = parser.parse_args(argv)
+
+    counts = {}
+    for length in (int(value) for value in args.lengths.split(',')):
+        for label, stats in measure(length).items():
+            print(f"{label:<28} {length:>7} blocks: {stats['queries']} queries, "
+                  f"{stats['rows']} rows in {stats['seconds'] * 1000:.1f} ms")
+            counts.setdefault(label, set()).add(stats['queries'])
+
+    growing = [label for label, seen in counts.items() if len(seen) > 1]
+    if growing:
+        print(f"Query count grows with chain length in: {', '.join(growing)}")
+        return 1
+    print("Query counts are constant in chain length")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import datetime
+import itertools
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.results import InsertManyResult, InsertOneResult
+
+# Per-reading fields stored as parallel arrays in a bucket (a record's _id is
+# stored as record_id); patient_id is per bucket, readable_time is derived from
+# the timestamp and created_at is dropped
+_COLUMNS = ('record_id', 'timestamp', 'heart_rate', 'blood_pressure', 'body_temp', 'spo2', 'glucose',
+            'alerts', 'block_hash', 'block_index', 'batch_position', 'merkle_proof')
+# Written by the ingestion paths but not kept
+_DROPPED = frozenset(('_id', 'patient_id', 'readable_time', 'created_at'))
+# Columns left out of a reading when they hold None (single-reading blocks)
+_OPTIONAL = frozenset(('batch_position', 'merkle_proof'))
+
+
+class HealthRecordBuckets:
+    """
+    Health records stored as per-patient time buckets.
+
+    Each document holds up to `max_count` readings of one patient whose
+    timestamps fall in the same `bucket_seconds` window (an hour by default).
+    The readings are stored as parallel arrays, one per field, with the
+    window start, reading count and timestamp range kept once per bucket.
+    Fields outside the known columns are kept per reading under "extra".
+
+    insert_one/insert_many accept the same documents as the health_records
+    collection and return pymongo results with the reading ids, so a bucket
+    store can stand in for that collection wherever records are written.
+    Readers unpack buckets back into health record dicts.
+    """
+
+    def __init__(self, collection, bucket_seconds=3600, max_count=1000):
+        self.collection = collection
+        self.bucket_seconds = bucket_seconds
+        self.max_count = max_count
+        self.name = collection.name
+
+    def ensure_indexes(self):
+        self.collection.create_index([('patient_id', 1), ('start', -1)])
+        # Multikey index over the block hash of every reading
+        self.collection.create_index('block_hash')
+        # Lets a retried insert find the readings it already wrote
+        self.collection.create_index('record_id')
+
+    def insert_one(self, document):
+        return InsertOneResult(self.insert_many([document]).inserted_ids[0], True)
+
+    def insert_many(self, documents, ordered=False):
+        """Append records to their buckets with one bulk write; `ordered` is accepted for compatibility"""
+        ids = []
+        assigned = []
+        buckets = {}
+        for document in documents:
+            # Ids assigned by the caller (e.g. the write-behind queue) are kept
+            if '_id' in document:
+                assigned.append(document['_id'])
+            record_id = document.setdefault('_id', ObjectId())
+            ids.append(record_id)
+
+        # A retried write (e.g. by the write-behind queue) skips the records an
+        # earlier attempt already pushed; pushing them again would duplicate them,
+        # in another bucket if theirs has since filled up
+        written = set()
+        if assigned:
+            for bucket in self.collection.find({'record_id': {'$in': assigned}}, {'record_id': 1}):
+                written.update(bucket['record_id'])
+        for document in documents:
+            if document['_id'] in written:
+                continue
+            start = document['timestamp'] // self.bucket_seconds * self.bucket_seconds
+            buckets.setdefault((document['patient_id'], start), []).append(document)
+
+        operations = []
+        for (patient_id, start), records in buckets.items():
+            for i in range(0, len(records), self.max_count):
+                chunk = records[i:i + self.max_count]
+                columns = {name: [record.get(name) for record in chunk] for name in _COLUMNS[1:]}
+                columns['record_id'] = [record['_id'] for record in chunk]
+                columns['extra'] = [
+                    {key: value for key, value in record.items()
+                     if key not in _DROPPED and key not in _COLUMNS} or None
+                    for record in chunk
+                ]
+                timestamps = columns['timestamp']
+                operations.append(UpdateOne(
+                    # Only a bucket with room for the whole chunk matches, so max_count is
+                    # never exceeded; otherwise the upsert opens a new bucket
+                    {'patient_id': patient_id, 'start': start,
+                     'count': {'$lte': self.max_count - len(chunk)}},
+                    {'$push': {name: {'$each': values} for name, values in columns.items()},
+                     '$inc': {'count': len(chunk)},
+                     '$min': {'min_timestamp': min(timestamps)},
+                     '$max': {'max_timestamp': max(timestamps)},
+                     '$setOnInsert': {'end': start + self.bucket_seconds}},
+                    upsert=True
+                ))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        return InsertManyResult(ids, True)
+
+    @staticmethod
+    def unpack(bucket, seen=None):
+        """
+        Health record dicts of a bucket, in the order they were written. Ids in
+        `seen` are skipped and the unpacked ones added, so a set shared across
+        buckets drops readings duplicated between them.
+        """
+        records = []
+        seen = set() if seen is None else seen
+        for position in range(len(bucket.get('timestamp', ()))):
+            record_id = bucket['record_id'][position]
+            # A retried write may have appended the same reading twice
+            if record_id in seen:
+                continue
+            seen.add(record_id)
+            record = {'_id': record_id, 'patient_id': bucket['patient_id']}
+            for name in _COLUMNS[1:]:
+                value = bucket[name][position]
+                if value is None and name in _OPTIONAL:
+                    continue
+                record[name] = value
+            record['readable_time'] = datetime.datetime.fromtimestamp(
+                int(record['timestamp'])).strftime("%Y-%m-%d %H:%M:%S")
+            extra = bucket.get('extra', [None] * (position + 1))[position]
+            if extra:
+                record.update(extra)
+            records.append(record)
+        return records
+
+    def history(self, patient_id, before=None, batch_size=100):
+        """
+        Lazily yield a patient's records newest first, as health records with
+        string ids. `before` is the (timestamp, _id) of the last record already
+        seen; _id may be None. Buckets are streamed from one cursor.
+        """
+        query = {'patient_id': patient_id}
+        if before is not None:
+            timestamp, record_id = before
+            query['min_timestamp'] = {'$lte': timestamp}
+            before = (timestamp, ObjectId(record_id) if record_id is not None else None)
+        buckets = self.collection.find(query).sort([('start', -1), ('_id', -1)]).batch_size(batch_size)
+
+        # Overflow buckets share a window start, so their readings are sorted together
+        for _, group in itertools.groupby(buckets, key=lambda bucket: bucket['start']):
+            # A duplicated reading has the same timestamp, so it is in this window too
+            seen = set()
+            records = [record for bucket in group for record in self.unpack(bucket, seen)]
+            records.sort(key=lambda record: (record['timestamp'], record['_id']), reverse=True)
+            for record in records:
+                if before is not None and not _is_before(record, before):
+                    continue
+                record['_id'] = str(record['_id'])
+                yield record
+
+    def records_for_blocks(self, hashes):
+        """Records of the given blocks, unpacked from every bucket holding one of them"""
+        wanted = set(hashes)
+        records = []
+        seen = set()
+        for bucket in self.collection.find({'block_hash': {'$in': list(wanted)}}):
+            records.extend(record for record in self.unpack(bucket, seen) if record['block_hash'] in wanted)
+        return records
+
+    def rename_blocks(self, renamed):
+        """Replace old block hashes with new ones (after a chain migration)"""
+        updates = []
+        for bucket in self.collection.find({'block_hash': {'$in': list(renamed)}},
+                                           {'block_hash': 1}):
+            updates.append(UpdateOne(
+                {'_id': bucket['_id']},
+                {'$set': {'block_hash': [renamed.get(block_hash, block_hash)
+                                         for block_hash in bucket['block_hash']]}}
+            ))
+        if updates:
+            self.collection.bulk_write(updates, ordered=False)
+
+    def delete_many(self, query):
+        return self.collection.delete_many(query)
+
+
+def _is_before(record, before):
+    timestamp, record_id = before
+    if record['timestamp'] != timestamp:
+        return record['timestamp'] < timestamp
+    return record_id is not None and record['_id'] < record_id
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+
+from atomic_file import write_atomic
+
+DEFAULT_PROFILE = 'default'
+
+# How each known vital is read from a reading and reported. Profiles can add
+# vitals of their own under "vitals" with the same fields.
+DEFAULT_VITALS = {
+    'heart_rate': {'field': 'heart_rate', 'message': "{severity} heart rate: {value} bpm"},
+    'blood_pressure': {'field': 'blood_pressure', 'item': 0,
+                       'message': "{severity} systolic BP: {value} mmHg"},
+    'body_temp': {'field': 'body_temp', 'message': "{severity} body temperature: {value} °C"},
+    'spo2': {'field': 'spo2', 'message': "{severity} oxygen saturation: {value}%"},
+    'glucose': {'field': 'glucose', 'message': "{severity} blood glucose: {value} mg/dL"}
+}
+
+
+class ThresholdRules:
+    """
+    Threshold profiles, compiled into flat evaluation plans.
+
+    A profile maps vitals to {'low': x, 'high': y} bounds (either may be
+    omitted) and may extend another profile, e.g. a "copd" cohort profile
+    that only lowers the SpO2 floor of "default". Patients are assigned a
+    profile and can carry their own overrides on top of it.
+
+    Each profile is compiled once into a tuple of
+    (vital, field, item, low, high, low message, high message) entries and
+    cached together with the plan of every patient using it. Changing a
+    profile drops the cached plans of it and every profile extending it.
+    """
+
+    def __init__(self, thresholds, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.vitals = dict(DEFAULT_VITALS)
+        self.profiles = {DEFAULT_PROFILE: {'extends': None, 'thresholds': thresholds}}
+        self.patients = {}  # patient_id -> {'profile': name, 'thresholds': overrides}
+        self._plans = {}  # profile name -> compiled plan
+        self._patient_plans = {}  # patient_id -> compiled plan
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def load(self, path):
+        """
+        Load profiles from a JSON file of the form
+        {"vitals": {...}, "profiles": {"copd": {"extends": "default",
+        "thresholds": {"spo2": {"low": 88}}}}, "patients": {"P001":
+        {"profile": "copd", "thresholds": {...}}}}
+        """
+        with open(path) as f:
+            config = json.load(f)
+        with self.lock:
+            self.vitals.update(config.get('vitals', {}))
+            for name, profile in config.get('profiles', {}).items():
+                extends = None if name == DEFAULT_PROFILE else profile.get('extends', DEFAULT_PROFILE)
+                self.profiles[name] = {'extends': extends, 'thresholds': profile.get('thresholds', {})}
+            self.patients.update(config.get('patients', {}))
+            self._invalidate_all()
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            config = {
+                'vitals': {name: vital for name, vital in self.vitals.items()
+                           if DEFAULT_VITALS.get(name) != vital},
+                'profiles': self.profiles,
+                'patients': self.patients
+            }
+        write_atomic(path, json.dumps(config, indent=2))
+
+    def _invalidate_all(self):
+        self._plans = {}
+        self._patient_plans = {}
+
+    def _dependents(self, name):
+        """The profile and every profile that extends it, directly or not"""
+        names = {name}
+        changed = True
+        while changed:
+            changed = False
+            for other, profile in self.profiles.items():
+                if other not in names and profile['extends'] in names:
+                    names.add(other)
+                    changed = True
+        return names
+
+    def set_vital(self, vital, field=None, message=None, item=None):
+        """Add or change how a vital is read and reported"""
+        spec = {'field': field or vital, 'message': message or "{severity} " + vital + ": {value}"}
+        if item is not None:
+            spec['item'] = item
+        with self.lock:
+            self.vitals[vital] = spec
+            self._invalidate_all()
+
+    def set_profile(self, name, thresholds, extends=DEFAULT_PROFILE):
+        """Create or replace a profile; the default profile extends nothing"""
+        with self.lock:
+            if name == DEFAULT_PROFILE:
+                extends = None
+            elif extends not in self.profiles:
+                raise ValueError(f"Unknown base profile: {extends}")
+            stale = self._dependents(name) if name in self.profiles else {name}
+            self.profiles[name] = {'extends': extends, 'thresholds': thresholds}
+            for profile_name in stale:
+                self._plans.pop(profile_name, None)
+            self._patient_plans = {
+                patient_id: plan for patient_id, plan in self._patient_plans.items()
+                if self.patients.get(patient_id, {}).get('profile', DEFAULT_PROFILE) not in stale
+            }
+
+    def assign_patient(self, patient_id, profile=DEFAULT_PROFILE, thresholds=None):
+        """Use `profile` for a patient, with optional patient-specific overrides"""
+        with self.lock:
+            if profile not in self.profiles:
+                raise ValueError(f"Unknown profile: {profile}")
+            self.patients[patient_id] = {'profile': profile, 'thresholds': thresholds or {}}
+            self._patient_plans.pop(patient_id, None)
+
+    def thresholds(self, profile=DEFAULT_PROFILE):
+        """Resolved bounds of a profile after applying everything it extends"""
+        chain = []
+        seen = set()
+        while profile is not None:
+            if profile in seen:
+                raise ValueError(f"Profile {profile} extends itself")
+            seen.add(profile)
+            chain.append(self.profiles[profile])
+            profile = self.profiles[profile]['extends']
+
+        resolved = {}
+        for entry in reversed(chain):
+            for vital, bounds in entry['thresholds'].items():
+                resolved[vital] = {**resolved.get(vital, {}), **bounds}
+        return resolved
+
+    def _compile(self, thresholds):
+        plan = []
+        for vital, bounds in thresholds.items():
+            spec = self.vitals[vital]
+            message = spec['message']
+            plan.append((
+                vital, spec['field'], spec.get('item'), bounds.get('low'), bounds.get('high'),
+                message.replace('{severity}', 'Low'), message.replace('{severity}', 'High')
+            ))
+        return tuple(plan)
+
+    def plan(self, profile=DEFAULT_PROFILE):
+        plan = self._plans.get(profile)
+        if plan is None:
+            with self.lock:
+                plan = self._plans[profile] = self._compile(self.thresholds(profile))
+        return plan
+
+    def plan_for_patient(self, patient_id):
+        plan = self._patient_plans.get(patient_id)
+        if plan is not None:
+            return plan
+
+        assignment = self.patients.get(patient_id)
+        if assignment is None:
+            return self.plan()
+        with self.lock:
+            thresholds = self.thresholds(assignment.get('profile', DEFAULT_PROFILE))
+            for vital, bounds in assignment.get('thresholds', {}).items():
+                thresholds[vital] = {**thresholds.get(vital, {}), **bounds}
+            plan = self._patient_plans[patient_id] = self._compile(thresholds)
+        return plan
+
+
+def evaluate(plan, data):
+    """Alerts raised by a compiled plan for one reading"""
+    alerts = []
+    for vital, field, item, low, high, low_message, high_message in plan:
+        value = data.get(field)
+        if value is None:
+            continue
+        if item is not None:
+            value = value[item]
+        if high is not None and value > high:
+            alerts.append({'type': vital, 'severity': 'high',
+                           'message': high_message.format(value=value)})
+        elif low is not None and value < low:
+            alerts.append({'type': vital, 'severity': 'low',
+                           'message': low_message.format(value=value)})
+    return alerts
@@ -1,91 +1,146 @@
+import os
+
+import numpy as np
+
+from rule_engine import ThresholdRules, DEFAULT_PROFILE, DEFAULT_VITALS, evaluate
+
+# (vital, severity) for each alert-code bit, in the order check_vitals reports them
+ALERT_CODES = [
+    ('heart_rate', 'low'), ('heart_rate', 'high'),
+    ('blood_pressure', 'low'), ('blood_pressure', 'high'),
+    ('body_temp', 'low'), ('body_temp', 'high'),
+    ('spo2', 'low'), ('spo2', 'high'),
+    ('glucose', 'low'), ('glucose', 'high')
+]
+_ALERT_BITS = {code: bit for bit, code in enumerate(ALERT_CODES)}
+
+# Message templates; formatting is deferred until an alert is displayed
+_ALERT_MESSAGES = {vital: spec['message'] for vital, spec in DEFAULT_VITALS.items()}
+
+
+def vital_value(data, vital):
+    """Value a vital is checked on (systolic pressure for blood_pressure)"""
+    if vital == 'blood_pressure':
+        return data['blood_pressure'][0]
+    return data[vital]
+
+
+def alert_message(vital, severity, value):
+    return _ALERT_MESSAGES[vital].format(severity=severity.capitalize(), value=value)
+
+
+def alerts_to_mask(alerts, data):
+    """
+    Pack alerts into a bitmask of ALERT_CODES. Returns None when the alerts
+    can't be rebuilt exactly from the mask and the reading.
+    """
+    mask = 0
+    last_bit = -1
+    for alert in alerts:
+        bit = _ALERT_BITS.get((alert.get('type'), alert.get('severity')))
+        # mask_to_alerts yields alerts in bit order with generated messages only
+        if bit is None or bit <= last_bit or len(alert) != 3 or \
+                alert.get('message') != alert_message(alert['type'], alert['severity'],
+                                                      vital_value(data, alert['type'])):
+            return None
+        mask |= 1 << bit
+        last_bit = bit
+    return mask
+
+
+def mask_to_alerts(mask, data):
+    """Rebuild the alert dicts for a bitmask of ALERT_CODES"""
+    alerts = []
+    for bit, (vital, severity) in enumerate(ALERT_CODES):
+        if mask >> bit & 1:
+            alerts.append({
+                'type': vital,
+                'severity': severity,
+                'message': alert_message(vital, severity, vital_value(data, vital))
+            })
+    return alerts
+
+
+def columns_from_readings(readings):
+    """Columnar arrays (heart_rate, systolic, body_temp, spo2, glucose) for check_vitals_batch"""
+    readings = list(readings)
+    return (
+        np.fromiter((r['heart_rate'] for r in readings), dtype=np.int64, count=len(readings)),
+        np.fromiter((r['blood_pressure'][0] for r in readings), dtype=np.int64, count=len(readings)),
+        np.fromiter((r['body_temp'] for r in readings), dtype=np.float64, count=len(readings)),
+        np.fromiter((r['spo2'] for r in readings), dtype=np.int64, count=len(readings)),
+        np.fromiter((r['glucose'] for r in readings), dtype=np.int64, count=len(readings))
+    )
+
+
+def row_alerts(masks, row, heart_rate, systolic, body_temp, spo2, glucose):
+    """Alert dicts for one row of a check_vitals_batch result, formatted on demand"""
+    data = {
+        'heart_rate': heart_rate[row].item(),
+        'blood_pressure': [systolic[row].item(), None],
+        'body_temp': body_temp[row].item(),
+        'spo2': spo2[row].item(),
+        'glucose': glucose[row].item()
+    }
+    return mask_to_alerts(int(masks[row]), data)
+
+
 class HealthSmartContract:
-    def __init__(self):
-        self.thresholds = {
+    def __init__(self, rules_path=None):
+        # Cohort profiles and patient assignments, if any, are kept in a JSON file
+        if rules_path is None:
+            rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'datastore',
+                                      'threshold_profiles.json')
+        # Bounds of the default profile; cohort and patient profiles are layered on top
+        self.rules = ThresholdRules({
             'heart_rate': {'low': 60, 'high': 100},
             'blood_pressure': {'low': 90, 'high': 140},
             'body_temp': {'low': 36.0, 'high': 38.0},
-            'spo2': {'low': 94, 'high': 100},
+            # Only low SpO2 is alerted on, as before profiles existed
+            'spo2': {'low': 94},
             'glucose': {'low': 70, 'high': 140}
-        }
+        }, path=rules_path)
+
+    @property
+    def thresholds(self):
+        return self.rules.thresholds()
 
-    def check_vitals(self, data):
-        """Check vital signs against thresholds and generate alerts"""
-        alerts = []
-        
-        # Check heart rate
-        if 'heart_rate' in data:
-            hr = data['heart_rate']
-            if hr > self.thresholds['heart_rate']['high']:
-                alerts.append({
-                    'type': 'heart_rate',
-                    'severity': 'high',
-                    'message': f"High heart rate: {hr} bpm"
-                })
-            elif hr < self.thresholds['heart_rate']['low']:
-                alerts.append({
-                    'type': 'heart_rate',
-                    'severity': 'low',
-                    'message': f"Low heart rate: {hr} bpm"
-                })
-        
-        # Check blood pressure
-        if 'blood_pressure' in data:
-            systolic = data['blood_pressure'][0]
-            diastolic = data['blood_pressure'][1]
-            
-            if systolic > self.thresholds['blood_pressure']['high']:
-                alerts.append({
-                    'type': 'blood_pressure',
-                    'severity': 'high',
-                    'message': f"High systolic BP: {systolic} mmHg"
-                })
-            elif systolic < self.thresholds['blood_pressure']['low']:
-                alerts.append({
-                    'type': 'blood_pressure',
-                    'severity': 'low',
-                    'message': f"Low systolic BP: {systolic} mmHg"
-                })
-        
-        # Check body temperature
-        if 'body_temp' in data:
-            temp = data['body_temp']
-            if temp > self.thresholds['body_temp']['high']:
-                alerts.append({
-                    'type': 'body_temp',
-                    'severity': 'high',
-                    'message': f"High body temperature: {temp} °C"
-                })
-            elif temp < self.thresholds['body_temp']['low']:
-                alerts.append({
-                    'type': 'body_temp',
-                    'severity': 'low',
-                    'message': f"Low body temperature: {temp} °C"
-                })
-        
-        # Check SpO2
-        if 'spo2' in data:
-            spo2 = data['spo2']
-            if spo2 < self.thresholds['spo2']['low']:
-                alerts.append({
-                    'type': 'spo2',
-                    'severity': 'low',
-                    'message': f"Low oxygen saturation: {spo2}%"
-                })
-        
-        # Check glucose
-        if 'glucose' in data:
-            glucose = data['glucose']
-            if glucose > self.thresholds['glucose']['high']:
-                alerts.append({
-                    'type': 'glucose',
-                    'severity': 'high',
-                    'message': f"High blood glucose: {glucose} mg/dL"
-                })
-            elif glucose < self.thresholds['glucose']['low']:
-                alerts.append({
-                    'type': 'glucose',
-                    'severity': 'low',
-                    'message': f"Low blood glucose: {glucose} mg/dL"
-                })
-        
-        return alerts
+    def check_vitals(self, data, profile=None):
+        """
+        Check vital signs against thresholds and generate alerts.
+        The patient's profile is used unless a profile name is given.
+        """
+        if profile is None:
+            plan = self.rules.plan_for_patient(data.get('patient_id'))
+        else:
+            plan = self.rules.plan(profile)
+        return evaluate(plan, data)
+
+    def check_vitals_batch(self, heart_rate, systolic, body_temp, spo2, glucose,
+                           profile=DEFAULT_PROFILE):
+        """
+        Vectorized check_vitals over columnar arrays of readings, using the
+        bounds of `profile`. Returns one ALERT_CODES bitmask per row (uint16);
+        use row_alerts or mask_to_alerts to turn a row's mask into alert
+        messages when it is displayed.
+        """
+        thresholds = self.rules.thresholds(profile)
+        columns = {
+            'heart_rate': np.asarray(heart_rate),
+            'blood_pressure': np.asarray(systolic),
+            'body_temp': np.asarray(body_temp),
+            'spo2': np.asarray(spo2),
+            'glucose': np.asarray(glucose)
+        }
+        masks = np.zeros(len(columns['heart_rate']), dtype=np.uint16)
+        for vital, values in columns.items():
+            limits = thresholds.get(vital, {})
+            high = np.zeros(len(masks), dtype=bool)
+            if limits.get('high') is not None:
+                high = values > limits['high']
+                masks |= high.astype(np.uint16) << _ALERT_BITS[(vital, 'high')]
+            # Like check_vitals, a reading is only low if it isn't also high
+            if limits.get('low') is not None:
+                low = (values < limits['low']) & ~high
+                masks |= low.astype(np.uint16) << _ALERT_BITS[(vital, 'low')]
+        return masks
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import struct
+import time
+from array import array
+
+from atomic_file import write_atomic
+from blockchain import Block
+
+_MAGIC = b'IOMTSNAP'
+_FORMAT_VERSION = 1
+# format version, tip index, tip digest, number of serialized blocks, written at
+_HEADER = struct.Struct('>BQ32sQd')
+_COUNT = struct.Struct('>I')
+_LENGTH = struct.Struct('>Q')
+
+
+class Snapshot:
+    """Contents of a snapshot file: chain tip, blocks (if stored) and indexes"""
+
+    def __init__(self, tip_index, tip_digest, blocks, patient_index, timestamp_keys,
+                 timestamp_blocks, written_at):
+        self.tip_index = tip_index
+        self.tip_digest = tip_digest
+        self.blocks = blocks
+        self.patient_index = patient_index
+        self.timestamp_keys = timestamp_keys
+        self.timestamp_blocks = timestamp_blocks
+        self.written_at = written_at
+
+
+def _pack_array(values):
+    return _LENGTH.pack(len(values)) + values.tobytes()
+
+
+def _unpack_array(typecode, buffer, offset):
+    (length,) = _LENGTH.unpack_from(buffer, offset)
+    offset += _LENGTH.size
+    values = array(typecode)
+    end = offset + length * values.itemsize
+    values.frombytes(buffer[offset:end])
+    return values, end
+
+
+def capture_snapshot(blockchain, include_blocks=True):
+    """
+    Copy the chain state a snapshot holds, for write_snapshot. Only the block
+    list and the index arrays are copied (no serialization), so it is cheap
+    enough to take under the chain lock. Log-backed chains are already
+    durable, so their snapshots can skip the blocks and hold only the tip and
+    the indexes.
+    """
+    tip = blockchain.get_latest_block()
+    return Snapshot(
+        tip.index, tip.digest, list(blockchain.chain) if include_blocks else [],
+        {patient_id: indices[:] for patient_id, indices in blockchain.patient_index.items()},
+        blockchain.timestamp_keys[:], blockchain.timestamp_blocks[:], time.time()
+    )
+
+
+def write_snapshot(path, snapshot):
+    """Atomically write a snapshot taken by capture_snapshot to `path`; returns its tip index"""
+    parts = [_MAGIC, _HEADER.pack(_FORMAT_VERSION, snapshot.tip_index, snapshot.tip_digest,
+                                  len(snapshot.blocks), snapshot.written_at)]
+    for block in snapshot.blocks:
+        record = block.to_bytes()
+        parts.append(_COUNT.pack(len(record)))
+        parts.append(record)
+
+    parts.append(_COUNT.pack(len(snapshot.patient_index)))
+    for patient_id, indices in snapshot.patient_index.items():
+        encoded = patient_id.encode()
+        parts.append(_COUNT.pack(len(encoded)))
+        parts.append(encoded)
+        parts.append(_pack_array(indices))
+    parts.append(_pack_array(snapshot.timestamp_keys))
+    parts.append(_pack_array(snapshot.timestamp_blocks))
+
+    body = b''.join(parts)
+    # A trailing checksum lets a torn or corrupted snapshot be detected on load
+    write_atomic(path, body + hashlib.sha256(body).digest())
+    return snapshot.tip_index
+
+
+def read_snapshot(path):
+    """Load a snapshot file, or return None if it is missing or corrupted"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    body, checksum = raw[:-32], raw[-32:]
+    if not body.startswith(_MAGIC) or hashlib.sha256(body).digest() != checksum:
+        print(f"Ignoring corrupted snapshot: {path}")
+        return None
+
+    view = memoryview(body)
+    offset = len(_MAGIC)
+    version, tip_index, tip_digest, block_count, written_at = _HEADER.unpack_from(view, offset)
+    if version != _FORMAT_VERSION:
+        print(f"Ignoring snapshot with unknown format version {version}: {path}")
+        return None
+    offset += _HEADER.size
+
+    blocks = []
+    for _ in range(block_count):
+        (length,) = _COUNT.unpack_from(view, offset)
+        offset += _COUNT.size
+        blocks.append(Block.from_buffer(view, offset)[0])
+        offset += length
+
+    patient_index = {}
+    (patients,) = _COUNT.unpack_from(view, offset)
+    offset += _COUNT.size
+    for _ in range(patients):
+        (length,) = _COUNT.unpack_from(view, offset)
+        offset += _COUNT.size
+        patient_id = bytes(view[offset:offset + length]).decode()
+        offset += length
+        patient_index[patient_id], offset = _unpack_array('Q', view, offset)
+    timestamp_keys, offset = _unpack_array('d', view, offset)
+    timestamp_blocks, offset = _unpack_array('Q', view, offset)
+
+    return Snapshot(tip_index, tip_digest, blocks, patient_index, timestamp_keys,
+                    timestamp_blocks, written_at)
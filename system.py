@@ -1,113 +1,602 @@
-from blockchain import Blockchain, Block
+from blockchain import Blockchain, Block, HASH_VERSION_JSON, HASH_VERSION_MERKLE, batch_levels
+from block_log import BlockLog
+from mining import Miner
+from snapshot import capture_snapshot, write_snapshot, read_snapshot
 from encryption import DataEncryptor
+from key_rotation import KeyRotationJob, read_checkpoint
+from alert_stream import StreamingAlertEngine
+from baselines import BaselineTracker
+from write_behind import WriteBehindQueue
+from patient_store import PatientStore
+from lazy_chain import LazyChain
+from record_buckets import HealthRecordBuckets
 from iomt_simulator import IoMTDeviceSimulator
 from smart_contract import HealthSmartContract
+from pymongo import UpdateOne, UpdateMany
+from bson.objectid import ObjectId
 import time
 import json
 import os
 import datetime
+import threading
+import itertools
+import heapq
+import contextlib
+
+class _StageTimer:
+    __slots__ = ('report', 'stage', 'started')
+
+    def __init__(self, report, stage):
+        self.report = report
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.report(self.stage, time.perf_counter() - self.started)
+
+
+_NOT_TIMED = contextlib.nullcontext()
+
+
+class ChainLoadError(Exception):
+    """Raised when a stored block can't be rebuilt, so the chain can't be loaded as a whole"""
+
 
 class HealthMonitoringSystem:
-    def __init__(self, mongo):
-        self.blockchain = Blockchain()
+    def __init__(self, mongo, block_log_dir=None, snapshot_path=None, snapshot_interval=1000,
+                 recent_readings=1000, recent_seconds=None):
+        # With a block log directory the chain is kept on disk instead of in memory
+        self.blockchain = Blockchain(BlockLog(block_log_dir) if block_log_dir else None)
+        # A snapshot is written every snapshot_interval blocks so restarts replay only the rest
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.last_snapshot_index = 0
+        # Interval snapshots are written on this thread; the lock serializes snapshot writes
+        self._snapshot_thread = None
+        self._snapshot_lock = threading.Lock()
         self.encryptor = DataEncryptor()
         self.contract = HealthSmartContract()
         self.device = IoMTDeviceSimulator()
-        self.patients = {}  # Dictionary to store patient data
+        # Recent readings per patient (the last recent_readings, and only those within
+        # recent_seconds of the newest when set); older ones are read back from MongoDB
+        self.patients = PatientStore(recent_readings, recent_seconds, loader=self.iter_medical_history)
         self.mongo = mongo  # MongoDB connection
         
         # MongoDB collections
         self.patients_collection = mongo.db.patients
         self.health_records_collection = mongo.db.health_records
         self.blockchain_collection = mongo.db.blockchain
+        self.sync_state_collection = mongo.db.sync_state
+        # Where health records are written: the collection itself, or per-patient
+        # time buckets once enable_bucketed_records is called
+        self.record_store = self.health_records_collection
+        self.record_buckets = None
 
-    def process_health_data(self, custom_data=None, skip_db_save=False):
+        # Every block up to persisted_index is known to be in MongoDB; blocks
+        # written past it are held in _persisted_above until the gap closes.
+        # save_state only has to look at blocks beyond the watermark.
+        self.persisted_index = 0
+        self._persisted_above = set()
+        self._persisted_lock = threading.Lock()
+
+        # Merkle batching of readings (disabled until enable_batching is called)
+        self.batch_max_readings = None
+        self.batch_max_wait = None
+        self._batch = []  # (raw_data, encrypted payload) pairs of the open batch
+        self._batch_opened = None
+        self._batch_timer = None  # seals an open batch after batch_max_wait when no miner runs
+        self._batch_lock = threading.Lock()
+        # Serializes appends to the chain between request threads and the miner
+        self._chain_lock = threading.Lock()
+
+        # Proof-of-work mining of batches (disabled until enable_mining is called)
+        self.miner = None
+        self._mining_thread = None
+        self._mining_stop = threading.Event()
+        self._batch_ready = threading.Event()
+
+        # Background MongoDB writer (disabled until enable_write_behind is called)
+        self.write_behind = None
+
+        # Called as stage_timer(stage, seconds) for each ingestion stage when set (see load_test.py)
+        self.stage_timer = None
+
+        # Windowed, de-duplicated alerting (disabled until enable_stream_alerts is called)
+        self.alert_stream = None
+        # Per-patient adaptive baselines (disabled until enable_baselines is called)
+        self.baselines = None
+
+        # Background re-wrapping of payloads after a key rotation
+        self.key_rotation = None
+        self.key_rotation_checkpoint = os.path.join(
+            os.path.dirname(self.encryptor.key_file), 'key_rotation.json')
+
+        # A log-backed chain is already on disk, so its saved watermark applies now;
+        # an in-memory chain gets it back from load_state
+        if self.blockchain.log is not None:
+            self._load_watermark()
+
+    def _prepare_reading(self, custom_data=None):
+        """Run the smart contract on a reading, track the patient and encrypt it"""
+        raw_data, alerts = self._check_reading(custom_data)
+        
+        # Encrypt data before storing in blockchain
+        with self._timed('encrypt'):
+            encrypted_data = self.encryptor.encrypt_data(raw_data)
+        return raw_data, alerts, encrypted_data
+
+    def _check_reading(self, custom_data=None):
+        """Run the smart contract on a reading and track the patient; returns (raw_data, alerts)"""
         # Use custom data if provided, otherwise generate random data
         raw_data = custom_data if custom_data else self.device.generate_health_data()
         
-        # Check for alerts using smart contract
-        alerts = self.contract.check_vitals(raw_data)
-        raw_data['alerts'] = alerts
+        with self._timed('alert_check'):
+            # Check for alerts using smart contract
+            alerts = self.contract.check_vitals(raw_data)
+            raw_data['alerts'] = alerts
+
+            # The stored reading keeps every threshold alert; only what is reported is
+            # scored against the patient's baseline and filtered
+            if self.baselines is not None:
+                alerts = self.baselines.score(raw_data, alerts)
+            if self.alert_stream is not None:
+                alerts = self.alert_stream.process(raw_data, alerts)
         
-        # Store patient ID for future reference
+        # Track the reading in the patient's recent window
+        self.patients.append(raw_data)
+        return raw_data, alerts
+
+    def _timed(self, stage):
+        """Context that reports the time spent in `stage` to stage_timer, if one is set"""
+        if self.stage_timer is None:
+            return _NOT_TIMED
+        return _StageTimer(self.stage_timer, stage)
+
+    def enable_baselines(self, path=None, **options):
+        """
+        Score readings against per-patient running baselines; alerts gain a
+        z-score and readings far from the patient's norm raise their own alert.
+        Baselines are saved to `path` alongside snapshots and in save_state.
+        """
+        if path is None:
+            path = os.path.join(os.path.dirname(self.encryptor.key_file), 'baselines.bin')
+        self.baselines = BaselineTracker(vitals=self.contract.rules.vitals, path=path, **options)
+
+    def save_baselines(self):
+        if self.baselines is None:
+            return
+        try:
+            self.baselines.save()
+        except Exception as e:
+            print(f"Error saving baselines: {e}")
+
+    def enable_stream_alerts(self, rules=None, dedup_seconds=None):
+        """
+        Report windowed alerts (sustained breaches, rapid changes) alongside
+        the per-reading ones, and hold back repeats of recently reported alerts.
+        """
+        options = {} if dedup_seconds is None else {'dedup_seconds': dedup_seconds}
+        self.alert_stream = StreamingAlertEngine(rules=rules, vitals=self.contract.rules.vitals,
+                                                 **options)
+
+    def process_health_data(self, custom_data=None, skip_db_save=False):
+        raw_data, alerts, encrypted_data = self._prepare_reading(custom_data)
         patient_id = raw_data['patient_id']
-        if patient_id not in self.patients:
-            self.patients[patient_id] = []
-        self.patients[patient_id].append(raw_data)
-        
-        # Encrypt data before storing in blockchain
-        encrypted_data = self.encryptor.encrypt_data(raw_data)
         
         # Create and add new block
-        new_block = Block(
-            index=len(self.blockchain.chain),
-            timestamp=time.time(),
-            data=encrypted_data.decode(),
-            previous_hash=self.blockchain.get_latest_block().hash
-        )
-        self.blockchain.add_block(new_block)
+        with self._timed('hash'), self._chain_lock:
+            new_block = Block(
+                index=len(self.blockchain.chain),
+                timestamp=time.time(),
+                data=encrypted_data,
+                previous_hash=self.blockchain.get_latest_block().hash
+            )
+            self.blockchain.add_block(new_block, patient_ids=[patient_id])
+        self._maybe_snapshot()
         
+        # In write-behind mode the writes are queued and the reading acknowledged at once
+        if not skip_db_save and self.write_behind is not None:
+            with self._timed('mongo_write'):
+                self.write_behind.put(self._health_record(raw_data, new_block),
+                                      self._block_document(new_block, patient_id), patient_id)
+
         # Store in MongoDB with explicit error handling
-        if not skip_db_save:
-            try:
-                # Save health record
-                health_record = raw_data.copy()
-                health_record['block_hash'] = new_block.hash
-                health_record['block_index'] = new_block.index
-                health_record['created_at'] = datetime.datetime.now()
+        elif not skip_db_save:
+            with self._timed('mongo_write'):
+                try:
+                    # Save health record
+                    health_record = self._health_record(raw_data, new_block)
+                
+                    record_result = self.record_store.insert_one(health_record)
+                    print(f"Health record saved to MongoDB with ID: {record_result.inserted_id}")
                 
-                record_result = self.health_records_collection.insert_one(health_record)
-                print(f"Health record saved to MongoDB with ID: {record_result.inserted_id}")
+                    # Save blockchain data
+                    block_data = self._block_document(new_block, patient_id)
+                    block_result = self.blockchain_collection.insert_one(block_data)
+                    self._mark_persisted([new_block.index])
+                    print(f"Blockchain data saved to MongoDB with ID: {block_result.inserted_id}")
                 
-                # Save blockchain data
-                block_data = {
+                    # Update patient record if it exists
+                    patient_exists = self.patients_collection.find_one({'patient_id': patient_id})
+                    if patient_exists:
+                        update_result = self.patients_collection.update_one(
+                            {'patient_id': patient_id},
+                            {'$push': {'records': str(record_result.inserted_id)}}
+                        )
+                        print(f"Patient record updated: {update_result.modified_count} document(s) modified")
+                except Exception as e:
+                    print(f"Error saving to MongoDB: {e}")
+        
+        return new_block, alerts, raw_data
+
+    def _health_record(self, raw_data, block, created_at=None):
+        """MongoDB health record for a reading stored in `block`"""
+        health_record = raw_data.copy()
+        health_record['block_hash'] = block.hash
+        health_record['block_index'] = block.index
+        health_record['created_at'] = created_at or datetime.datetime.now()
+        return health_record
+
+    def _block_document(self, block, patient_id, created_at=None):
+        """MongoDB document describing a single-reading block"""
+        return {
+            'index': block.index,
+            'timestamp': block.timestamp,
+            'hash': block.hash,
+            'previous_hash': block.previous_hash,
+            'hash_version': block.version,
+            'patient_id': patient_id,
+            'created_at': created_at or datetime.datetime.now()
+        }
+
+    def enable_write_behind(self, spill_path=None, **options):
+        """
+        Acknowledge readings once their block is on the chain and write them to
+        MongoDB from a background queue (see WriteBehindQueue for the options).
+        """
+        if spill_path is None:
+            spill_path = os.path.join(os.path.dirname(self.encryptor.key_file), 'write_behind.spill')
+        self.write_behind = WriteBehindQueue(
+            self.record_store, self.blockchain_collection, self.patients_collection,
+            spill_path, on_written=self._mark_persisted, **options
+        )
+
+    def enable_bucketed_records(self, bucket_seconds=3600, max_count=1000):
+        """
+        Write new health records into per-patient time buckets (see
+        HealthRecordBuckets) instead of one document per reading. Records
+        already in the health_records collection are still read alongside.
+        Call before enable_write_behind so the queue writes buckets too.
+        """
+        self.record_buckets = HealthRecordBuckets(self.mongo.db.health_buckets, bucket_seconds, max_count)
+        try:
+            self.record_buckets.ensure_indexes()
+        except Exception as e:
+            print(f"Error creating health bucket indexes: {e}")
+        self.record_store = self.record_buckets
+
+    def _records_for_blocks(self, hashes, chunk_size=1000):
+        """Health records of the given blocks, from the collection and any buckets"""
+        records = []
+        for i in range(0, len(hashes), chunk_size):
+            chunk = hashes[i:i + chunk_size]
+            records.extend(self.health_records_collection.find({'block_hash': {'$in': chunk}}))
+            if self.record_buckets is not None:
+                records.extend(self.record_buckets.records_for_blocks(chunk))
+        return records
+
+    def process_health_data_batch(self, readings, skip_db_save=False):
+        """
+        Ingest many readings at once, one block per reading in the given order.
+        MongoDB sees one insert_many for the health records, one for the block
+        documents and one bulk_write of patient updates, however many readings
+        there are. Returns a (block, alerts, raw_data) tuple per reading.
+        """
+        checked = [self._check_reading(reading) for reading in readings]
+        if not checked:
+            return []
+        with self._timed('encrypt'):
+            encrypted = list(self.encryptor.encrypt_many(raw_data for raw_data, _ in checked))
+
+        blocks = []
+        with self._timed('hash'), self._chain_lock:
+            for (raw_data, _), encrypted_data in zip(checked, encrypted):
+                new_block = Block(
+                    index=len(self.blockchain.chain),
+                    timestamp=time.time(),
+                    data=encrypted_data,
+                    previous_hash=self.blockchain.get_latest_block().hash
+                )
+                self.blockchain.add_block(new_block, patient_ids=[raw_data['patient_id']])
+                blocks.append(new_block)
+        self._maybe_snapshot()
+
+        if not skip_db_save and self.write_behind is not None:
+            with self._timed('mongo_write'):
+                for new_block, (raw_data, _) in zip(blocks, checked):
+                    self.write_behind.put(self._health_record(raw_data, new_block),
+                                          self._block_document(new_block, raw_data['patient_id']),
+                                          raw_data['patient_id'])
+        elif not skip_db_save:
+            with self._timed('mongo_write'):
+                try:
+                    now = datetime.datetime.now()
+                    health_records = [self._health_record(raw_data, new_block, now)
+                                      for new_block, (raw_data, _) in zip(blocks, checked)]
+                    block_docs = [self._block_document(new_block, raw_data['patient_id'], now)
+                                  for new_block, (raw_data, _) in zip(blocks, checked)]
+                    record_result = self.record_store.insert_many(health_records)
+                    self.blockchain_collection.insert_many(block_docs)
+                    self._mark_persisted(new_block.index for new_block in blocks)
+
+                    # Only existing patient documents are updated, as in process_health_data
+                    records_by_patient = {}
+                    for (raw_data, _), record_id in zip(checked, record_result.inserted_ids):
+                        records_by_patient.setdefault(raw_data['patient_id'], []).append(str(record_id))
+                    self.patients_collection.bulk_write([
+                        UpdateOne({'patient_id': patient_id}, {'$push': {'records': {'$each': record_ids}}})
+                        for patient_id, record_ids in records_by_patient.items()
+                    ], ordered=False)
+                    print(f"Saved {len(blocks)} readings to MongoDB "
+                          f"(blocks {blocks[0].index}-{blocks[-1].index})")
+                except Exception as e:
+                    print(f"Error saving batch to MongoDB: {e}")
+
+        return [(new_block, alerts, raw_data)
+                for new_block, (raw_data, alerts) in zip(blocks, checked)]
+
+    def enable_batching(self, max_readings=500, max_wait=1.0):
+        """Collect readings into Merkle-batched blocks, sealed by size or by age"""
+        self.batch_max_readings = max_readings
+        self.batch_max_wait = max_wait
+
+    def queue_health_data(self, custom_data=None, skip_db_save=False):
+        """
+        Add a reading to the open batch. Returns (alerts, raw_data, sealed) where
+        sealed lists the (raw_data, proof) pairs of the batch this reading closed,
+        or is empty while the batch window is still open.
+        """
+        raw_data, alerts, encrypted_data = self._prepare_reading(custom_data)
+
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_opened = time.time()
+                if self.miner is None:
+                    # Seal the batch once its window closes, even if no other reading arrives
+                    self._batch_timer = threading.Timer(self.batch_max_wait, self._seal_expired_batch,
+                                                        args=(self._batch_opened, skip_db_save))
+                    self._batch_timer.daemon = True
+                    self._batch_timer.start()
+            self._batch.append((raw_data, encrypted_data))
+            window_closed = len(self._batch) >= self.batch_max_readings or \
+                time.time() - self._batch_opened >= self.batch_max_wait
+
+        if self.miner is not None:
+            # The mining thread seals batches; ingestion never waits for it
+            if window_closed:
+                self._batch_ready.set()
+            return alerts, raw_data, []
+
+        sealed = self.flush_health_batch(skip_db_save)[1] if window_closed else []
+        return alerts, raw_data, sealed
+
+    def _seal_expired_batch(self, opened, skip_db_save):
+        try:
+            self.flush_health_batch(skip_db_save, opened=opened)
+        except Exception as e:
+            print(f"Error sealing batch: {e}")
+
+    def flush_health_batch(self, skip_db_save=False, opened=None):
+        """
+        Seal the open batch into one block; returns (block, [(raw_data, proof), ...]).
+        With `opened`, only a batch opened at that time is sealed.
+        """
+        with self._batch_lock:
+            # The batch a window timer was started for may have been sealed by size already
+            if opened is not None and self._batch_opened != opened:
+                return None, []
+            batch, self._batch = self._batch, []
+            self._batch_opened = None
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+        if not batch:
+            return None, []
+
+        payloads = [encrypted for _, encrypted in batch]
+        patient_ids = [raw_data['patient_id'] for raw_data, _ in batch]
+        while True:
+            with self._chain_lock:
+                index = len(self.blockchain.chain)
+                previous_hash = self.blockchain.get_latest_block().hash
+            new_block = Block.from_batch(
+                index=index,
+                timestamp=time.time(),
+                payloads=payloads,
+                previous_hash=previous_hash
+            )
+            # Mining runs outside the chain lock so other appends are not held up
+            if self.miner is not None:
+                if self.miner.mine(new_block) is None:
+                    # Cancelled (the miner is closing); the readings are kept in an unmined block
+                    print(f"Mining of block {index} was cancelled; sealing it without proof of work")
+                self.blockchain.difficulty = self.miner.difficulty
+            with self._chain_lock:
+                if len(self.blockchain.chain) == index:
+                    self.blockchain.add_block(new_block, patient_ids=patient_ids)
+                    break
+            # Another block was appended meanwhile, so build on the new tip
+        self._maybe_snapshot()
+
+        # Every reading gets a proof that can be checked against the block hash alone
+        levels = batch_levels(payloads)
+        sealed = [(raw_data, new_block.inclusion_proof(position, levels))
+                  for position, (raw_data, _) in enumerate(batch)]
+
+        if not skip_db_save:
+            try:
+                now = datetime.datetime.now()
+                health_records = []
+                for raw_data, proof in sealed:
+                    health_record = raw_data.copy()
+                    health_record['block_hash'] = new_block.hash
+                    health_record['block_index'] = new_block.index
+                    health_record['batch_position'] = proof['position']
+                    health_record['merkle_proof'] = proof['path']
+                    health_record['created_at'] = now
+                    health_records.append(health_record)
+                record_result = self.record_store.insert_many(health_records)
+
+                patient_ids = sorted({raw_data['patient_id'] for raw_data, _ in sealed})
+                self.blockchain_collection.insert_one({
                     'index': new_block.index,
                     'timestamp': new_block.timestamp,
                     'hash': new_block.hash,
                     'previous_hash': new_block.previous_hash,
-                    'patient_id': patient_id,
-                    'created_at': datetime.datetime.now()
-                }
-                block_result = self.blockchain_collection.insert_one(block_data)
-                print(f"Blockchain data saved to MongoDB with ID: {block_result.inserted_id}")
-                
-                # Update patient record if it exists
-                patient_exists = self.patients_collection.find_one({'patient_id': patient_id})
-                if patient_exists:
-                    update_result = self.patients_collection.update_one(
+                    'hash_version': new_block.version,
+                    'nonce': new_block.nonce,
+                    'difficulty': new_block.difficulty,
+                    'merkle_root': sealed[0][1]['merkle_root'],
+                    'patient_id': patient_ids,
+                    'created_at': now
+                })
+                self._mark_persisted([new_block.index])
+
+                # One update per patient in the batch rather than one per reading
+                records_by_patient = {}
+                for (raw_data, _), record_id in zip(sealed, record_result.inserted_ids):
+                    records_by_patient.setdefault(raw_data['patient_id'], []).append(str(record_id))
+                for patient_id, record_ids in records_by_patient.items():
+                    self.patients_collection.update_one(
                         {'patient_id': patient_id},
-                        {'$push': {'records': str(record_result.inserted_id)}}
+                        {'$push': {'records': {'$each': record_ids}}}
                     )
-                    print(f"Patient record updated: {update_result.modified_count} document(s) modified")
+                print(f"Batch block {new_block.index} saved to MongoDB with {len(sealed)} readings")
             except Exception as e:
-                print(f"Error saving to MongoDB: {e}")
-        
-        return new_block, alerts, raw_data
+                print(f"Error saving batch to MongoDB: {e}")
+
+        return new_block, sealed
+
+    def enable_mining(self, workers=None, target_interval=10.0, max_readings=500):
+        """
+        Mine batched blocks with proof of work on a background thread.
+        Readings queued with queue_health_data go into the next mined block.
+        """
+        self.enable_batching(max_readings=max_readings, max_wait=target_interval)
+        self.miner = Miner(workers=workers, difficulty=self.blockchain.difficulty,
+                           target_interval=target_interval)
+        self._mining_stop.clear()
+        self._mining_thread = threading.Thread(target=self._mining_loop, daemon=True)
+        self._mining_thread.start()
+
+    def _mining_loop(self):
+        while not self._mining_stop.is_set():
+            # Seal when the batch window closes, or after the interval at the latest
+            self._batch_ready.wait(self.batch_max_wait)
+            self._batch_ready.clear()
+            try:
+                self.flush_health_batch()
+            except Exception as e:
+                print(f"Error mining block: {e}")
+
+    def disable_mining(self):
+        """Stop the mining thread after sealing whatever is still queued"""
+        if self.miner is None:
+            return
+        self._mining_stop.set()
+        self._batch_ready.set()
+        self._mining_thread.join()
+        self.flush_health_batch()
+        self.miner.close()
+        self.miner = None
+
+    def rotate_encryption_key(self, blocks_per_second=None, chunk_size=500):
+        """
+        Switch new payloads to a fresh master key and re-wrap the existing ones
+        in the background. Returns the running KeyRotationJob.
+        """
+        self.stop_key_rotation()
+        self.encryptor.rotate_key()
+        return self._start_key_rotation(blocks_per_second, chunk_size)
+
+    def resume_key_rotation(self, blocks_per_second=None, chunk_size=500):
+        """Restart an interrupted re-wrap from its checkpoint, if one is pending"""
+        checkpoint = read_checkpoint(self.key_rotation_checkpoint)
+        if checkpoint is None or checkpoint.get('finished') or \
+                checkpoint['key_id'] != self.encryptor.primary_key_id:
+            return None
+        return self._start_key_rotation(blocks_per_second, chunk_size)
+
+    def _start_key_rotation(self, blocks_per_second, chunk_size):
+        self.key_rotation = KeyRotationJob(
+            self.blockchain, self.encryptor, self.key_rotation_checkpoint,
+            chunk_size=chunk_size, blocks_per_second=blocks_per_second, lock=self._chain_lock
+        )
+        return self.key_rotation.start()
+
+    def stop_key_rotation(self):
+        if self.key_rotation is not None:
+            self.key_rotation.stop()
 
     def view_medical_history(self, patient_id):
+        return list(self.iter_medical_history(patient_id))
+
+    def iter_medical_history(self, patient_id, before=None, page_size=500):
+        """
+        Lazily yield a patient's health records, newest first. Records are
+        read from MongoDB in pages of `page_size`, keyset-paginated on
+        (timestamp, _id), so memory stays constant however long the history
+        is. `before` is the (timestamp, _id) of the last record already seen.
+        Bucketed records are unpacked and merged in. If MongoDB fails before
+        any record is read, the history is decrypted from the chain instead; a
+        failure after records were yielded is raised, so a partial history is
+        never passed off as a complete one.
+        """
+        sources = [self._stored_history(patient_id, before, page_size)]
+        if self.record_buckets is not None:
+            sources.append(self.record_buckets.history(patient_id, before))
+        found = False
         # Get history from MongoDB for better performance
         try:
-            records = list(self.health_records_collection.find({'patient_id': patient_id}).sort('timestamp', -1))
-            if records:
-                # Convert ObjectId to string for JSON serialization
-                for record in records:
-                    if '_id' in record:
-                        record['_id'] = str(record['_id'])
-                return records
+            for record in heapq.merge(*sources, key=lambda record: record['timestamp'], reverse=True):
+                found = True
+                yield record
         except Exception as e:
             print(f"Error retrieving from MongoDB: {e}")
-        
-        # Fallback to blockchain if MongoDB fails
-        history = []
-        for block in self.blockchain.chain[1:]:  # Skip genesis block
-            try:
-                decrypted = self.encryptor.decrypt_data(block.data.encode())
-                if decrypted['patient_id'] == patient_id:
-                    history.append(decrypted)
-            except Exception as e:
-                # Skip blocks that can't be decrypted
-                pass
-        return history
+            if found:
+                raise
+        if found:
+            return
+
+        # Fallback to blockchain if MongoDB fails, decrypting only this patient's blocks
+        for _, decrypted in self._block_readings(self.blockchain.blocks_for_patient(patient_id)):
+            if decrypted['patient_id'] == patient_id and (
+                    before is None or decrypted['timestamp'] < before[0]):
+                yield decrypted
+
+    def _stored_history(self, patient_id, before, page_size):
+        """A patient's records in the health_records collection, newest first"""
+        cursor = before
+        while True:
+            query = {'patient_id': patient_id}
+            if cursor is not None:
+                timestamp, record_id = cursor
+                query['$or'] = [{'timestamp': {'$lt': timestamp}}]
+                if record_id is not None:
+                    query['$or'].append({'timestamp': timestamp, '_id': {'$lt': ObjectId(record_id)}})
+            records = self.health_records_collection.find(query).sort(
+                [('timestamp', -1), ('_id', -1)]).limit(page_size)
+            count = 0
+            for record in records:
+                count += 1
+                cursor = (record['timestamp'], record['_id'])
+                # Convert ObjectId to string for JSON serialization
+                record['_id'] = str(record['_id'])
+                yield record
+            if count < page_size:
+                return
 
     def get_all_patients(self):
         # Get all patients from MongoDB
@@ -118,218 +607,668 @@ class HealthMonitoringSystem:
             print(f"Error retrieving patients from MongoDB: {e}")
             return list(self.patients.keys())
 
-    def get_blockchain_data(self):
-        # Get blockchain data from MongoDB for better performance
+    def _block_readings(self, blocks):
+        """Decrypt the readings of blocks in parallel, yielding (block, reading) pairs"""
+        entries = (
+            (block, position, payload)
+            for block in blocks
+            for position, payload in enumerate(block.payloads())
+        )
+        for_tokens, for_keys, for_blocks = itertools.tee(entries, 3)
+        decrypted = self.encryptor.decrypt_many(
+            (payload for _, _, payload in for_tokens),
+            # Memoized by block hash and position within the block
+            cache_keys=((block.hash, position) for block, position, _ in for_keys),
+            ignore_errors=True
+        )
+        for (block, _, _), reading in zip(for_blocks, decrypted):
+            # Skip blocks that can't be decrypted
+            if reading is not None:
+                yield block, reading
+
+    def _decrypted_blocks(self, blocks, patient_id=None):
+        """Lazily decrypt blocks into the entries shown by the dashboard and blockchain views"""
+        # Batch blocks contribute one entry per reading
+        for block, decrypted in self._block_readings(blocks):
+            if patient_id is not None and decrypted['patient_id'] != patient_id:
+                continue
+            yield {
+                'index': block.index,
+                'timestamp': block.timestamp,
+                'hash': block.hash,
+                'previous_hash': block.previous_hash,
+                'data': decrypted
+            }
+
+    # Fields of a health record shown by the dashboard, blockchain and history views
+    _RECORD_FIELDS = ('patient_id', 'heart_rate', 'blood_pressure', 'body_temp', 'spo2',
+                      'glucose', 'timestamp', 'readable_time', 'alerts')
+
+    def _joined_blocks(self, block_query, patient_id=None, limit=None):
+        """
+        Block documents joined with their health records in a single
+        aggregation (plus a bulk record query when records are bucketed), in
+        block order. Batch blocks yield one entry per reading,
+        in batch order. With a limit, at most that many blocks are read.
+        Returns the entries and the index of the last block read, which is the
+        keyset cursor for the next page.
+        """
+        pipeline = [{'$match': block_query}, {'$sort': {'index': 1}}]
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+        if self.record_buckets is not None:
+            rows = self._bucket_joined_rows(pipeline)
+        else:
+            rows = self._lookup_joined_rows(pipeline)
+
+        blockchain_data = []
+        last_index = None
+        seen = set()
+        for row in rows:
+            last_index = row['index']
+            record = row.get('records')
+            if not record:
+                continue
+            # A reading can be stored twice (register_patient inserts its own copy of the
+            # first reading's record); like a find_one per reading, only the first is shown
+            reading = (row['index'], record.pop('batch_position', None))
+            record.pop('_id', None)
+            if reading in seen:
+                continue
+            seen.add(reading)
+            if patient_id is not None and record.get('patient_id') != patient_id:
+                continue
+            blockchain_data.append({
+                'index': row['index'],
+                'timestamp': row['timestamp'],
+                'hash': row['hash'],
+                'previous_hash': row['previous_hash'],
+                'data': record
+            })
+        return blockchain_data, last_index
+
+    def _lookup_joined_rows(self, pipeline):
+        """
+        Block rows joined with their health records by $lookup, one row per
+        record, with a reading's copies in insertion order
+        """
+        pipeline = pipeline + [
+            {'$lookup': {
+                'from': self.health_records_collection.name,
+                'localField': 'hash',
+                'foreignField': 'block_hash',
+                'as': 'records'
+            }},
+            # Blocks without records are kept so the cursor still moves past them
+            {'$unwind': {'path': '$records', 'preserveNullAndEmptyArrays': True}}
+        ]
+        projection = {'_id': 0, 'index': 1, 'timestamp': 1, 'hash': 1, 'previous_hash': 1,
+                      'records._id': 1, 'records.batch_position': 1}
+        projection.update({f'records.{field}': 1 for field in self._RECORD_FIELDS})
+        pipeline += [
+            {'$project': projection},
+            {'$sort': {'index': 1, 'records.batch_position': 1, 'records._id': 1}}
+        ]
+        return self.blockchain_collection.aggregate(pipeline)
+
+    def _bucket_joined_rows(self, pipeline):
+        """
+        Block rows joined with their health records in Python, since bucketed
+        records can't be joined by $lookup: one query for the blocks, then the
+        records of all of them in bulk
+        """
+        blocks = list(self.blockchain_collection.aggregate(pipeline + [{'$project': {
+            '_id': 0, 'index': 1, 'timestamp': 1, 'hash': 1, 'previous_hash': 1}}]))
+        records_by_block = {}
+        for record in self._records_for_blocks([block['hash'] for block in blocks]):
+            records_by_block.setdefault(record['block_hash'], []).append(
+                {field: record[field] for field in self._RECORD_FIELDS + ('batch_position',)
+                 if field in record})
+        for block in blocks:
+            records = records_by_block.get(block['hash'])
+            if not records:
+                # Kept so the cursor still moves past it
+                yield block
+                continue
+            records.sort(key=lambda record: record.get('batch_position', 0))
+            for record in records:
+                yield dict(block, records=record)
+
+    def _paged_blocks(self, block_query, fallback, patient_id=None, after_index=0, page_size=500):
+        """
+        Lazily yield joined block entries after block `after_index`, reading
+        MongoDB in keyset-paginated pages of `page_size` blocks (or in one
+        query when page_size is None). If MongoDB fails part way, the rest
+        comes from `fallback(cursor)`, an iterable of the chain's blocks
+        after the cursor; so does everything when MongoDB has nothing.
+        """
+        cursor = after_index
+        found = False
         try:
-            blocks = list(self.blockchain_collection.find().sort('index', 1))
-            if blocks:
-                blockchain_data = []
-                for block in blocks:
-                    # Get corresponding health record
-                    health_record = self.health_records_collection.find_one({'block_hash': block['hash']})
-                    if health_record:
-                        # Convert ObjectId to string for JSON serialization
-                        if '_id' in health_record:
-                            health_record['_id'] = str(health_record['_id'])
-                        if '_id' in block:
-                            block['_id'] = str(block['_id'])
-                        
-                        block_info = {
-                            'index': block['index'],
-                            'timestamp': block['timestamp'],
-                            'hash': block['hash'],
-                            'previous_hash': block['previous_hash'],
-                            'data': health_record
-                        }
-                        blockchain_data.append(block_info)
-                return blockchain_data
+            while True:
+                entries, last_index = self._joined_blocks(
+                    dict(block_query, index={'$gt': cursor}), patient_id, page_size)
+                found = found or bool(entries)
+                yield from entries
+                if last_index is None:
+                    break
+                cursor = last_index
+                if page_size is None:
+                    break
+            if found:
+                return
+            cursor = after_index
         except Exception as e:
             print(f"Error retrieving blockchain data from MongoDB: {e}")
-        
-        # Fallback to blockchain if MongoDB fails
-        blockchain_data = []
-        for block in self.blockchain.chain[1:]:  # Skip genesis block
-            try:
-                decrypted = self.encryptor.decrypt_data(block.data.encode())
-                block_info = {
-                    'index': block.index,
-                    'timestamp': block.timestamp,
-                    'hash': block.hash,
-                    'previous_hash': block.previous_hash,
-                    'data': decrypted
-                }
-                blockchain_data.append(block_info)
-            except Exception as e:
-                # Skip blocks that can't be decrypted
-                pass
-        return blockchain_data
+
+        yield from self._decrypted_blocks(fallback(cursor), patient_id)
+
+    def iter_blockchain_data(self, start_time=None, end_time=None, after_index=0, page_size=500):
+        """
+        Lazily yield blocks with their health records in block order, starting
+        after block `after_index` (the genesis block is never included),
+        optionally limited to a block timestamp range
+        """
+        query = {}
+        if start_time is not None or end_time is not None:
+            query['timestamp'] = {}
+            if start_time is not None:
+                query['timestamp']['$gte'] = start_time
+            if end_time is not None:
+                query['timestamp']['$lte'] = end_time
+
+        if query:
+            def fallback(cursor):
+                return self.blockchain.blocks_in_range(start_time, end_time, after_index=cursor)
+        else:
+            def fallback(cursor):
+                chain = self.blockchain.chain
+                return (chain[i] for i in range(cursor + 1, len(chain)))
+        return self._paged_blocks(query, fallback, after_index=after_index, page_size=page_size)
+
+    def iter_patient_blockchain_data(self, patient_id, after_index=0, page_size=500):
+        """Lazily yield a patient's blocks with their health records, after block `after_index`"""
+        def fallback(cursor):
+            return self.blockchain.blocks_for_patient(patient_id, after_index=cursor)
+        return self._paged_blocks({'patient_id': patient_id}, fallback, patient_id,
+                                  after_index, page_size)
+
+    def get_blockchain_data(self, start_time=None, end_time=None):
+        """Blocks with their health records, optionally limited to a block timestamp range"""
+        # Read in a single query; use iter_blockchain_data to walk long chains
+        return list(self.iter_blockchain_data(start_time, end_time, page_size=None))
 
     def get_patient_blockchain_data(self, patient_id):
         # Get blockchain data for a specific patient
-        try:
-            blocks = list(self.blockchain_collection.find({'patient_id': patient_id}).sort('index', 1))
-            if blocks:
-                blockchain_data = []
-                for block in blocks:
-                    # Get corresponding health record
-                    health_record = self.health_records_collection.find_one({'block_hash': block['hash']})
-                    if health_record:
-                        # Convert ObjectId to string for JSON serialization
-                        if '_id' in health_record:
-                            health_record['_id'] = str(health_record['_id'])
-                        if '_id' in block:
-                            block['_id'] = str(block['_id'])
-                        
-                        block_info = {
-                            'index': block['index'],
-                            'timestamp': block['timestamp'],
-                            'hash': block['hash'],
-                            'previous_hash': block['previous_hash'],
-                            'data': health_record
-                        }
-                        blockchain_data.append(block_info)
-                return blockchain_data
-        except Exception as e:
-            print(f"Error retrieving patient blockchain data from MongoDB: {e}")
-        
-        # Fallback to filtering all blockchain data
-        return [block for block in self.get_blockchain_data() if block['data']['patient_id'] == patient_id]
+        return list(self.iter_patient_blockchain_data(patient_id, page_size=None))
     
     def remove_patient(self, patient_id):
         """
         Remove a patient from the system.
         Note: This doesn't remove blocks from the blockchain (as that would violate immutability),
-        but it removes the patient from the patients dictionary.
+        but it removes the patient's recent readings from memory.
         """
         if patient_id in self.patients:
             del self.patients[patient_id]
             return True
         return False
+
+    def recent_readings(self, patient_id, limit=None):
+        """A patient's most recent readings from memory, newest first"""
+        return self.patients.recent(patient_id, limit)
     
-    def save_state(self):
-        """Save blockchain data to MongoDB"""
+    def _mark_persisted(self, indices):
+        """Record blocks whose MongoDB documents have been written, advancing the watermark"""
+        with self._persisted_lock:
+            self._persisted_above.update(index for index in indices if index > self.persisted_index)
+            while self.persisted_index + 1 in self._persisted_above:
+                self.persisted_index += 1
+                self._persisted_above.remove(self.persisted_index)
+
+    def save_watermark(self):
+        """
+        Durably record the persisted-through index, with its block's hash, and
+        the chain's verified checkpoint so validation resumes from it after a restart
+        """
+        with self._persisted_lock:
+            index = self.persisted_index
         try:
-            for block in self.blockchain.chain:
-                # Skip genesis block
-                if block.index == 0:
-                    continue
-                    
-                # Check if block already exists in MongoDB
-                existing_block = self.blockchain_collection.find_one({'hash': block.hash})
-                if existing_block:
-                    continue
-                    
-                try:
-                    # For each block, try to decrypt and save data
-                    decrypted_data = self.encryptor.decrypt_data(block.data.encode())
-                    
-                    # Save blockchain data
-                    block_data = {
-                        'index': block.index,
-                        'timestamp': block.timestamp,
-                        'hash': block.hash,
-                        'previous_hash': block.previous_hash,
-                        'patient_id': decrypted_data.get('patient_id', 'unknown'),
-                        'created_at': datetime.datetime.now()
-                    }
-                    self.blockchain_collection.insert_one(block_data)
-                    
-                    # Save health record
-                    health_record = decrypted_data.copy()
-                    health_record['block_hash'] = block.hash
-                    health_record['block_index'] = block.index
-                    health_record['created_at'] = datetime.datetime.now()
-                    self.health_records_collection.insert_one(health_record)
-                    
-                    # Update patient record
-                    patient_id = decrypted_data.get('patient_id')
-                    if patient_id and patient_id != 'unknown':
-                        self.patients_collection.update_one(
-                            {'patient_id': patient_id},
-                            {'$push': {'records': block.hash}},
-                            upsert=True
-                        )
-                except Exception as e:
-                    print(f"Error processing block {block.index}: {e}")
-            
+            self.sync_state_collection.update_one(
+                {'_id': 'blockchain'},
+                {'$set': {'persisted_index': index, 'persisted_hash': self.blockchain.chain[index].hash,
+                          'verified_index': self.blockchain.verified_index,
+                          'verified_hash': self.blockchain.verified_digest.hex()}},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error saving persisted index: {e}")
+
+    def _load_watermark(self):
+        """Restore the watermark saved by save_watermark, if it still describes this chain"""
+        try:
+            state = self.sync_state_collection.find_one({'_id': 'blockchain'})
+        except Exception as e:
+            print(f"Error loading persisted index: {e}")
+            return
+        if not state:
+            return
+        self._restore_checkpoint(state)
+        index = state.get('persisted_index', 0)
+        if index >= len(self.blockchain.chain) or self.blockchain.chain[index].hash != state.get('persisted_hash'):
+            print("Persisted index does not match the chain, ignoring it")
+            return
+        with self._persisted_lock:
+            self.persisted_index = max(self.persisted_index, index)
+        self._mark_persisted(())
+
+    def _restore_checkpoint(self, state):
+        """Resume from the verified checkpoint saved by save_watermark, if its block is unchanged"""
+        index = state.get('verified_index', 0)
+        if index <= self.blockchain.verified_index or index >= len(self.blockchain.chain):
+            return
+        if self.blockchain.chain[index].hash != state.get('verified_hash'):
+            print("Verified checkpoint does not match the chain, ignoring it")
+            return
+        self.blockchain.verified_index = index
+        self.blockchain.verified_digest = self.blockchain.chain[index].digest
+
+    def save_state(self, chunk_size=1000):
+        """
+        Save blocks missing from MongoDB. Only blocks past the persisted-through
+        watermark are considered, so the work is proportional to what is
+        unsaved. They are written in chunks, each with one insert_many per
+        collection and one bulk_write of patient updates.
+        """
+        # Seal any readings still waiting in an open batch
+        if self._batch:
+            self.flush_health_batch()
+
+        try:
+            with self._persisted_lock:
+                written = set(self._persisted_above)
+                candidates = [index for index in range(self.persisted_index + 1, len(self.blockchain.chain))
+                              if index not in written]
+
+            for i in range(0, len(candidates), chunk_size):
+                chunk = candidates[i:i + chunk_size]
+                blocks = [self.blockchain.chain[index] for index in chunk]
+
+                # One query tells which of these blocks are already saved
+                saved = {(doc['index'], doc['hash']) for doc in self.blockchain_collection.find(
+                    {'index': {'$in': chunk}}, {'_id': 0, 'index': 1, 'hash': 1})}
+                missing = [block for block in blocks if (block.index, block.hash) not in saved]
+                self._mark_persisted(block.index for block in blocks if (block.index, block.hash) in saved)
+                if missing:
+                    self._save_blocks(missing)
+
+            self.save_watermark()
+            # Snapshot the final chain so the next startup has nothing to replay
+            self.save_snapshot()
+            self.save_baselines()
             return True
         except Exception as e:
             print(f"Error saving state: {e}")
             return False
 
-    def load_state(self):
-        """Load blockchain data from MongoDB"""
+    def _save_blocks(self, blocks):
+        """Write the MongoDB documents of blocks that are on the chain but not in MongoDB"""
+        entries = [(block, position, payload)
+                   for block in blocks
+                   for position, payload in enumerate(block.payloads())]
+        decrypted = self.encryptor.decrypt_many(
+            (payload for _, _, payload in entries),
+            cache_keys=((block.hash, position) for block, position, _ in entries),
+            ignore_errors=True
+        )
+        readings_by_block = {}
+        for (block, _, _), reading in zip(entries, decrypted):
+            readings_by_block.setdefault(block.index, []).append(reading)
+
+        now = datetime.datetime.now()
+        health_records = []
+        block_docs = []
+        hashes_by_patient = {}
+        for block in blocks:
+            readings = readings_by_block.get(block.index, [])
+            if not readings or any(reading is None for reading in readings):
+                print(f"Error processing block {block.index}: payload could not be decrypted")
+                continue
+            patient_ids = [reading.get('patient_id', 'unknown') for reading in readings]
+            for position, reading in enumerate(readings):
+                health_record = reading.copy()
+                health_record['block_hash'] = block.hash
+                health_record['block_index'] = block.index
+                if len(readings) > 1:
+                    health_record['batch_position'] = position
+                health_record['created_at'] = now
+                health_records.append(health_record)
+
+                patient_id = reading.get('patient_id')
+                if patient_id and patient_id != 'unknown':
+                    hashes_by_patient.setdefault(patient_id, []).append(block.hash)
+            block_docs.append({
+                'index': block.index,
+                'timestamp': block.timestamp,
+                'hash': block.hash,
+                'previous_hash': block.previous_hash,
+                'hash_version': block.version,
+                'nonce': block.nonce,
+                'difficulty': block.difficulty,
+                'patient_id': patient_ids[0] if len(readings) == 1 else sorted(set(patient_ids)),
+                'created_at': now
+            })
+        if not block_docs:
+            return
+
+        # Records first: a block document marks its block as saved
+        self.record_store.insert_many(health_records, ordered=False)
+        self.blockchain_collection.insert_many(block_docs, ordered=False)
+        if hashes_by_patient:
+            self.patients_collection.bulk_write([
+                UpdateOne({'patient_id': patient_id}, {'$push': {'records': {'$each': hashes}}}, upsert=True)
+                for patient_id, hashes in hashes_by_patient.items()
+            ], ordered=False)
+        self._mark_persisted(doc['index'] for doc in block_docs)
+        print(f"Saved {len(block_docs)} unsaved blocks to MongoDB")
+
+    def save_snapshot(self):
+        """
+        Write a snapshot of the chain and its indexes for fast restarts. Only
+        copies are taken under the chain lock; serializing them happens outside it.
+        """
+        # A lazily hydrated chain is rebuilt from MongoDB headers, which is already fast
+        if not self.snapshot_path or isinstance(self.blockchain.chain, LazyChain):
+            return None
+        # A direct save waits for a running background save, so the two never write the same files
+        thread = self._snapshot_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        try:
+            with self._chain_lock:
+                # A log-backed chain is already on disk; only its tip and indexes are needed
+                snapshot = capture_snapshot(self.blockchain, include_blocks=self.blockchain.log is None)
+            self.last_snapshot_index = snapshot.tip_index
+            with self._snapshot_lock:
+                # The snapshot's tip must be durable before the snapshot refers to it
+                self.blockchain.flush()
+                return write_snapshot(self.snapshot_path, snapshot)
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+            return None
+
+    def _maybe_snapshot(self):
+        """Every snapshot_interval blocks, save a snapshot, the baselines and the watermark in the background"""
+        if not self.snapshot_path or \
+                len(self.blockchain.chain) - 1 - self.last_snapshot_index < self.snapshot_interval:
+            return
+        with self._chain_lock:
+            # One background save at a time; a later block starts the next one
+            if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+                return
+            self._snapshot_thread = threading.Thread(target=self._save_interval_state, name='snapshot',
+                                                     daemon=True)
+            self._snapshot_thread.start()
+
+    def _save_interval_state(self):
+        self.save_snapshot()
+        self.save_baselines()
+        self.save_watermark()
+
+    def _restore_snapshot(self):
+        """Restore the chain and indexes from the snapshot file, if one matches this chain"""
+        if not self.snapshot_path:
+            return None
+        snapshot = read_snapshot(self.snapshot_path)
+        if snapshot is None:
+            return None
+
+        if self.blockchain.log is not None:
+            # The snapshot must describe a prefix of the blocks already in the log
+            if snapshot.tip_index >= len(self.blockchain.chain) or \
+                    self.blockchain.chain[snapshot.tip_index].digest != snapshot.tip_digest:
+                print("Snapshot does not match the block log, ignoring it")
+                return None
+        else:
+            if not snapshot.blocks or snapshot.blocks[-1].digest != snapshot.tip_digest:
+                return None
+            self.blockchain.chain = snapshot.blocks
+
+        self.blockchain.patient_index = snapshot.patient_index
+        self.blockchain.timestamp_keys = snapshot.timestamp_keys
+        self.blockchain.timestamp_blocks = snapshot.timestamp_blocks
+        self.last_snapshot_index = snapshot.tip_index
+        return snapshot
+
+    def load_state(self, lazy=False, block_cache_size=10000):
+        """
+        Load blockchain data from the latest snapshot and MongoDB. With lazy,
+        only block headers are loaded and payloads are rebuilt when first read
+        (see LazyChain), keeping at most block_cache_size rebuilt blocks.
+        Raises ChainLoadError when a stored block can't be rebuilt.
+        """
+        if lazy and self.blockchain.log is None:
+            loaded = self._load_headers(block_cache_size)
+        else:
+            loaded = self._load_chain()
+        self._load_watermark()
+        return loaded
+
+    def _rebuild_blocks(self, block_docs):
+        """
+        Rebuild chain blocks from their MongoDB documents and health records,
+        re-encrypting the readings. Returns a (block, readings) pair per
+        document; block is None when the document has no health records.
+        Raises ChainLoadError if a block with records can't be rebuilt, since
+        leaving it out would shift every later block.
+        """
+        # Fetch the health records of all the blocks in bulk
+        records_by_block = {}
+        for record in self._records_for_blocks([block_data['hash'] for block_data in block_docs]):
+            records_by_block.setdefault(record['block_hash'], []).append(record)
+
+        # Strip MongoDB-specific fields so the readings can be re-encrypted
+        replayed = []
+        for block_data in block_docs:
+            health_records = records_by_block.get(block_data['hash'], [])
+            health_records.sort(key=lambda record: record.get('batch_position', 0))
+            readings = []
+            for health_record in health_records:
+                health_record_copy = health_record.copy()
+                for field in ('_id', 'created_at', 'block_hash', 'block_index',
+                              'batch_position', 'merkle_proof'):
+                    health_record_copy.pop(field, None)
+                readings.append(health_record_copy)
+            replayed.append((block_data, readings))
+
+        # Encrypt every replayed reading in one parallel stream
+        encrypted = self.encryptor.encrypt_many(
+            reading for _, readings in replayed for reading in readings
+        )
+
+        rebuilt = []
+        for block_data, readings in replayed:
+            payloads = [next(encrypted) for _ in readings]
+            if not readings:
+                rebuilt.append((None, readings))
+                continue
+            try:
+                # Create a new block with the original hash and data
+                version = block_data.get('hash_version', HASH_VERSION_JSON)
+                if version == HASH_VERSION_MERKLE:
+                    new_block = Block.from_batch(
+                        index=block_data['index'],
+                        timestamp=block_data['timestamp'],
+                        payloads=payloads,
+                        previous_hash=block_data['previous_hash'],
+                        nonce=block_data.get('nonce', 0),
+                        difficulty=block_data.get('difficulty', 0)
+                    )
+                else:
+                    new_block = Block(
+                        index=block_data['index'],
+                        timestamp=block_data['timestamp'],
+                        data=payloads[0],
+                        previous_hash=block_data['previous_hash'],
+                        # Blocks saved before hash versioning used JSON hashing
+                        version=version
+                    )
+
+                # Set the hash to match the stored hash
+                new_block.hash = block_data['hash']
+            except Exception as e:
+                raise ChainLoadError(f"Error reconstructing block {block_data['index']}: {e}") from e
+            rebuilt.append((new_block, readings))
+        return rebuilt
+
+    def _load_chain(self):
         try:
-            # Clear existing chain except genesis block
-            self.blockchain.chain = [self.blockchain.chain[0]]
-            
-            # Load blockchain data from MongoDB
-            blocks = list(self.blockchain_collection.find().sort('index', 1))
-            if not blocks:
-                return False
-                
             # Load patients from MongoDB
             patients = list(self.patients_collection.find())
             for patient in patients:
                 patient_id = patient.get('patient_id')
-                if patient_id and patient_id not in self.patients:
-                    self.patients[patient_id] = []
+                if patient_id:
+                    self.patients.add_patient(patient_id)
+
+            # Only blocks after the snapshot's tip need to be replayed
+            snapshot = self._restore_snapshot()
+            tip_index = snapshot.tip_index if snapshot else 0
+
+            if self.blockchain.log is not None:
+                # A block log already holds the chain on disk, only the indexes are rebuilt
+                if len(self.blockchain.chain) > 1:
+                    self._rebuild_indexes(after_index=tip_index)
+                    return True
+            elif snapshot is None:
+                # Clear existing chain except genesis block
+                self.blockchain.chain = [self.blockchain.chain[0]]
+            self.blockchain.reset_checkpoint()
+            if snapshot is None:
+                self.blockchain.clear_indexes()
             
+            # Load blockchain data from MongoDB
+            blocks = list(self.blockchain_collection.find({'index': {'$gt': tip_index}}).sort('index', 1))
+            if not blocks:
+                return snapshot is not None
+
             # Reconstruct blockchain directly without calling process_health_data
-            for block_data in blocks:
-                # Get corresponding health record
-                health_record = self.health_records_collection.find_one({'block_hash': block_data['hash']})
-                if health_record:
-                    # Create a new block directly
-                    try:
-                        # Remove MongoDB-specific fields for encryption
-                        health_record_copy = health_record.copy()
-                        if '_id' in health_record_copy:
-                            del health_record_copy['_id']
-                        if 'created_at' in health_record_copy:
-                            del health_record_copy['created_at']
-                        if 'block_hash' in health_record_copy:
-                            del health_record_copy['block_hash']
-                        if 'block_index' in health_record_copy:
-                            del health_record_copy['block_index']
-                        
-                        # Encrypt the data
-                        encrypted_data = self.encryptor.encrypt_data(health_record_copy)
-                        
-                        # Create a new block with the original hash and data
-                        new_block = Block(
-                            index=block_data['index'],
-                            timestamp=block_data['timestamp'],
-                            data=encrypted_data.decode(),
-                            previous_hash=block_data['previous_hash']
-                        )
-                        
-                        # Set the hash to match the stored hash
-                        new_block.hash = block_data['hash']
-                        
-                        # Add to blockchain directly (not through process_health_data)
-                        self.blockchain.chain.append(new_block)
-                        
-                        # Update patients dictionary
-                        patient_id = health_record_copy.get('patient_id')
-                        if patient_id and patient_id not in self.patients:
-                            self.patients[patient_id] = []
-                        if patient_id:
-                            self.patients[patient_id].append(health_record_copy)
-                    except Exception as e:
-                        print(f"Error reconstructing block {block_data['index']}: {e}")
+            for i in range(0, len(blocks), 1000):
+                for new_block, readings in self._rebuild_blocks(blocks[i:i + 1000]):
+                    if new_block is None:
+                        continue
+                    # Add to blockchain directly (not through process_health_data)
+                    self.blockchain.chain.append(new_block)
+                    # Replayed from MongoDB, so it is already saved there
+                    self._mark_persisted([new_block.index])
+
+                    # Update patients dictionary
+                    patient_ids = [reading['patient_id'] for reading in readings if reading.get('patient_id')]
+                    self.blockchain.index_block(new_block.index, new_block.timestamp, patient_ids)
+                    for reading in readings:
+                        if reading.get('patient_id'):
+                            self.patients.append(reading)
             
             return True
+        except ChainLoadError:
+            # Continuing with a partial chain would reuse the indexes of the missing blocks
+            raise
         except Exception as e:
             print(f"Error loading state: {e}")
             return False
 
+    def _load_headers(self, block_cache_size):
+        """Hydrate the chain from block headers only, in one projected query"""
+        try:
+            for patient in self.patients_collection.find({}, {'_id': 0, 'patient_id': 1}):
+                if patient.get('patient_id'):
+                    self.patients.add_patient(patient['patient_id'])
+
+            chain = LazyChain(
+                self.blockchain.chain[0],
+                lambda headers: [block for block, _ in self._rebuild_blocks(headers)],
+                cache_size=block_cache_size
+            )
+            self.blockchain.clear_indexes()
+            projection = {'_id': 0, 'index': 1, 'timestamp': 1, 'hash': 1, 'previous_hash': 1,
+                          'hash_version': 1, 'patient_id': 1}
+            persisted_index = 0
+            for block_data in self.blockchain_collection.find({'index': {'$gt': 0}}, projection).sort('index', 1):
+                chain.add_header(block_data)
+                patient_ids = block_data.get('patient_id') or ()
+                if isinstance(patient_ids, str):
+                    patient_ids = [patient_ids]
+                self.blockchain.index_block(block_data['index'], block_data['timestamp'], patient_ids)
+                # Loaded from MongoDB, so already saved there
+                if block_data['index'] == persisted_index + 1:
+                    persisted_index += 1
+
+            self.blockchain.chain = chain
+            self.blockchain.reset_checkpoint()
+            with self._persisted_lock:
+                self.persisted_index = max(self.persisted_index, persisted_index)
+            print(f"Loaded {chain.header_count} block headers; payloads are loaded on demand")
+            return chain.header_count > 0
+        except Exception as e:
+            print(f"Error loading block headers: {e}")
+            return False
+
+    def _rebuild_indexes(self, after_index=0):
+        """Rebuild the chain's patient and timestamp indexes from MongoDB block metadata"""
+        if after_index == 0:
+            self.blockchain.clear_indexes()
+        projection = {'_id': 0, 'index': 1, 'timestamp': 1, 'patient_id': 1}
+        # Blocks lost from an uncommitted log tail exist only in MongoDB and are not indexed
+        query = {'index': {'$gt': after_index, '$lt': len(self.blockchain.chain)}}
+        for block_data in self.blockchain_collection.find(query, projection).sort('index', 1):
+            patient_ids = block_data.get('patient_id') or ()
+            if isinstance(patient_ids, str):
+                patient_ids = [patient_ids]
+            self.blockchain.index_block(block_data['index'], block_data['timestamp'], patient_ids)
+
+    def migrate_chain_format(self):
+        """Re-hash legacy blocks with the current format and update MongoDB references"""
+        renamed = self.blockchain.migrate()
+        if not renamed:
+            return 0
+
+        try:
+            previous_names = {new: old for old, new in renamed.items()}
+            block_updates = []
+            record_updates = []
+            for block in self.blockchain.chain[1:]:
+                old_hash = previous_names.get(block.hash)
+                if old_hash is None:
+                    continue
+                block_updates.append(UpdateOne(
+                    {'hash': old_hash},
+                    {'$set': {'hash': block.hash,
+                              'previous_hash': block.previous_hash,
+                              'hash_version': block.version}}
+                ))
+                record_updates.append(UpdateMany(
+                    {'block_hash': old_hash},
+                    {'$set': {'block_hash': block.hash}}
+                ))
+            if block_updates:
+                self.blockchain_collection.bulk_write(block_updates, ordered=False)
+                self.health_records_collection.bulk_write(record_updates, ordered=False)
+                if self.record_buckets is not None:
+                    self.record_buckets.rename_blocks(renamed)
+        except Exception as e:
+            print(f"Error migrating blockchain data in MongoDB: {e}")
+        return len(renamed)
+
     # Add a method to clear the database for testing
     def clear_database(self):
         """Clear all data from MongoDB collections"""
         try:
             self.health_records_collection.delete_many({})
+            if self.record_buckets is not None:
+                self.record_buckets.delete_many({})
             self.blockchain_collection.delete_many({})
+            self.sync_state_collection.delete_many({})
+            with self._persisted_lock:
+                self.persisted_index = 0
+                self._persisted_above.clear()
             # Don't delete patients to preserve user accounts
             # self.patients_collection.delete_many({})
             print("Database cleared successfully")
@@ -0,0 +1,134 @@
+import datetime
+import json
+import struct
+from functools import lru_cache
+
+from smart_contract import alerts_to_mask, mask_to_alerts
+
+# Schema ids occupy the first byte of an encoded reading. Legacy payloads are
+# JSON objects and therefore always start with '{'.
+SCHEMA_VITALS_V1 = 1
+
+# schema id, timestamp, heart rate, systolic, diastolic, body temp (centi-degrees),
+# SpO2, glucose, alert bitmask, patient id length; the patient id follows
+_VITALS_V1 = struct.Struct('>BdHHHHBHHB')
+_VITALS_KEYS = {'patient_id', 'heart_rate', 'blood_pressure', 'body_temp', 'spo2',
+                'glucose', 'timestamp', 'readable_time', 'alerts'}
+_READABLE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@lru_cache(maxsize=4096)
+def _readable_second(second):
+    return datetime.datetime.fromtimestamp(second).strftime(_READABLE_TIME_FORMAT)
+
+
+def _readable_time(timestamp):
+    # Readings carry their local-time rendering of the timestamp, so it is derived again on decode
+    return _readable_second(int(timestamp // 1))
+
+
+def _is_int(value, limit):
+    return type(value) is int and 0 <= value < limit
+
+
+def encode_vitals(data):
+    """
+    Encode a reading with the compact binary schema. Returns None if the
+    reading can't be represented exactly (unknown keys, out-of-range values,
+    a readable_time that doesn't match the timestamp, custom alerts, ...).
+    """
+    if data.keys() != _VITALS_KEYS:
+        return None
+
+    blood_pressure = data['blood_pressure']
+    body_temp = data['body_temp']
+    patient_id = data['patient_id'].encode() if isinstance(data['patient_id'], str) else None
+    if not (isinstance(blood_pressure, (list, tuple)) and len(blood_pressure) == 2 and
+            _is_int(blood_pressure[0], 1 << 16) and _is_int(blood_pressure[1], 1 << 16) and
+            _is_int(data['heart_rate'], 1 << 16) and _is_int(data['spo2'], 1 << 8) and
+            _is_int(data['glucose'], 1 << 16) and type(body_temp) is float and
+            isinstance(data['timestamp'], float) and
+            patient_id is not None and len(patient_id) < 1 << 8):
+        return None
+
+    centi_temp = round(body_temp * 100)
+    if not 0 <= centi_temp < 1 << 16 or centi_temp / 100 != body_temp:
+        return None
+    if data['readable_time'] != _readable_time(data['timestamp']):
+        return None
+    mask = alerts_to_mask(data['alerts'], data)
+    if mask is None:
+        return None
+
+    return _VITALS_V1.pack(
+        SCHEMA_VITALS_V1, data['timestamp'], data['heart_rate'], blood_pressure[0],
+        blood_pressure[1], centi_temp, data['spo2'], data['glucose'], mask, len(patient_id)
+    ) + patient_id
+
+
+def encode_payload(data):
+    """Compact encoding when the reading fits the schema, JSON otherwise"""
+    encoded = encode_vitals(data)
+    return encoded if encoded is not None else json.dumps(data).encode()
+
+
+def decode_payload(payload):
+    """Decode a reading written by encode_payload, including legacy JSON payloads"""
+    if payload[0] != SCHEMA_VITALS_V1:
+        return json.loads(payload.decode())
+
+    (_, timestamp, heart_rate, systolic, diastolic, centi_temp, spo2, glucose, mask,
+     id_length) = _VITALS_V1.unpack_from(payload, 0)
+    data = {
+        'patient_id': payload[_VITALS_V1.size:_VITALS_V1.size + id_length].decode(),
+        'heart_rate': heart_rate,
+        'blood_pressure': [systolic, diastolic],
+        'body_temp': centi_temp / 100,
+        'spo2': spo2,
+        'glucose': glucose,
+        'timestamp': timestamp,
+        'readable_time': _readable_time(timestamp)
+    }
+    data['alerts'] = mask_to_alerts(mask, data)
+    return data
+
+
+def measure(readings):
+    """Compare encrypted size and round-trip time of the JSON and binary encodings"""
+    import time
+    from cryptography.fernet import Fernet
+
+    cipher = Fernet(Fernet.generate_key())
+    results = {}
+    for name, encode, decode in (
+        ('json', lambda d: json.dumps(d).encode(), lambda p: json.loads(p.decode())),
+        ('binary', encode_payload, decode_payload)
+    ):
+        started = time.perf_counter()
+        tokens = [cipher.encrypt(encode(reading)) for reading in readings]
+        encode_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        for token in tokens:
+            decode(cipher.decrypt(token))
+        decode_seconds = time.perf_counter() - started
+        results[name] = {
+            'token_bytes': sum(len(token) for token in tokens) / len(tokens),
+            'encode_us': encode_seconds / len(readings) * 1e6,
+            'decode_us': decode_seconds / len(readings) * 1e6
+        }
+    return results
+
+
+if __name__ == '__main__':
+    from iomt_simulator import IoMTDeviceSimulator
+    from smart_contract import HealthSmartContract
+
+    contract = HealthSmartContract()
+    readings = []
+    for _ in range(20000):
+        reading = IoMTDeviceSimulator.generate_health_data()
+        reading['alerts'] = contract.check_vitals(reading)
+        readings.append(reading)
+    for name, stats in measure(readings).items():
+        print(f"{name:>6}: {stats['token_bytes']:.0f} bytes/token, "
+              f"encrypt {stats['encode_us']:.1f} us, decrypt {stats['decode_us']:.1f} us")
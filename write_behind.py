@@ -0,0 +1,265 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+_DUPLICATE_KEY = 11000
+
+
+class QueueFull(Exception):
+    """Raised when the write-behind queue stays full for longer than the put timeout"""
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of MongoDB writes drained by a background thread.
+
+    Each entry is one reading: its health record, its block document and the
+    patient whose record list gets the new id. The writer flushes up to
+    `flush_size` entries at a time, or whatever is queued every
+    `flush_interval` seconds. It uses one insert_many per collection and one
+    bulk_write of patient updates. Record ids are assigned before queueing,
+    so a retried batch's already-written records and blocks fail as duplicate
+    keys and are ignored, bucketed records skip ids already in a bucket, and
+    patient updates use $addToSet; retrying a partly applied batch is
+    therefore harmless. Failed flushes are retried with exponential backoff and full
+    jitter.
+
+    Every entry is also appended to `spill_path` before put() returns, so
+    readings that were acknowledged but not yet written survive a crash of
+    the process. The file is fsynced on every flush cycle, which also covers
+    a machine crash. Spilled entries are re-queued when the queue is next
+    opened. A small `.ack` file
+    records how much of the spill file has been written to MongoDB. The
+    spill file is truncated once everything in it is acknowledged.
+
+    When the queue is full, put() blocks the caller (backpressure) for up to
+    `put_timeout` seconds and then raises QueueFull. `on_written`, if given,
+    is called with the block indices of every batch once it is written.
+    """
+
+    def __init__(self, health_records, blockchain, patients, spill_path, max_size=10000,
+                 flush_size=500, flush_interval=0.5, put_timeout=30.0,
+                 retry_base=0.1, retry_max=10.0, compact_bytes=64 * 1024 * 1024, on_written=None):
+        self.health_records = health_records
+        self.blockchain = blockchain
+        self.patients = patients
+        self.spill_path = spill_path
+        self.ack_path = spill_path + '.ack'
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.compact_bytes = compact_bytes
+        self.on_written = on_written
+
+        self._entries = deque()  # (entry, spill bytes) in spill-file order
+        self._in_flight = 0  # entries taken by the writer but not yet acknowledged
+        self._condition = threading.Condition()
+        self._stop = False
+
+        # Metrics
+        self.written = 0
+        self.flushes = 0
+        self.retries = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(spill_path)), exist_ok=True)
+        self._acked = self._read_ack()
+        self._recover()
+        self._spill = open(spill_path, 'ab')
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _read_ack(self):
+        try:
+            with open(self.ack_path) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_ack(self):
+        with open(self.ack_path + '.tmp', 'w') as f:
+            f.write(str(self._acked))
+        os.replace(self.ack_path + '.tmp', self.ack_path)
+
+    def _recover(self):
+        """Re-queue entries spilled by a previous run that never reached MongoDB"""
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, 'rb+') as f:
+            f.seek(self._acked)
+            end = self._acked
+            for line in f:
+                # A torn last line from a crash mid-append was never acknowledged to anyone
+                if not line.endswith(b'\n'):
+                    # Cut it off, or the next append would be glued onto it
+                    f.truncate(end)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    break
+                self._entries.append((json_util.loads(line), len(line)))
+                end += len(line)
+        if self._entries:
+            print(f"Re-queued {len(self._entries)} unwritten records from {self.spill_path}")
+
+    def __len__(self):
+        return len(self._entries) + self._in_flight
+
+    def put(self, health_record, block_doc, patient_id):
+        """Queue one reading's writes; blocks while the queue is full"""
+        # Ids are fixed now so a retried or replayed write can't insert a second copy
+        health_record.setdefault('_id', ObjectId())
+        block_doc.setdefault('_id', ObjectId())
+        entry = {'record': health_record, 'block': block_doc, 'patient_id': patient_id}
+        line = json_util.dumps(entry).encode() + b'\n'
+        deadline = time.monotonic() + self.put_timeout
+        with self._condition:
+            while len(self) >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._stop:
+                    raise QueueFull(f"Write-behind queue full ({self.max_size} entries)")
+                self._condition.wait(remaining)
+            # Spilled before the caller is acknowledged, so a crash can't lose it
+            self._spill.write(line)
+            self._spill.flush()
+            self._entries.append((entry, len(line)))
+            if len(self._entries) >= self.flush_size:
+                self._condition.notify_all()
+
+    def _take(self):
+        with self._condition:
+            if len(self._entries) < self.flush_size and not self._stop:
+                self._condition.wait(self.flush_interval)
+            batch = [self._entries.popleft()
+                     for _ in range(min(self.flush_size, len(self._entries)))]
+            self._in_flight = len(batch)
+            return batch
+
+    def _insert(self, collection, documents):
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Documents already written by an earlier attempt of this batch
+            if any(error.get('code') != _DUPLICATE_KEY for error in e.details.get('writeErrors', [])):
+                raise
+
+    def _write(self, entries):
+        self._insert(self.health_records, [entry['record'] for entry in entries])
+        self._insert(self.blockchain, [entry['block'] for entry in entries])
+
+        records_by_patient = {}
+        for entry in entries:
+            records_by_patient.setdefault(entry['patient_id'], []).append(str(entry['record']['_id']))
+        self.patients.bulk_write([
+            UpdateOne({'patient_id': patient_id}, {'$addToSet': {'records': {'$each': record_ids}}})
+            for patient_id, record_ids in records_by_patient.items()
+        ], ordered=False)
+
+    def _flush(self, batch):
+        """
+        Write a batch, retrying with jittered backoff. Once the queue is
+        closing, gives up after a few attempts and returns False.
+        """
+        attempt = 0
+        while True:
+            try:
+                self._write([entry for entry, _ in batch])
+                break
+            except Exception as e:
+                attempt += 1
+                self.retries += 1
+                if self._stop and attempt >= 3:
+                    print(f"Giving up on {len(batch)} queued records after {attempt} attempts: {e}")
+                    return False
+                delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** attempt))
+                print(f"Write-behind flush failed ({e}); retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+        if self.on_written is not None:
+            self.on_written([entry['block']['index'] for entry, _ in batch])
+
+        with self._condition:
+            self._acked += sum(size for _, size in batch)
+            self._in_flight = 0
+            self.written += len(batch)
+            self.flushes += 1
+            self._spill.flush()
+            os.fsync(self._spill.fileno())
+            if not self._entries and self._acked == self._spill.tell():
+                # Everything spilled has been written; start the spill file over.
+                # The offset is reset first: a crash in between only replays
+                # records that are already written, which is harmless.
+                self._acked = 0
+                self._write_ack()
+                self._spill.truncate(0)
+            elif self._acked >= self.compact_bytes:
+                self._compact()
+            else:
+                self._write_ack()
+            self._condition.notify_all()
+        return True
+
+    def _compact(self):
+        """Drop the acknowledged prefix of the spill file (called with the lock held)"""
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self._acked)
+            pending = f.read()
+        with open(self.spill_path + '.tmp', 'wb') as f:
+            f.write(pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self._acked = 0
+        self._write_ack()
+        self._spill.close()
+        os.replace(self.spill_path + '.tmp', self.spill_path)
+        self._spill = open(self.spill_path, 'ab')
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch:
+                # Gives up only while shutting down, leaving the rest in the spill file
+                if not self._flush(batch):
+                    return
+            elif self._stop:
+                return
+
+    def drain(self, timeout=None):
+        """Wait until everything queued so far has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while len(self) and self._thread.is_alive():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining if remaining is not None else 0.1)
+        return not len(self)
+
+    def close(self, timeout=None):
+        """Flush what is queued and stop the writer; unwritten entries stay spilled"""
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        with self._condition:
+            self._spill.flush()
+            os.fsync(self._spill.fileno())
+            self._spill.close()
+        return not len(self)
+
+    def metrics(self):
+        return {
+            'queued': len(self),
+            'written': self.written,
+            'flushes': self.flushes,
+            'retries': self.retries
+        }